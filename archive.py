@@ -0,0 +1,282 @@
+import os
+import sqlite3
+import threading
+import zlib
+import gzip
+import json
+import cStringIO
+from metrics import Metrics
+
+# Revision archive
+# The raw revision history without a version control system: one JSON record per revision, with
+#   page_id, page_name, rev_id, date, user, comment, flags, title, unixname, parent, source
+# (page_name is the name atm, unixname the name at the revision, parent the parent's unixname or null).
+#
+# The archive is a gzip file of JSON lines, written in blocks: each block is a gzip member of its own,
+# so the file as a whole is an ordinary .jsonl.gz (zcat works), and each block can be decompressed without the others.
+# The index next to it (PATH.idx, SQLite) tells which block and line each revision is in,
+# for reading records by rev_id or page without reading the whole archive.
+# Only blocks in the index count: an archive left after a crash is cut back to its last indexed block.
+
+# Usage:
+#   writer = ArchiveWriter(path)
+#   writer.open(create)
+#   writer.append(record)		# True when the record is safely stored
+#   writer.close()
+#
+#   reader = ArchiveReader(path)
+#   reader.get(rev_id)			# a record
+#   reader.page(page_name)		# records of a page, oldest first
+#   for record in reader: ...	# all, in the order written
+#
+# archive2hg.py replays an archive into a repository.
+
+
+# Gzip member for a block of lines. The header carries no time, so the same records make the same bytes.
+def _compress(lines):
+	buf = cStringIO.StringIO()
+	member = gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0)
+	member.write(''.join(lines))
+	member.close()
+	return buf.getvalue()
+
+def _decompress(data):
+	return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+
+class _Index:
+	def __init__(self, filename):
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(filename, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.executescript("""
+			CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+			CREATE TABLE IF NOT EXISTS blocks (offset INTEGER PRIMARY KEY, length INTEGER);
+			CREATE TABLE IF NOT EXISTS revs (
+				rev_id INTEGER PRIMARY KEY,
+				page_id INTEGER,
+				page_name TEXT,
+				unixname TEXT,
+				date INTEGER,
+				user TEXT,
+				comment TEXT,
+				flags TEXT,
+				block INTEGER,
+				line INTEGER
+			);
+			CREATE INDEX IF NOT EXISTS revs_page ON revs (page_name, date, rev_id);
+			CREATE INDEX IF NOT EXISTS revs_order ON revs (date, rev_id);
+			CREATE TABLE IF NOT EXISTS tree (fname TEXT PRIMARY KEY, data BLOB);
+		""")
+		self.db.commit()
+
+	def getMeta(self, key, default = None):
+		with self.lock:
+			row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		return row[0] if row else default
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+
+class ArchiveWriter:
+	def __init__(self, path, blockSize = 1000):
+		self.path = path
+		self.blockSize = max(blockSize, 1)	# Records per block
+		self.index = None
+		self.fp = None
+		self.end = 0			# Where the next block goes
+		self.lines = []			# Records of the block being filled
+		self.rows = []			# and their index rows
+
+	def exists(self):
+		return os.path.isfile(self.path) and os.path.isfile(self.path+'.idx')
+
+	def open(self, create):
+		if create:
+			for fname in (self.path, self.path+'.idx', self.path+'.idx-wal', self.path+'.idx-shm'):
+				if os.path.isfile(fname):
+					os.remove(fname)
+		self.index = _Index(self.path+'.idx')
+		self.end = self.index.getMeta('end', 0)
+		self.fp = open(self.path, 'ab' if os.path.isfile(self.path) else 'wb')
+		self.fp.truncate(self.end) # drop whatever didn't make it to the index
+		self.fp.seek(self.end)
+
+	# Adds a record. Returns True if it and all before it are stored.
+	# tree: see flush(), stored if this completes a block.
+	def append(self, record, tree = None):
+		self.lines.append(json.dumps(record, sort_keys=True)+'\n')
+		self.rows.append((int(record['rev_id']), record['page_id'], record['page_name'], record['unixname'],
+			record['date'], record['user'], record['comment'], record.get('flags')))
+		if len(self.lines) >= self.blockSize:
+			self.flush(tree)
+			return True
+		return False
+
+	#
+	# Writes out the current block and indexes it.
+	# tree: files to store in the index along with it, fname -> data (None to delete),
+	# for ArchiveBackend to keep its files consistent with the records.
+	#
+	def flush(self, tree = None):
+		if self.lines:
+			data = _compress(self.lines)
+			self.fp.write(data)
+			self.fp.flush()
+			os.fsync(self.fp.fileno())
+		with self.index.lock:
+			db = self.index.db
+			if self.lines:
+				db.execute('INSERT OR REPLACE INTO blocks (offset, length) VALUES (?, ?)', (self.end, len(data)))
+				db.executemany('INSERT OR REPLACE INTO revs (rev_id, page_id, page_name, unixname, date, user, comment, flags, block, line) '
+					'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [row + (self.end, i) for i, row in enumerate(self.rows)])
+				self.end += len(data)
+				db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('end', self.end))
+			for fname, data in (tree or {}).items():
+				if data is None:
+					db.execute('DELETE FROM tree WHERE fname = ?', (fname,))
+				else:
+					db.execute('INSERT OR REPLACE INTO tree (fname, data) VALUES (?, ?)', (fname, sqlite3.Binary(data)))
+			db.commit()
+		self.lines = []
+		self.rows = []
+
+	def treeFile(self, fname):
+		with self.index.lock:
+			row = self.index.db.execute('SELECT data FROM tree WHERE fname = ?', (fname,)).fetchone()
+		return str(row[0]) if row else None
+
+	# Names of the files stored along with the blocks, starting with prefix
+	def treeFiles(self, prefix = ''):
+		with self.index.lock:
+			rows = self.index.db.execute('SELECT fname FROM tree').fetchall()
+		fnames = [row[0].encode('utf-8') for row in rows]
+		return [fname for fname in fnames if fname.startswith(prefix)]
+
+	# Works without open()
+	def lastDate(self):
+		index = self.index or _Index(self.path+'.idx')
+		try:
+			with index.lock:
+				return index.db.execute('SELECT MAX(date) FROM revs').fetchone()[0]
+		finally:
+			if index is not self.index:
+				index.close()
+
+	def close(self, tree = None):
+		self.flush(tree)
+		self.fp.close()
+		self.index.close()
+
+
+class ArchiveReader:
+	def __init__(self, path):
+		self.path = path
+		if not os.path.isfile(path+'.idx'):
+			raise IOError("No index for archive "+path)
+		self.index = _Index(path+'.idx')
+		self.fp = open(path, 'rb')
+		self.lock = threading.Lock()
+		self.cached = (None, None)	# Last block read: (offset, lines)
+
+	def close(self):
+		self.fp.close()
+		self.index.close()
+
+	def _block(self, offset):
+		with self.lock:
+			if self.cached[0] == offset:
+				return self.cached[1]
+			with self.index.lock:
+				length = self.index.db.execute('SELECT length FROM blocks WHERE offset = ?', (offset,)).fetchone()[0]
+			self.fp.seek(offset)
+			lines = _decompress(self.fp.read(length)).rstrip('\n').split('\n')
+			self.cached = (offset, lines)
+			return lines
+
+	def _record(self, block, line):
+		return json.loads(self._block(block)[line])
+
+	# Record of a revision, or None if it isn't in the archive
+	def get(self, rev_id):
+		with self.index.lock:
+			row = self.index.db.execute('SELECT block, line FROM revs WHERE rev_id = ?', (int(rev_id),)).fetchone()
+		return self._record(*row) if row else None
+
+	# Records of a page (by its name atm), oldest first
+	def page(self, page_name):
+		with self.index.lock:
+			rows = self.index.db.execute('SELECT block, line FROM revs WHERE page_name = ? ORDER BY date, rev_id', (page_name,)).fetchall()
+		return [self._record(*row) for row in rows]
+
+	# Pages in the archive: [(page_name, page_id)]
+	def pages(self):
+		with self.index.lock:
+			return self.index.db.execute('SELECT DISTINCT page_name, page_id FROM revs ORDER BY page_name').fetchall()
+
+	#
+	# Revision list of a page as Wikidot.get_revisions returns it, from the index alone
+	#
+	def revisions(self, page_name):
+		with self.index.lock:
+			rows = self.index.db.execute('SELECT rev_id, date, user, comment, flags FROM revs WHERE page_name = ? ORDER BY date DESC, rev_id DESC',
+				(page_name,)).fetchall()
+		return [{
+		  'id' : str(row[0]),
+		  'date' : row[1],
+		  'user' : row[2],
+		  'comment' : row[3],
+		  'flags' : row[4],
+		} for row in rows]
+
+	# All records in the order written, a block at a time
+	def __iter__(self):
+		with self.index.lock:
+			offsets = [row[0] for row in self.index.db.execute('SELECT offset FROM blocks ORDER BY offset')]
+		for offset in offsets:
+			for line in self._block(offset):
+				yield json.loads(line)
+
+
+#
+# Stands in for Wikidot when replaying an archive: answers the queries RepoMaintainer makes while committing
+# from the archive's records, so nothing is requested.
+#
+class ArchiveWikidot:
+	def __init__(self, reader):
+		self.reader = reader
+		self.site = None
+		self.metrics = Metrics()
+		self.cache = None
+
+	def _get(self, rev_id):
+		record = self.reader.get(rev_id)
+		if record is None:
+			raise Exception("Revision "+str(rev_id)+" is not in the archive")
+		return record
+
+	def get_revision_source(self, rev_id):
+		return self._get(rev_id)['source']
+
+	def get_revision_version(self, rev_id, content = True):
+		if content:
+			raise Exception("Archives don't keep page content")
+		record = self._get(rev_id)
+		return {
+		  'rev_id': str(rev_id),
+		  'unixname': record['unixname'],
+		  'title': record['title'],
+		  'content': None,
+		}
+
+	def download_file(self, url, fp, chunk_size = 65536):
+		raise Exception("Archives don't keep attached files")
+
+	def effective_rate(self):
+		return 0.0
+
+	def connection_stats(self):
+		return (0, 0)
@@ -0,0 +1,74 @@
+import argparse
+import sys
+import os
+import codecs
+import locale
+from rmaint import RepoMaintainer
+from revstore import RevisionStore
+from archive import ArchiveReader, ArchiveWikidot
+
+# Replays a revision archive (crawl.py --export) into a Mercurial repository.
+# Commits go through RepoMaintainer exactly as in a dump, with the archive answering its queries,
+# so the repository is the same as a --dump of the site would have made. Nothing is requested from Wikidot.
+# If interrupted, restart the same command.
+
+# Example:
+#   crawl.py http://example.wikidot.com --export example.jsonl.gz
+#   archive2hg.py example.jsonl.gz --dump ExampleRepo
+
+
+sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout, 'xmlcharrefreplace')
+
+def force_dirs(path):
+	try:
+		os.makedirs(path)
+	except OSError as exception:
+		if exception.errno != os.errno.EEXIST:
+			raise
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Replays a revision archive made by crawl.py --export into a Mercurial repository')
+	parser.add_argument('archive', help='Archive file')
+	parser.add_argument('--dump', type=str, required=True, help='Create the repository in this directory')
+	parser.add_argument('--revids', action='store_true', help='Store last revision ids in the repository')
+	parser.add_argument('--commit-engine', type=str, default='commands', choices=['commands', 'memory'], help='How to commit: through Mercurial commands, or by building changesets in memory (faster)')
+	parser.add_argument('--commit-batch', type=int, default='100', help='Commits per transaction for --commit-engine memory')
+	parser.add_argument('--progress-interval', type=int, default='10', help='Print progress and ETA every N seconds')
+	parser.add_argument('--debug', action='store_true', help='Print debug info')
+	args = parser.parse_args()
+
+	reader = ArchiveReader(args.archive)
+	print "Replaying "+args.archive+" into "+args.dump
+	force_dirs(args.dump)
+	rm = RepoMaintainer(ArchiveWikidot(reader), args.dump)
+	rm.debug = args.debug
+	rm.storeRevIds = args.revids
+	rm.fetchFiles = False
+	rm.engine = args.commit_engine
+	rm.commitBatch = args.commit_batch
+	rm.progressInterval = args.progress_interval
+	if rm.lastDumpDate() is not None:
+		raise Exception("There's a finished dump at "+args.dump+" already, replay into a new directory")
+
+	# The revision list, from the archive's index: buildRevisionList takes it from here as a finished one
+	store = RevisionStore(args.dump+'\\.wrevs.db')
+	if not store.isComplete():
+		print "Reading revision list..."
+		for page_name, page_id in reader.pages():
+			store.addPage(page_name, page_id, reader.revisions(page_name))
+		store.setMeta('started', 1)
+		store.setComplete()
+	store.close()
+	rm.buildRevisionList()
+	rm.openRepo()
+
+	print "Committing revisions..."
+	while rm.commitNext():
+		pass
+	rm.cleanup()
+	reader.close()
+	print "Done."
+
+if __name__ == '__main__':
+	main()
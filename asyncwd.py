@@ -0,0 +1,153 @@
+import threading
+import Queue
+import sys
+from wikidot import Wikidot
+
+# Non-blocking Wikidot client
+# Queries return futures right away and run on a bounded pool of threads, so many requests
+# can be in flight at once. Response parsing happens on the pool threads too, never in the caller.
+# All requests still go through the Wikidot instance's rate limiter (and shared limiter, if any),
+# so keeping more requests in flight doesn't make us less polite.
+#
+# This is Python 2, so there's no asyncio: futures here are the thread-based kind.
+# The blocking Wikidot class stays the API underneath; AsyncWikidot.wd is the same client, usable directly.
+
+# Usage:
+#   awd = AsyncWikidot('http://example.wikidot.com', concurrency=8)
+#   futures = [awd.get_revision_source(rev_id) for rev_id in rev_ids]
+#   sources = awd.gather(futures)		# or futures[i].result()
+#   awd.close()
+
+
+#
+# Result of a query which may not have finished yet
+#
+class Future:
+	def __init__(self):
+		self.cond = threading.Condition()
+		self.finished = False
+		self.value = None
+		self.exc_info = None
+		self.callbacks = []
+
+	def done(self):
+		with self.cond:
+			return self.finished
+
+	def _finish(self, value, exc_info):
+		with self.cond:
+			self.value = value
+			self.exc_info = exc_info
+			self.finished = True
+			callbacks = self.callbacks
+			self.callbacks = []
+			self.cond.notify_all()
+		for callback in callbacks:
+			callback(self)
+
+	# Returns the query result, waiting for it if needed. Re-raises query errors.
+	# Raises Queue.Empty on timeout.
+	def result(self, timeout = None):
+		with self.cond:
+			if timeout is None:
+				while not self.finished:
+					self.cond.wait(1) # in steps, so Ctrl+C gets through
+			elif not self.finished:
+				self.cond.wait(timeout)
+			if not self.finished:
+				raise Queue.Empty("Query still running")
+		if self.exc_info:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.value
+
+	# Calls callback(future) when finished (right away if already), on the thread which finished it
+	def add_done_callback(self, callback):
+		with self.cond:
+			if not self.finished:
+				self.callbacks.append(callback)
+				return
+		callback(self)
+
+
+class AsyncWikidot:
+	def __init__(self, site, concurrency = 8):
+		if isinstance(site, Wikidot):
+			self.wd = site
+		else:
+			self.wd = Wikidot(site)
+		self.concurrency = concurrency	# Max requests in flight
+		self.wd.pool_size = max(self.wd.pool_size, concurrency) # a connection for each
+		self.jobs = Queue.Queue()
+		self.threads = []
+		self.lock = threading.Lock()
+
+	def _start(self):
+		with self.lock:
+			while len(self.threads) < self.concurrency:
+				thread = threading.Thread(target=self._work)
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+
+	def _work(self):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+			future, fn, args, kwargs = job
+			try:
+				value = fn(*args, **kwargs)
+			except Exception:
+				future._finish(None, sys.exc_info())
+			else:
+				future._finish(value, None)
+
+	# Runs fn(*args, **kwargs) on the pool. Returns a Future.
+	def submit(self, fn, *args, **kwargs):
+		if not self.threads:
+			self._start()
+		future = Future()
+		self.jobs.put((future, fn, args, kwargs))
+		return future
+
+	# Waits for all futures and returns their results in order. Raises the first error.
+	def gather(self, futures):
+		return [future.result() for future in futures]
+
+	# Waits for queued queries to finish and stops the pool threads
+	def close(self):
+		with self.lock:
+			threads = self.threads
+			self.threads = []
+			for thread in threads:
+				self.jobs.put(None)
+		for thread in threads:
+			thread.join()
+
+
+	# Same queries as Wikidot, returning futures
+
+	def queryex(self, params):
+		return self.submit(self.wd.queryex, dict(params)) # queryex adds the token to params
+
+	def query(self, params):
+		return self.submit(self.wd.query, dict(params))
+
+	# Future of a list: the listing is requested page by page, but only returned whole
+	def list_pages(self, limit = None, order = 'dateCreatedDesc', **filters):
+		return self.submit(lambda: list(self.wd.list_pages(limit, order, **filters)))
+
+	def list_page_ids(self, limit = None, **filters):
+		return self.submit(self.wd.list_page_ids, limit, **filters)
+
+	def get_page_id(self, page_unix_name):
+		return self.submit(self.wd.get_page_id, page_unix_name)
+
+	def get_revisions(self, page_id, limit):
+		return self.submit(self.wd.get_revisions, page_id, limit)
+
+	def get_revision_source(self, rev_id):
+		return self.submit(self.wd.get_revision_source, rev_id)
+
+	def get_revision_version(self, rev_id, content = True):
+		return self.submit(self.wd.get_revision_version, rev_id, content)
@@ -0,0 +1,562 @@
+import os
+import sys
+import codecs
+import subprocess
+import hashlib
+import shutil
+import time
+from archive import ArchiveWriter
+
+# Commit backends for RepoMaintainer
+# A backend stores page files and commits them. RepoMaintainer only talks to the repository through it.
+
+# Interface:
+#   exists()							Whether there's a repository at path already
+#   open(create)						Open the repository at path, or create a new one
+#   readFile(fname)					Current contents of a tracked file, unicode
+#   writeFile(fname, content)			Set contents of a file (unicode)
+#   addFile(fname)					Start tracking a new file
+#   writeBinaryFile(fname, filename)	Set contents of a file to those of a file on disk, tracking it if new
+#   removeFile(fname)					Stop tracking a file and delete it, if it exists
+#   renameFile(oldfname, newfname)	Rename a tracked file, keeping its history
+#   listFiles(prefix)					Names of the tracked files starting with prefix, e.g. those in a directory
+#   setRevision(record)				Details of the revision the next commit is for, see archive.py
+#   commit(message, user, date)		Commit the changes. Returns True if this and all previous commits are safely stored
+#   close()							Store everything and bring the repository into a final state
+#   lastDate()						Date of the last commit, or None. Works without open(), and leaves nothing open
+# File names are relative to the repository root.
+
+
+# Mercurial is only loaded for the backends which use it: it's slow to import, and patched when loaded
+commands = ui = hg = context = node = None
+
+def _loadMercurial():
+	global commands, ui, hg, context, node
+	if commands is None:
+		from mercurial import commands, ui, hg, context, node
+		import hgpatch
+
+# Mercurial and git want file names as byte strings
+def _bytes(fname):
+	if isinstance(fname, unicode):
+		return fname.encode('utf-8')
+	return fname
+
+
+#
+# Commits through mercurial.commands, exactly as a user would.
+# Every commit is immediately durable, but each one scans the whole working copy.
+#
+class HgCommandBackend:
+	def __init__(self, path):
+		_loadMercurial()
+		self.path = path
+		self.ui = None
+		self.repo = None
+
+	def exists(self):
+		return os.path.isdir(os.path.join(self.path, '.hg')) # where init puts it
+
+	def open(self, create):
+		self.ui = ui.ui()
+		if create:
+			commands.init(self.ui, self.path)
+		self.repo = hg.repository(self.ui, self.path)
+
+	def _fullpath(self, fname):
+		return self.path+'\\'+fname
+
+	def readFile(self, fname):
+		with codecs.open(self._fullpath(fname), "r", "UTF-8") as f:
+			return f.read()
+
+	def writeFile(self, fname, content):
+		outp = codecs.open(self._fullpath(fname), "w", "UTF-8")
+		outp.write(content)
+		outp.close()
+
+	def addFile(self, fname):
+		commands.add(self.ui, self.repo, str(self._fullpath(fname)))
+
+	def writeBinaryFile(self, fname, filename):
+		fullpath = self._fullpath(fname)
+		if not os.path.isdir(os.path.dirname(fullpath)):
+			os.makedirs(os.path.dirname(fullpath))
+		new = not os.path.isfile(fullpath)
+		shutil.copyfile(filename, fullpath)
+		if new:
+			self.addFile(fname)
+
+	def removeFile(self, fname):
+		if os.path.isfile(self._fullpath(fname)):
+			commands.remove(self.ui, self.repo, str(self._fullpath(fname)))
+
+	def renameFile(self, oldfname, newfname):
+		commands.rename(self.ui, self.repo, str(self._fullpath(oldfname)), str(self._fullpath(newfname)))
+
+	def listFiles(self, prefix):
+		prefix = _bytes(prefix)
+		return [fname for fname in self.repo[None] if fname.startswith(prefix)] # working copy, with changes not committed yet
+
+	def setRevision(self, record):
+		pass # the commit says it all
+
+	def commit(self, message, user, date):
+		commands.commit(self.ui, self.repo, message=message, user=user, date=date)
+		return True
+
+	def close(self):
+		pass
+
+	def lastDate(self):
+		repo = self.repo or hg.repository(ui.ui(), self.path) # nothing to close
+		if len(repo) <= 0:
+			return None
+		return repo['tip'].date()[0]
+
+
+#
+# Builds changesets in memory (memctx) straight from the page contents we hold,
+# without touching the working copy or dirstate.
+# Commits are grouped into transactions of `batch` commits; the working copy is only updated in close().
+#
+class HgMemoryBackend:
+	def __init__(self, path, batch = 100):
+		_loadMercurial()
+		self.path = path
+		self.batch = max(batch, 1)	# Commits per transaction
+		self.ui = None
+		self.repo = None
+		self.parent = node.nullid	# Node we're committing on top of
+		self.pending = {}			# fname -> utf-8 data, or None if removed in the next commit
+		self.copies = {}			# fname -> fname it was renamed from in the next commit
+		self.lock = None			# Repo lock and transaction of the current batch
+		self.tr = None
+		self.uncommitted = 0		# Commits in the current transaction
+
+	def exists(self):
+		return os.path.isdir(os.path.join(self.path, '.hg')) # where init puts it
+
+	def open(self, create):
+		self.ui = ui.ui()
+		if create:
+			commands.init(self.ui, self.path)
+		self.repo = hg.repository(self.ui, self.path)
+		if self.repo.svfs.exists('journal'):
+			self.repo.recover() # roll back the batch we were writing when we crashed
+			self.repo = hg.repository(self.ui, self.path)
+		self.parent = self.repo['tip'].node()
+
+	def _currentData(self, fname):
+		fname = _bytes(fname)
+		if fname in self.pending:
+			return self.pending[fname]
+		ctx = self.repo[self.parent]
+		if fname in ctx:
+			return ctx[fname].data()
+		return None
+
+	def readFile(self, fname):
+		data = self._currentData(fname)
+		if data is None:
+			raise IOError("No such file in repository: "+fname)
+		return data.decode('utf-8')
+
+	def writeFile(self, fname, content):
+		self.pending[_bytes(fname)] = content.encode('utf-8')
+
+	def addFile(self, fname):
+		pass # any file we write becomes tracked
+
+	# memfilectx wants the data itself, so it's read into memory until the commit
+	def writeBinaryFile(self, fname, filename):
+		with open(filename, 'rb') as fp:
+			self.pending[_bytes(fname)] = fp.read()
+
+	def removeFile(self, fname):
+		if self._currentData(fname) is not None:
+			self.pending[_bytes(fname)] = None
+
+	def renameFile(self, oldfname, newfname):
+		oldfname, newfname = _bytes(oldfname), _bytes(newfname)
+		self.pending[newfname] = self._currentData(oldfname)
+		self.pending[oldfname] = None
+		self.copies[newfname] = self.copies.pop(oldfname, oldfname)
+
+	def listFiles(self, prefix):
+		prefix = _bytes(prefix)
+		fnames = set(fname for fname in self.repo[self.parent] if fname.startswith(prefix))
+		for fname, data in self.pending.items():
+			if fname.startswith(prefix):
+				if data is None:
+					fnames.discard(fname)
+				else:
+					fnames.add(fname)
+		return sorted(fnames)
+
+	def _fileCtx(self, repo, memctx, fname):
+		data = self.pending[fname]
+		if data is None:
+			return None
+		try:
+			return context.memfilectx(repo, memctx, fname, data, copysource=self.copies.get(fname))
+		except TypeError: # Mercurial < 5.0
+			return context.memfilectx(repo, memctx, fname, data, copied=self.copies.get(fname))
+
+	def setRevision(self, record):
+		pass # the commit says it all
+
+	def commit(self, message, user, date):
+		# Drop writes which didn't change anything, like Mercurial itself would
+		ctx = self.repo[self.parent]
+		for fname in self.pending.keys():
+			if fname in self.copies: continue
+			data = self.pending[fname]
+			if (fname in ctx) and (data is not None) and (ctx[fname].data() == data):
+				del self.pending[fname]
+			elif (fname not in ctx) and (data is None):
+				del self.pending[fname]
+		if not self.pending:
+			return self.uncommitted == 0 # nothing changed, no commit
+
+		if self.tr is None:
+			self.lock = self.repo.lock()
+			self.tr = self.repo.transaction('wikidot-dump')
+		memctx = context.memctx(self.repo, (self.parent, node.nullid), message,
+			sorted(self.pending.keys()), self._fileCtx, user=user, date=date)
+		self.parent = self.repo.commitctx(memctx)
+		self.pending = {}
+		self.copies = {}
+
+		self.uncommitted += 1
+		if self.uncommitted >= self.batch:
+			self._flush()
+			return True
+		return False
+
+	def _flush(self):
+		if self.tr is not None:
+			self.tr.close()
+			self.tr.release()
+			self.lock.release()
+			self.tr = None
+			self.lock = None
+		self.uncommitted = 0
+
+	def close(self):
+		self._flush()
+		# Bring the working copy up to date in one go
+		hg.update(self.repo, self.repo['tip'].node())
+
+	def lastDate(self):
+		repo = self.repo or hg.repository(ui.ui(), self.path) # nothing to close
+		if len(repo) <= 0:
+			return None
+		return repo['tip'].date()[0]
+
+
+#
+# Writes history as a git fast-import stream.
+# By default the stream is piped into `git fast-import` running in a git repository at path;
+# with `output` it goes to that file instead ('-' for stdout), to be imported elsewhere.
+# Streams written to a file can't be continued: the files they hold are only known to the repository
+# they get imported into, so the next dump has nothing to diff against.
+#
+class GitFastImportBackend:
+	def __init__(self, path, output = None, batch = 100):
+		self.path = path
+		self.output = output		# Stream destination, None = pipe into git at path
+		self.batch = max(batch, 1)	# Commits between checkpoints
+		self.branch = 'refs/heads/master'
+		self.proc = None			# git fast-import process
+		self.stream = None
+		self.files = {}				# fname -> utf-8 data, current tree as far as we know
+		self.binaries = {}			# fname -> sha1 of data, for files written with writeBinaryFile
+		self.blobs = {}				# sha1 of data -> blob mark
+		self.next_mark = 1
+		self.changes = []			# fast-import file commands for the next commit
+		self.continued = False		# The branch already exists, first commit must say where to continue from
+		self.lookup = False			# The branch existed when opened, files we haven't seen are looked up in it
+		self.last_date = None
+		self.uncommitted = 0		# Commits since the last checkpoint
+
+	def exists(self):
+		if self.output is None:
+			return os.path.isdir(os.path.join(self.path, '.git')) # where git init puts it
+		return (self.output != '-') and os.path.isfile(self.output)
+
+	def _git(self, *args):
+		return subprocess.check_output(('git',) + args, cwd=self.path)
+
+	def open(self, create):
+		self.continued = not create
+		if self.output is None:
+			if create:
+				subprocess.check_call(['git', 'init', '-q', self.path])
+				self._git('symbolic-ref', 'HEAD', self.branch)
+			else:
+				self.continued = (self.lastDate() is not None) # we may have crashed before the first checkpoint
+			self.lookup = self.continued
+			self.proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=self.path, stdin=subprocess.PIPE)
+			self.stream = self.proc.stdin
+			# Without 'done' at the end the import is aborted and refs stay at the last checkpoint,
+			# which is what the journal remembers. Otherwise a crash would still commit the rest.
+			self.stream.write('feature done\n')
+		elif self.output == '-':
+			self.stream = sys.__stdout__
+		else:
+			if not create:
+				raise Exception("Cannot continue the dump streamed to "+self.output+": import it and dump into that repository "
+					"(--dump without --git-output), or remove it and the dump state at "+self.path+" to start over")
+			self.stream = open(self.output, 'wb')
+
+	def _quote(self, fname):
+		return '"' + fname.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+	def _data(self, data):
+		self.stream.write('data %d\n' % len(data))
+		self.stream.write(data)
+		self.stream.write('\n')
+
+	def _currentData(self, fname):
+		fname = _bytes(fname)
+		if fname not in self.files and self.lookup:
+			# Continuing an earlier dump: look it up in the repository
+			try:
+				self.files[fname] = self._git('cat-file', 'blob', self.branch+':'+fname)
+			except subprocess.CalledProcessError:
+				self.files[fname] = None
+		return self.files.get(fname)
+
+	def readFile(self, fname):
+		data = self._currentData(fname)
+		if data is None:
+			raise IOError("No such file in repository: "+fname)
+		return data.decode('utf-8')
+
+	def writeFile(self, fname, content):
+		fname = _bytes(fname)
+		data = content.encode('utf-8')
+		if self._currentData(fname) == data:
+			return # unchanged
+		digest = hashlib.sha1(data).digest()
+		mark = self.blobs.get(digest)
+		if mark is None: # identical contents are only sent once
+			mark = self.next_mark
+			self.next_mark += 1
+			self.stream.write('blob\nmark :%d\n' % mark)
+			self._data(data)
+			self.blobs[digest] = mark
+		self.files[fname] = data
+		self.changes.append('M 100644 :%d %s\n' % (mark, self._quote(fname)))
+
+	def addFile(self, fname):
+		pass # any file we write becomes tracked
+
+	# Streamed from disk in chunks, without holding the file in memory
+	def writeBinaryFile(self, fname, filename, chunk_size = 65536):
+		fname = _bytes(fname)
+		sha1 = hashlib.sha1()
+		with open(filename, 'rb') as fp:
+			for chunk in iter(lambda: fp.read(chunk_size), ''):
+				sha1.update(chunk)
+		digest = sha1.digest()
+		if self.binaries.get(fname) == digest:
+			return # unchanged
+		mark = self.blobs.get(digest)
+		if mark is None:
+			mark = self.next_mark
+			self.next_mark += 1
+			self.stream.write('blob\nmark :%d\n' % mark)
+			self.stream.write('data %d\n' % os.path.getsize(filename))
+			with open(filename, 'rb') as fp:
+				for chunk in iter(lambda: fp.read(chunk_size), ''):
+					self.stream.write(chunk)
+			self.stream.write('\n')
+			self.blobs[digest] = mark
+		self.binaries[fname] = digest
+		self.files.pop(fname, None)
+		self.changes.append('M 100644 :%d %s\n' % (mark, self._quote(fname)))
+
+	def removeFile(self, fname):
+		fname = _bytes(fname)
+		if (fname not in self.binaries) and (self._currentData(fname) is None):
+			return
+		self.binaries.pop(fname, None)
+		self.files[fname] = None
+		self.changes.append('D %s\n' % self._quote(fname))
+
+	def renameFile(self, oldfname, newfname):
+		oldfname, newfname = _bytes(oldfname), _bytes(newfname)
+		if oldfname in self.binaries:
+			self.binaries[newfname] = self.binaries.pop(oldfname)
+			self.files.pop(newfname, None)
+		else:
+			self.files[newfname] = self._currentData(oldfname)
+		self.files[oldfname] = None
+		self.changes.append('R %s %s\n' % (self._quote(oldfname), self._quote(newfname)))
+
+	def listFiles(self, prefix):
+		prefix = _bytes(prefix)
+		fnames = set(self.binaries.keys()) | set(self.files.keys())
+		if self.output is None:
+			# As of the last checkpoint; what changed since is in files and binaries
+			with open(os.devnull, 'w') as devnull:
+				try:
+					listed = subprocess.check_output(['git', 'ls-tree', '-r', '-z', '--name-only', self.branch, '--', prefix],
+						cwd=self.path, stderr=devnull)
+					fnames.update(fname for fname in listed.split('\0') if fname)
+				except subprocess.CalledProcessError:
+					pass # no commits yet
+		return sorted(fname for fname in fnames if fname.startswith(prefix)
+			and ((fname in self.binaries) or (self.files.get(fname, '') is not None)))
+
+	def setRevision(self, record):
+		pass # the commit says it all
+
+	def commit(self, message, user, date):
+		if not self.changes:
+			return self.uncommitted == 0 # nothing changed, no commit
+		if date:
+			self.last_date = int(date.split(' ')[0])
+		else:
+			self.last_date = int(time.time())
+		if isinstance(user, unicode):
+			user = user.encode('utf-8')
+		if isinstance(message, unicode):
+			message = message.encode('utf-8')
+		user = (user or 'unknown').replace('<', '').replace('>', '')
+
+		self.stream.write('commit %s\n' % self.branch)
+		self.stream.write('committer %s <> %d +0000\n' % (user, self.last_date))
+		self._data(message)
+		if self.continued:
+			self.stream.write('from %s^0\n' % self.branch)
+			self.continued = False
+		for change in self.changes:
+			self.stream.write(change)
+		self.stream.write('\n')
+		self.changes = []
+
+		self.uncommitted += 1
+		if self.uncommitted >= self.batch:
+			self._checkpoint()
+			return True
+		return False
+
+	def _checkpoint(self):
+		if self.output is None:
+			self.stream.write('checkpoint\n\n')
+		self.stream.flush()
+		self.uncommitted = 0
+
+	def close(self):
+		self._checkpoint()
+		if self.proc is not None:
+			self.stream.write('done\n')
+			self.stream.close()
+			if self.proc.wait() != 0:
+				raise Exception("git fast-import failed with code "+str(self.proc.returncode))
+			self.proc = None
+			self._git('reset', '-q', '--hard') # bring the working copy up to date
+		elif self.stream is not sys.__stdout__:
+			self.stream.close()
+
+	def lastDate(self):
+		if (self.last_date is None) and (self.output is None) and self.exists():
+			try:
+				return int(self._git('log', '-1', '--format=%ct', self.branch).strip())
+			except subprocess.CalledProcessError:
+				return None # no commits yet
+		return self.last_date
+
+
+#
+# Writes revision records to an archive (see archive.py) instead of a repository: no version control at all.
+# Every revision becomes a record, even ones which wouldn't change any files.
+# The page files are only kept so they can be read back; they're stored in the archive's index
+# along with each block of records, so a continued dump finds them as they were.
+#
+class ArchiveBackend:
+	def __init__(self, path, batch = 100):
+		self.path = path			# Archive file
+		self.writer = ArchiveWriter(path, batch)
+		self.pending = {}			# fname -> utf-8 data, or None if removed, since the last stored block
+		self.record = None			# Record for the next commit
+
+	def exists(self):
+		return self.writer.exists()
+
+	def open(self, create):
+		self.writer.open(create)
+
+	def _currentData(self, fname):
+		fname = _bytes(fname)
+		if fname in self.pending:
+			return self.pending[fname]
+		return self.writer.treeFile(fname)
+
+	def readFile(self, fname):
+		data = self._currentData(fname)
+		if data is None:
+			raise IOError("No such file in archive: "+fname)
+		return data.decode('utf-8')
+
+	def writeFile(self, fname, content):
+		self.pending[_bytes(fname)] = content.encode('utf-8')
+
+	def addFile(self, fname):
+		pass # any file we write becomes tracked
+
+	def writeBinaryFile(self, fname, filename):
+		raise Exception("Archives don't keep attached files")
+
+	def removeFile(self, fname):
+		if self._currentData(fname) is not None:
+			self.pending[_bytes(fname)] = None
+
+	def renameFile(self, oldfname, newfname):
+		self.pending[_bytes(newfname)] = self._currentData(oldfname)
+		self.pending[_bytes(oldfname)] = None
+
+	def listFiles(self, prefix):
+		prefix = _bytes(prefix)
+		fnames = set(self.writer.treeFiles(prefix))
+		for fname, data in self.pending.items():
+			if fname.startswith(prefix):
+				if data is None:
+					fnames.discard(fname)
+				else:
+					fnames.add(fname)
+		return sorted(fnames)
+
+	def setRevision(self, record):
+		self.record = record
+
+	def commit(self, message, user, date):
+		if self.record is None:
+			return False
+		stored = self.writer.append(self.record, self.pending)
+		self.record = None
+		if stored:
+			self.pending = {}
+		return stored
+
+	def close(self):
+		self.writer.close(self.pending)
+		self.pending = {}
+
+	def lastDate(self):
+		return self.writer.lastDate()
+
+
+def makeBackend(engine, path, batch = 100, output = None):
+	if engine == 'commands':
+		return HgCommandBackend(path)
+	if engine == 'memory':
+		return HgMemoryBackend(path, batch)
+	if engine == 'git':
+		return GitFastImportBackend(path, output, batch)
+	if engine == 'archive':
+		return ArchiveBackend(output or path+'\\archive.jsonl.gz', batch)
+	raise Exception("Unknown commit engine: "+engine)
@@ -0,0 +1,199 @@
+import argparse
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import resource
+import subprocess
+import traceback
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import wdparse
+from wikidot import Wikidot
+from rmaint import RepoMaintainer
+
+# End-to-end crawl benchmark against a local stand-in site (see server.py). No real site is touched.
+# For each site size, starts a server, dumps the whole site with Wikidot + RepoMaintainer
+# in a forked child and reports:
+#   requests/s (as counted by the server), commits/s, time spent in the response parsers,
+#   and peak RSS of the crawling process.
+#
+#   python bench/crawl_bench.py --sizes 1000,10000,100000 --json results.jsonl
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+
+def start_server(args, revisions):
+	cmd = [sys.executable, SERVER, '--revisions', str(revisions), '--latency', str(args.latency),
+		'--jitter', str(args.jitter), '--errors', str(args.errors), '--error-status', str(args.error_status)]
+	if args.fixtures:
+		cmd += ['--fixtures', args.fixtures]
+	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+	line = proc.stdout.readline().strip() # "Serving on URL" once the site is generated
+	if not line.startswith('Serving on '):
+		proc.kill()
+		raise Exception('Stand-in server failed to start')
+	return proc, line[len('Serving on '):]
+
+def server_stats(url):
+	return requests.get(url+'/__stats', timeout=10).json()
+
+
+# Wraps the wdparse functions to add up time spent parsing
+def time_parsers(totals):
+	def timed(parse):
+		def wrapper(html):
+			started = time.time()
+			try:
+				return parse(html)
+			finally:
+				totals[0] += time.time() - started
+		return wrapper
+	for name in ('parse_revisions', 'parse_revision_source', 'parse_revision_unixname'):
+		setattr(wdparse, name, timed(getattr(wdparse, name)))
+
+#
+# Dumps the site into workdir. Runs in the forked child.
+#
+def crawl(args, url, workdir):
+	os.chdir(workdir) # RepoMaintainer keeps its state files next to the repository
+	parse_time = [0.0]
+	time_parsers(parse_time)
+
+	wd = Wikidot(url)
+	wd.delay = args.delay
+	wd.burst = args.burst
+
+	rm = RepoMaintainer(wd, 'repo')
+	rm.engine = args.engine
+	rm.lookahead = args.lookahead
+	rm.fetchWorkers = args.workers
+	rm.commitBatch = args.commit_batch
+	os.mkdir('repo')
+
+	started = time.time()
+	rm.buildRevisionList(None, 10000, None)
+	listed = time.time()
+	rm.openRepo()
+	commits = 0
+	while rm.commitNext():
+		commits += 1
+	rm.cleanup()
+	finished = time.time()
+
+	return {
+		'revisions': len(rm.wrevs),
+		'commits': commits,
+		'list_sec': listed - started,
+		'commit_sec': finished - listed,
+		'total_sec': finished - started,
+		'parse_sec': parse_time[0],
+		'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		'skipped_requests': rm.skipped_requests,
+	}
+
+# Runs crawl() in a forked child, so each run's peak memory is its own
+def run_crawl(args, url, workdir):
+	rfd, wfd = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(rfd)
+		devnull = os.open(os.devnull, os.O_WRONLY)
+		os.dup2(devnull, 1) # RepoMaintainer is talkative
+		try:
+			result = crawl(args, url, workdir)
+		except Exception:
+			result = {'error': traceback.format_exc()}
+		sys.stdout.flush()
+		os.write(wfd, json.dumps(result))
+		os._exit(0)
+	os.close(wfd)
+	chunks = []
+	while True:
+		data = os.read(rfd, 65536)
+		if not data: break
+		chunks.append(data)
+	os.close(rfd)
+	os.waitpid(pid, 0)
+	return json.loads(''.join(chunks))
+
+
+def bench(args, size):
+	proc, url = start_server(args, size)
+	workdir = tempfile.mkdtemp(prefix='wdbench-')
+	try:
+		result = run_crawl(args, url, workdir)
+		stats = server_stats(url)
+	finally:
+		proc.terminate()
+		proc.wait()
+		if args.keep:
+			print "Kept "+workdir
+		else:
+			shutil.rmtree(workdir, True)
+	result.update({
+		'site_revisions': size,
+		'engine': args.engine,
+		'lookahead': args.lookahead,
+		'workers': args.workers,
+		'latency_ms': args.latency,
+		'error_rate': args.errors,
+		'requests': stats['requests'],
+		'injected_errors': stats['errors'],
+		'requests_by_module': stats['by_module'],
+	})
+	if 'error' not in result:
+		total = result['total_sec']
+		result['requests_per_sec'] = stats['requests'] / total if total else 0.0
+		result['commits_per_sec'] = result['commits'] / result['commit_sec'] if result['commit_sec'] else 0.0
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmarks a full site dump against a local stand-in server')
+	parser.add_argument('--sizes', type=str, default='1000,10000,100000', help='Comma-separated site sizes, in revisions')
+	parser.add_argument('--fixtures', type=str, help='Serve recorded responses from this directory (see server.py); sizes are ignored')
+	parser.add_argument('--engine', type=str, default='memory', choices=['commands', 'memory', 'git'], help='Commit backend')
+	parser.add_argument('--commit-batch', type=int, default='100', help='Commits per transaction')
+	parser.add_argument('--lookahead', type=int, default='0', help='Prefetch this many revisions ahead')
+	parser.add_argument('--workers', type=int, default='2', help='Prefetching threads')
+	parser.add_argument('--delay', type=int, default='0', help='Client delay between requests, msec (0 = unlimited)')
+	parser.add_argument('--burst', type=int, default='1', help='Client request burst')
+	parser.add_argument('--latency', type=float, default='0', help='Server latency, msec')
+	parser.add_argument('--jitter', type=float, default='0', help='Server latency jitter, msec')
+	parser.add_argument('--errors', type=float, default='0', help='Fraction of requests the server fails')
+	parser.add_argument('--error-status', type=int, default='500', help='HTTP status of failed requests')
+	parser.add_argument('--keep', action='store_true', help='Keep the dumped repositories')
+	parser.add_argument('--json', type=str, help='Also write results as JSON lines to this file')
+	args = parser.parse_args()
+
+	sizes = [0] if args.fixtures else [int(size) for size in args.sizes.split(',')]
+	results = []
+	failed = False
+	print "%10s %10s %10s %10s %10s %10s %10s %10s" % ('revisions', 'requests', 'req/s', 'commits', 'commit/s', 'parse s', 'total s', 'peak KB')
+	for size in sizes:
+		result = bench(args, size)
+		results.append(result)
+		if 'error' in result:
+			failed = True
+			print "%10d  FAILED" % size
+			print result['error']
+			continue
+		if result['commits'] != result['revisions']:
+			failed = True
+		print "%10d %10d %10.1f %10d %10.1f %10.2f %10.2f %10d" % (result['revisions'], result['requests'], result['requests_per_sec'],
+			result['commits'], result['commits_per_sec'], result['parse_sec'], result['total_sec'], result['peak_rss_kb'])
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			for result in results:
+				f.write(json.dumps(result, sort_keys=True)+'\n')
+
+	if failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
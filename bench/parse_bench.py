@@ -0,0 +1,210 @@
+import argparse
+import os
+import sys
+import time
+import glob
+import json
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bs4 import BeautifulSoup
+import wdparse
+
+# Benchmarks the streaming parsers in wdparse against the BeautifulSoup html.parser code they replace.
+# Checks that both give identical results, and reports parse time and peak memory per response.
+#
+# Fixtures are recorded responses: files named *.revisions.html, *.source.html, *.version.html
+# (bodies of PageRevisionListModule, PageSourceModule and PageVersionModule responses).
+# Without --fixtures, synthetic responses of Wikidot's shape are generated.
+
+
+#
+# Reference implementations: what wikidot.py did before wdparse (plus revision flags)
+#
+def soup_revisions(html):
+	soup = BeautifulSoup(html, 'html.parser')
+	revs = []
+	for tr in soup.table.contents:
+		if tr.name != 'tr': continue
+		rev_id = tr.input['value'] if tr.input else None
+		if rev_id is None: continue
+		rev_date = 0
+		date_span = tr.find("span", attrs={"class": "odate"})
+		if date_span is not None:
+			for cls in date_span['class']:
+				if cls.startswith('time_'):
+					rev_date = int(cls[5:])
+		user_span = tr.find("span", attrs={"class": "printuser"})
+		last_a = None
+		for last_a in user_span.find_all('a'): pass
+		rev_user = last_a.getText() if last_a else None
+		last_td = None
+		for last_td in tr.find_all('td'): pass
+		rev_comment = last_td.getText() if last_td else ""
+		rev_flags = u''.join(span.getText().strip() for span in tr.find_all("span", attrs={"class": "spantip"}))
+		revs.append({
+			'id': rev_id,
+			'date': rev_date,
+			'user': rev_user,
+			'comment': rev_comment,
+			'flags': rev_flags,
+		})
+	return revs
+
+def soup_source(html):
+	soup = BeautifulSoup(html, 'html.parser')
+	return soup.div.getText().lstrip(' \r\n')
+
+def soup_unixname(html):
+	soup = BeautifulSoup(html, 'html.parser')
+	unixname = None
+	details = soup.find("div", attrs={"id": "page-version-info"}).extract()
+	for tr in details.find_all('tr'):
+		tds = tr.find_all('td')
+		if len(tds) < 2: continue
+		if tds[0].getText().strip() == 'Page name:':
+			unixname = tds[1].getText().strip()
+	return unixname
+
+PARSERS = {
+	'revisions': (soup_revisions, wdparse.parse_revisions),
+	'source': (soup_source, wdparse.parse_revision_source),
+	'version': (soup_unixname, wdparse.parse_revision_unixname),
+}
+
+
+#
+# Synthetic responses
+#
+def make_revisions(rows):
+	out = [u'<table class="page-history"><tr><td>rev.</td><td>&nbsp;&nbsp;&nbsp;</td><td>flags</td>'
+		u'<td>actions</td><td>by</td><td>date</td><td>comments</td></tr>\n']
+	for i in range(rows):
+		rev_id = 1000000 + rows - i
+		out.append(u'<tr id="revision-row-%d"><td>%d.</td>'
+			u'<td><input type="radio" name="from" value="%d"/><input type="radio" name="to" value="%d"/></td>'
+			u'<td><span class="spantip" title="content changed">S</span></td>'
+			u'<td style="width: 5em"><a href="javascript:;" onclick="WIKIDOT.modules.PageHistoryModule.listeners.showVersion(event,%d)">V</a></td>'
+			u'<td style="width: 15em"><span class="printuser avatarhover"><a href="http://www.wikidot.com/user:info/user-%d">'
+			u'<img class="small" src="http://www.wikidot.com/avatar.php?userid=%d" alt="user %d"/></a>'
+			u'<a href="http://www.wikidot.com/user:info/user-%d">User &amp; %d</a></span></td>'
+			u'<td style="padding: 0 0.5em; width: 7em;"><span class="odate time_%d format_%%25e%%20%%25b%%20%%25Y">date</span></td>'
+			u'<td style="font-size: 90%%">Edit &quot;%d&quot; &lt;with&gt; &#233;ntities &#x151;</td></tr>\n'
+			% (rev_id, rows - i, rev_id, rev_id, rev_id, i % 50, i % 50, i % 50, i % 50, i % 50, 1200000000 + (rows - i) * 60, i))
+	out.append(u'</table>')
+	return u''.join(out)
+
+def make_source(lines):
+	out = [u'<div class="page-source">\n']
+	for i in range(lines):
+		out.append(u'+ Line %d with **markup** &amp; [[[links]]] &lt;tags&gt;<br />\n' % i)
+	out.append(u'</div>')
+	return u''.join(out)
+
+def make_version(paragraphs):
+	out = [u'<div id="page-version-info" style="display: none"><table>'
+		u'<tr><td>Page name:</td><td>some-page-name</td></tr>'
+		u'<tr><td>Revision no.:</td><td>5</td></tr>'
+		u'<tr><td>Date created:</td><td><span class="odate time_1200000000">date</span></td></tr>'
+		u'</table></div><div id="page-content">']
+	for i in range(paragraphs):
+		out.append(u'<p>Paragraph %d of <strong>rendered</strong> <a href="/page-%d">content</a>.</p>\n' % (i, i))
+	out.append(u'</div>')
+	return u''.join(out)
+
+def synthetic(scale):
+	return [
+		('revisions-100', 'revisions', make_revisions(100)),
+		('revisions-%d' % scale, 'revisions', make_revisions(scale)),
+		('source-small', 'source', make_source(50)),
+		('source-large', 'source', make_source(scale)),
+		('version-small', 'version', make_version(50)),
+		('version-large', 'version', make_version(scale)),
+	]
+
+def recorded(path):
+	fixtures = []
+	for kind in PARSERS:
+		for fname in sorted(glob.glob(os.path.join(path, '*.'+kind+'.html'))):
+			with open(fname, 'rb') as f:
+				fixtures.append((os.path.basename(fname), kind, f.read().decode('utf-8')))
+	return fixtures
+
+
+#
+# Measurements
+#
+def time_parse(parse, html, repeat):
+	best = None
+	for i in range(repeat):
+		started = time.time()
+		parse(html)
+		elapsed = time.time() - started
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+# Peak memory increase while parsing, in KB. Measured in a forked child so runs don't affect each other.
+def peak_memory(parse, html):
+	rfd, wfd = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(rfd)
+		before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		parse(html)
+		after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		os.write(wfd, str(after - before))
+		os._exit(0)
+	os.close(wfd)
+	data = os.read(rfd, 100)
+	os.close(rfd)
+	os.waitpid(pid, 0)
+	return int(data)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmarks Wikidot response parsers')
+	parser.add_argument('--fixtures', type=str, help='Directory with recorded responses')
+	parser.add_argument('--scale', type=int, default='10000', help='Size of large synthetic responses (rows/lines)')
+	parser.add_argument('--repeat', type=int, default='3', help='Take best of this many runs')
+	parser.add_argument('--json', type=str, help='Also write results as JSON lines to this file')
+	args = parser.parse_args()
+
+	fixtures = recorded(args.fixtures) if args.fixtures else synthetic(args.scale)
+	# Memory first, while this process hasn't parsed anything and its heap is small
+	memory = {}
+	for name, kind, html in fixtures:
+		soup_parse, stream_parse = PARSERS[kind]
+		memory[name] = (peak_memory(soup_parse, html), peak_memory(stream_parse, html))
+
+	results = []
+	print "%-24s %10s %12s %12s %8s %10s %10s  %s" % ('fixture', 'size', 'soup ms', 'stream ms', 'speedup', 'soup KB', 'stream KB', 'same')
+	for name, kind, html in fixtures:
+		soup_parse, stream_parse = PARSERS[kind]
+		same = (soup_parse(html) == stream_parse(html))
+		soup_time = time_parse(soup_parse, html, args.repeat)
+		stream_time = time_parse(stream_parse, html, args.repeat)
+		result = {
+			'fixture': name,
+			'kind': kind,
+			'bytes': len(html.encode('utf-8')),
+			'soup_ms': soup_time * 1000,
+			'stream_ms': stream_time * 1000,
+			'soup_peak_kb': memory[name][0],
+			'stream_peak_kb': memory[name][1],
+			'identical': same,
+		}
+		results.append(result)
+		print "%-24s %10d %12.2f %12.2f %7.1fx %10d %10d  %s" % (name, result['bytes'], result['soup_ms'], result['stream_ms'],
+			soup_time / stream_time if stream_time else 0, result['soup_peak_kb'], result['stream_peak_kb'], 'yes' if same else 'NO')
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			for result in results:
+				f.write(json.dumps(result)+'\n')
+
+	if not all(result['identical'] for result in results):
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,390 @@
+import argparse
+import os
+import sys
+import time
+import json
+import random
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from cgi import escape
+
+# Local stand-in for a Wikidot site, for benchmarking without touching a real one.
+# Serves the AJAX modules wikidot.py uses through /ajax-module-connector.php:
+#   list/ListPagesModule, history/PageRevisionListModule, history/PageSourceModule, history/PageVersionModule,
+#   files/PageFilesModule
+# and page GETs (for get_page_id) and file GETs (/local--files/<page>/<file>). Responses come from a synthetic site or a directory of recorded ones.
+# Latency and errors can be injected. GET /__stats returns request counts as JSON.
+#
+# Standalone:
+#   python bench/server.py --revisions 10000 --port 8080
+#   crawl.py http://127.0.0.1:8080 --dump Repo --delay 0
+# Prints "Serving on http://127.0.0.1:PORT" as the first line once it's ready.
+#
+# Recorded site directory:
+#   pages.txt						one page per line: unix_name page_id [created [edited [revisions]]], newest first
+#   <page_id>.revisions.html		PageRevisionListModule bodies
+#   <rev_id>.source.html			PageSourceModule bodies
+#   <rev_id>.version.html			PageVersionModule bodies (+ optional <rev_id>.version.title)
+#   <page_id>.files.html			PageFilesModule bodies
+#   files/<unix_name>/<file>		attached files
+# ListPagesModule bodies depend on the module_body asked for, so they are rendered from pages.txt.
+
+
+#
+# Synthetic site: pages with a made-up but realistic history.
+# Revisions are kept as tuples and rendered on request, so 100k revision sites are cheap to serve.
+#
+class SyntheticSite:
+	def __init__(self, revisions, pages = None, source_lines = 20, seed = 0):
+		self.source_lines = source_lines
+		npages = pages or max(1, revisions // 10)
+		npages = min(npages, revisions)
+		rnd = random.Random(seed)
+
+		self.page_ids = [100000 + i for i in range(npages)]
+		names = ['page-%d' % i for i in range(npages)]
+		titles = ['Page %d' % i for i in range(npages)]
+		parents = [None] * npages
+		versions = [0] * npages
+		renamed = [False] * npages
+		created = [0] * npages
+		edited = [0] * npages
+		files = [{} for p in range(npages)]	# file name -> contents no.
+		self.revs = {}			# page_id -> list of revision tuples, oldest first
+		self.by_rev_id = {}		# rev_id -> revision tuple
+		date = 1200000000
+		for k in range(revisions):
+			date += rnd.randint(1, 600)
+			if k < npages:
+				p = k
+				flags = 'N'
+				comment = u''
+				created[p] = date
+			else:
+				p = rnd.randrange(npages)
+				roll = rnd.random()
+				if (roll < 0.03) and not renamed[p]:
+					flags = 'R'
+					old = names[p]
+					names[p] = old+'-renamed'
+					renamed[p] = True
+					comment = u'Page name changed: "%s" to "%s".' % (old, names[p])
+				elif (roll < 0.06) and (npages > 1):
+					flags = 'M'
+					parent = rnd.randrange(npages)
+					if parent == p: parent = (p + 1) % npages
+					parents[p] = names[parent]
+					comment = u'Parent page set to: "%s".' % names[parent]
+				elif roll < 0.10:
+					flags = 'T'
+					titles[p] = 'Page %d (v%d)' % (p, k)
+					comment = u'Title changed'
+				elif roll < 0.13:
+					flags = 'F'
+					fname = 'file-%d.bin' % rnd.randrange(5)
+					if (fname in files[p]) and (rnd.random() < 0.2):
+						del files[p][fname]
+						comment = u'Deleted file "%s".' % fname
+					else:
+						files[p][fname] = rnd.randrange(20) # the same contents turn up on several pages
+						comment = u'Uploaded file "%s".' % fname
+				else:
+					flags = 'S'
+					versions[p] += 1
+					comment = u'Edit %d' % k if rnd.random() < 0.7 else u''
+			if flags == 'N':
+				versions[p] = 1
+			edited[p] = date
+			rev_id = 2000000 + k
+			rev = (rev_id, self.page_ids[p], date, u'user-%d' % rnd.randrange(50), comment, flags,
+				names[p], titles[p], p, versions[p])
+			self.revs.setdefault(self.page_ids[p], []).append(rev)
+			self.by_rev_id[rev_id] = rev
+
+		self.table = [(names[p], self.page_ids[p], created[p], edited[p], len(self.revs[self.page_ids[p]])) for p in range(npages)]
+		self.files = dict((self.page_ids[p], files[p]) for p in range(npages) if files[p])
+		self.names = dict((self.page_ids[p], names[p]) for p in range(npages))
+		self.table.sort(key=lambda page: page[2], reverse=True)
+		self.revision_count = revisions
+
+	def pages(self):
+		return self.table
+
+	def revisions_html(self, page_id):
+		revs = self.revs.get(page_id)
+		if revs is None: return None
+		out = [u'<table class="page-history"><tr><td>rev.</td><td>&nbsp;&nbsp;&nbsp;</td><td>flags</td>'
+			u'<td>actions</td><td>by</td><td>date</td><td>comments</td></tr>\n']
+		for no in range(len(revs) - 1, -1, -1):
+			rev_id, page_id, date, user, comment, flags = revs[no][:6]
+			out.append(u'<tr id="revision-row-%d"><td>%d.</td>'
+				u'<td><input type="radio" name="from" value="%d"/><input type="radio" name="to" value="%d"/></td>'
+				u'<td><span class="spantip" title="change">%s</span></td>'
+				u'<td><a href="javascript:;" onclick="WIKIDOT.modules.PageHistoryModule.listeners.showVersion(event,%d)">V</a></td>'
+				u'<td><span class="printuser avatarhover"><a href="http://www.wikidot.com/user:info/%s">'
+				u'<img class="small" src="http://www.wikidot.com/avatar.php?userid=1" alt="%s"/></a>'
+				u'<a href="http://www.wikidot.com/user:info/%s">%s</a></span></td>'
+				u'<td><span class="odate time_%d format_%%25e%%20%%25b%%20%%25Y">date</span></td>'
+				u'<td style="font-size: 90%%">%s</td></tr>\n'
+				% (rev_id, no, rev_id, rev_id, flags, rev_id, user, user, user, user, date, escape(comment, True)))
+		out.append(u'</table>')
+		return u''.join(out)
+
+	def source_html(self, rev_id):
+		rev = self.by_rev_id.get(rev_id)
+		if rev is None: return None
+		p, version = rev[8], rev[9]
+		out = [u'<div class="page-source">\n']
+		for i in range(self.source_lines):
+			out.append(u'+ Page %d, version %d, line %d with **markup** &amp; [[[links]]]<br />\n' % (p, version, i))
+		out.append(u'</div>')
+		return u''.join(out)
+
+	def version(self, rev_id):
+		rev = self.by_rev_id.get(rev_id)
+		if rev is None: return None
+		html = (u'<div id="page-version-info" style="display: none"><table>'
+			u'<tr><td>Page name:</td><td>%s</td></tr>'
+			u'<tr><td>Date created:</td><td><span class="odate time_%d">date</span></td></tr>'
+			u'</table></div><div id="page-content"><p>Page %d version %d</p></div>') % (rev[6], rev[2], rev[8], rev[9])
+		return (html, rev[7])
+
+	def files_html(self, page_id):
+		if page_id not in self.names: return None
+		out = [u'<table class="page-files"><tr><th>file name</th><th>type</th><th>size</th><th>&nbsp;</th></tr>\n']
+		for fname, no in sorted(self.files.get(page_id, {}).items()):
+			out.append(u'<tr id="file-row-%d"><td><a href="/local--files/%s/%s">%s</a></td><td>application/octet-stream</td>'
+				u'<td><span title="%d bytes">%d kB</span></td><td><a href="javascript:;">+ info</a></td></tr>\n'
+				% (no, self.names[page_id], fname, fname, len(self.file_data_no(no)), len(self.file_data_no(no)) // 1024))
+		out.append(u'</table>')
+		return u''.join(out)
+
+	def file_data_no(self, no):
+		return ''.join('Synthetic file %d, line %d\n' % (no, i) for i in range(2000))
+
+	def file_data(self, unix_name, fname):
+		for page_id, name in self.names.items():
+			if (name == unix_name) and (fname in self.files.get(page_id, {})):
+				return self.file_data_no(self.files[page_id][fname])
+		return None
+
+
+#
+# Recorded site: serves response bodies from files, see the layout above.
+#
+class RecordedSite:
+	def __init__(self, path):
+		self.path = path
+		self.table = []
+		with open(os.path.join(path, 'pages.txt'), 'rb') as f:
+			for line in f:
+				parts = line.decode('utf-8').split()
+				if not parts: continue
+				created = int(parts[2]) if len(parts) > 2 else 0
+				edited = int(parts[3]) if len(parts) > 3 else created
+				revisions = int(parts[4]) if len(parts) > 4 else 1
+				self.table.append((parts[0], int(parts[1]), created, edited, revisions))
+		self.revision_count = None
+
+	def _read(self, name):
+		fname = os.path.join(self.path, name)
+		if not os.path.isfile(fname):
+			return None
+		with open(fname, 'rb') as f:
+			return f.read().decode('utf-8')
+
+	def pages(self):
+		return self.table
+
+	def revisions_html(self, page_id):
+		return self._read('%d.revisions.html' % page_id)
+
+	def source_html(self, rev_id):
+		return self._read('%d.source.html' % rev_id)
+
+	def version(self, rev_id):
+		html = self._read('%d.version.html' % rev_id)
+		if html is None: return None
+		title = self._read('%d.version.title' % rev_id)
+		return (html, title.strip() if title else u'')
+
+	def files_html(self, page_id):
+		return self._read('%d.files.html' % page_id)
+
+	def file_data(self, unix_name, fname):
+		fname = os.path.join(self.path, 'files', unix_name, fname)
+		if ('..' in fname) or not os.path.isfile(fname):
+			return None
+		with open(fname, 'rb') as f:
+			return f.read()
+
+
+#
+# ListPagesModule rendering for the module_body formats wikidot.py uses
+#
+def render_list_pages(site, params):
+	pages = site.pages()
+	if params.get('order') == 'dateEditedDesc':
+		pages = sorted(pages, key=lambda page: page[3], reverse=True)
+	elif params.get('order') == 'dateCreatedAsc':
+		pages = pages[::-1]
+	offset = int(params.get('offset') or 0)
+	limit = params.get('perPage') or params.get('limit')
+	pages = pages[offset:offset+int(limit)] if limit else pages[offset:]
+	template = params.get('module_body', '%%page_unix_name%%')
+	entries = []
+	for name, page_id, created, edited, revisions in pages:
+		entry = template.replace('%%page_unix_name%%', name).replace('%%page_id%%', str(page_id))
+		entry = entry.replace('%%revisions%%', str(revisions))
+		entry = entry.replace('%%updated_at%%', u'<span class="odate time_%d format_%%25e">date</span>' % edited)
+		entry = entry.replace('%%created_at%%', u'<span class="odate time_%d format_%%25e">date</span>' % created)
+		entries.append(entry)
+	return u'<div class="list-pages-box"><p>'+u'<br/>'.join(entries)+u'</p></div>'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1' # keep-alive, like the real thing
+	wbufsize = -1					# send each response in one piece...
+	disable_nagle_algorithm = True	# ...right away
+
+	def log_message(self, format, *args):
+		pass
+
+	def send(self, code, body, content_type = 'text/html; charset=utf-8'):
+		if isinstance(body, unicode):
+			body = body.encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def send_json(self, data):
+		self.send(200, json.dumps(data), 'application/json')
+
+	# Sleeps for the configured latency; returns True if this request should fail
+	def inject(self):
+		server = self.server
+		if server.latency or server.jitter:
+			time.sleep((server.latency + random.uniform(0, server.jitter)) / 1000.0)
+		if server.error_rate and (random.random() < server.error_rate):
+			server.count('errors')
+			self.send(server.error_status, 'Injected error')
+			return True
+		return False
+
+	def do_GET(self):
+		server = self.server
+		path = urlparse.urlparse(self.path).path.lstrip('/')
+		if path == '__stats':
+			self.send_json(server.stats())
+			return
+		server.count('GET')
+		if self.inject(): return
+		if path.startswith('local--files/'):
+			parts = urlparse.unquote(path).split('/')
+			data = server.site.file_data(parts[1], '/'.join(parts[2:])) if len(parts) > 2 else None
+			if data is None:
+				self.send(404, 'No such file')
+			else:
+				self.send(200, data, 'application/octet-stream')
+			return
+		for name, page_id, created, edited, revisions in server.site.pages():
+			if name == path:
+				self.send(200, '<html><head><script type="text/javascript">\n'
+					'WIKIREQUEST.info.pageId = %d;\n</script></head><body></body></html>' % page_id)
+				return
+		self.send(404, 'No such page')
+
+	def do_POST(self):
+		server = self.server
+		length = int(self.headers.getheader('Content-Length') or 0)
+		params = dict((k, v[0].decode('utf-8')) for k, v in urlparse.parse_qs(self.rfile.read(length)).items())
+		if urlparse.urlparse(self.path).path != '/ajax-module-connector.php':
+			self.send(404, 'Not found')
+			return
+		module = params.get('moduleName')
+		server.count(module)
+		if self.inject(): return
+		site = server.site
+		title = None
+		if module == 'list/ListPagesModule':
+			body = render_list_pages(site, params)
+		elif module == 'history/PageRevisionListModule':
+			body = site.revisions_html(int(params.get('page_id') or 0))
+		elif module == 'history/PageSourceModule':
+			body = site.source_html(int(params.get('revision_id') or 0))
+		elif module == 'history/PageVersionModule':
+			res = site.version(int(params.get('revision_id') or 0))
+			body, title = res if res else (None, None)
+		elif module == 'files/PageFilesModule':
+			body = site.files_html(int(params.get('page_id') or 0))
+		else:
+			body = None
+		if body is None:
+			self.send_json({'status': 'not_ok', 'message': 'No such object or module: '+str(module)})
+			return
+		data = {'status': 'ok', 'body': body}
+		if title is not None:
+			data['title'] = title
+		self.send_json(data)
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, site, port = 0, latency = 0, jitter = 0, error_rate = 0.0, error_status = 500):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+		self.site = site
+		self.latency = latency			# Added to every response, msec
+		self.jitter = jitter			# Plus a random 0..jitter msec
+		self.error_rate = error_rate	# Fraction of requests answered with error_status
+		self.error_status = error_status
+		self.counts = {}
+		self.counts_lock = threading.Lock()
+
+	def url(self):
+		return 'http://127.0.0.1:%d' % self.server_address[1]
+
+	def count(self, key):
+		with self.counts_lock:
+			self.counts[key] = self.counts.get(key, 0) + 1
+
+	def stats(self):
+		with self.counts_lock:
+			counts = dict(self.counts)
+		errors = counts.pop('errors', 0)
+		return {'requests': sum(counts.values()), 'errors': errors, 'by_module': counts}
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Serves a stand-in Wikidot site on localhost')
+	parser.add_argument('--port', type=int, default='0', help='Port to listen on (default: any free port)')
+	parser.add_argument('--revisions', type=int, default='1000', help='Revisions in the synthetic site')
+	parser.add_argument('--pages', type=int, help='Pages in the synthetic site (default: revisions/10)')
+	parser.add_argument('--source-lines', type=int, default='20', help='Lines in each synthetic page source')
+	parser.add_argument('--seed', type=int, default='0', help='Random seed for the synthetic site')
+	parser.add_argument('--fixtures', type=str, help='Serve recorded responses from this directory instead')
+	parser.add_argument('--latency', type=float, default='0', help='Response latency, msec')
+	parser.add_argument('--jitter', type=float, default='0', help='Random extra latency up to this much, msec')
+	parser.add_argument('--errors', type=float, default='0', help='Fraction of requests to fail')
+	parser.add_argument('--error-status', type=int, default='500', help='HTTP status of failed requests (e.g. 500, 503, 429)')
+	args = parser.parse_args()
+
+	if args.fixtures:
+		site = RecordedSite(args.fixtures)
+	else:
+		site = SyntheticSite(args.revisions, args.pages, args.source_lines, args.seed)
+	server = StandInServer(site, args.port, args.latency, args.jitter, args.errors, args.error_status)
+	print "Serving on "+server.url()
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,79 @@
+import os
+import hashlib
+import tempfile
+import shutil
+
+# Content-addressed store for downloaded files
+# Files are streamed to disk as they arrive and stored under the SHA-1 of their contents,
+# so identical files (the same image attached to several pages) are kept once.
+
+# Usage:
+#   blobs = BlobStore(path)
+#   sha1, size = blobs.store(lambda fp: wd.download_file(url, fp))
+#   blobs.blobPath(sha1)		# where it is
+
+# Thread-safe: each store() writes its own temporary file.
+
+class _HashingFile:
+	def __init__(self, fp):
+		self.fp = fp
+		self.sha1 = hashlib.sha1()
+		self.size = 0
+
+	def write(self, data):
+		self.fp.write(data)
+		self.sha1.update(data)
+		self.size += len(data)
+
+	# Only rewinding to the start is supported (a download starting over)
+	def seek(self, offset):
+		if offset != 0:
+			raise IOError("Can only seek to the start")
+		self.fp.seek(0)
+		self.sha1 = hashlib.sha1()
+		self.size = 0
+
+	def truncate(self):
+		self.fp.truncate()
+
+	def close(self):
+		self.fp.close()
+
+
+class BlobStore:
+	def __init__(self, path):
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+	def blobPath(self, sha1):
+		return os.path.join(self.path, sha1)
+
+	def has(self, sha1):
+		return os.path.isfile(self.blobPath(sha1))
+
+	# Stores whatever write(fp) writes to fp. Returns (sha1, size).
+	def store(self, write):
+		fd, tmpname = tempfile.mkstemp(suffix='.part', dir=self.path)
+		fp = _HashingFile(os.fdopen(fd, 'wb'))
+		try:
+			write(fp)
+		except:
+			fp.close()
+			os.remove(tmpname) # nothing to keep of a failed download
+			raise
+		fp.close()
+		sha1 = fp.sha1.hexdigest()
+		if self.has(sha1):
+			os.remove(tmpname) # we have it already
+		else:
+			try:
+				os.rename(tmpname, self.blobPath(sha1))
+			except OSError:
+				if not self.has(sha1): raise
+				os.remove(tmpname) # another thread stored it first (Windows won't rename over it)
+		return (sha1, fp.size)
+
+	# Deletes the store with everything in it
+	def remove(self):
+		shutil.rmtree(self.path, True)
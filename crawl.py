@@ -3,13 +3,12 @@ import sys
 import locale
 import codecs
 import os
+import shutil
+import glob
 from wikidot import Wikidot
-from rmaint import RepoMaintainer
+# The rest (Mercurial above all) is only imported by the actions which need it, to keep queries quick to start
 
-# TODO: Files.
 # TODO: Forum and comment pages.
-# TODO: Ability to download new transactions since last dump.
-#   We'll probably check the last revision time, then query all transactions and select those with greater revision time (not equal, since we would have downloaded equals at the previous dump)
 
 rawStdout = sys.stdout
 rawStderr = sys.stderr
@@ -23,23 +22,67 @@ parser.add_argument('--list-pages', action='store_true', help='List all pages on
 parser.add_argument('--source', action='store_true', help='Print page source (requires --page)')
 parser.add_argument('--content', action='store_true', help='Print page content (requires --page)')
 parser.add_argument('--log', action='store_true', help='Print page revision log (requires --page)')
+parser.add_argument('--batch', action='store_true', help='Read query commands ("source PAGE", "log PAGE", "list-pages"...) from stdin and answer each with a line of JSON')
 parser.add_argument('--dump', type=str, help='Download page revisions to this directory')
+parser.add_argument('--export', type=str, help='Download page revisions to this compressed archive instead of a repository (see archive.py); work files go to --dump, or PATH.work until the export is done')
+parser.add_argument('--verify', action='store_true', help='Check the dump at --dump against the site and report what it lacks (exit status 1 if anything); run --dump again to sync')
+parser.add_argument('--shard', type=str, help='With --dump: only fetch the i-th of n shares of the pages (i/n) into a bundle at --dump, for mergeshards.py')
 # Debug actions
 parser.add_argument('--list-pages-raw', action='store_true')
 parser.add_argument('--log-raw', action='store_true')
 # Action settings
 parser.add_argument('--page', type=str, help='Query only this page')
 parser.add_argument('--depth', type=int, default='10000', help='Query only last N revisions')
+parser.add_argument('--category', type=str, help='List/dump only pages in this category')
+parser.add_argument('--created', type=str, help='List/dump only pages created as given, e.g. "> 2015-01-01" or "last 30 day"')
+parser.add_argument('--edited', type=str, help='List/dump only pages last edited as given, same format as --created')
 parser.add_argument('--revids', action='store_true', help='Store last revision ids in the repository')
+parser.add_argument('--lookahead', type=int, default='0', help='Prefetch data for this many upcoming revisions while committing')
+parser.add_argument('--dump-format', type=str, default='hg', choices=['hg', 'git'], help='Dump into a Mercurial repository, or as a git fast-import stream')
+parser.add_argument('--git-output', type=str, help='Write git fast-import stream to this file (- for stdout) instead of a git repository at --dump; new dumps only')
+parser.add_argument('--commit-engine', type=str, default='commands', choices=['commands', 'memory'], help='How to commit: through Mercurial commands, or by building changesets in memory (faster)')
+parser.add_argument('--commit-batch', type=int, default='100', help='Commits per transaction for --commit-engine memory, or records per block for --export')
+parser.add_argument('--fetch-all', action='store_true', help='Fetch source and details for every revision, even if its flags say they did not change')
+parser.add_argument('--fetch-workers', type=int, default='2', help='Number of threads prefetching revision data')
+parser.add_argument('--list-workers', type=int, default='4', help='Number of threads querying pages while building the revision list')
+parser.add_argument('--no-files', action='store_true', help='Do not download files attached to pages')
+parser.add_argument('--file-workers', type=int, default='4', help='Number of threads downloading files')
+parser.add_argument('--progress-interval', type=int, default='10', help='Print progress and ETA every N seconds')
+parser.add_argument('--metrics', type=str, help='Export timing metrics to this file while dumping')
+parser.add_argument('--metrics-format', type=str, default='json', choices=['json', 'prometheus'], help='Append JSON lines, or keep a Prometheus text file up to date')
+parser.add_argument('--profile', type=int, default='0', help='Profile the first N commits and print the results')
+parser.add_argument('--profile-output', type=str, help='Also save the --profile results to this file, for pstats')
 # Common settings
 parser.add_argument('--debug', action='store_true', help='Print debug info')
 parser.add_argument('--delay', type=int, default='200', help='Delay between consequent calls to Wikidot')
+parser.add_argument('--burst', type=int, default='1', help='Allow this many calls to Wikidot in a burst')
+parser.add_argument('--file-delay', type=int, default='100', help='Delay between consequent file downloads')
+parser.add_argument('--pool-size', type=int, default='10', help='Max keep-alive connections to Wikidot')
+parser.add_argument('--list-page-size', type=int, default='250', help='Pages to list per request')
+parser.add_argument('--cache', type=str, help='Keep revision source and version responses in this cache file')
+parser.add_argument('--cache-size', type=int, default='1024', help='Max cache size in MB')
+parser.add_argument('--timeout', type=int, default='60', help='Network timeout in seconds')
 args = parser.parse_args()
 
 
 wd = Wikidot(args.site)
 wd.debug = args.debug
 wd.delay = args.delay
+wd.burst = args.burst
+wd.file_delay = args.file_delay
+wd.pool_size = args.pool_size
+wd.timeout = args.timeout
+wd.list_page_size = args.list_page_size
+if args.cache:
+	from respcache import ResponseCache
+	wd.cache = ResponseCache(args.cache, args.cache_size*1024*1024)
+
+
+# ListPagesModule selectors
+list_filter = {}
+if args.category: list_filter['category'] = args.category
+if args.created: list_filter['created_at'] = args.created
+if args.edited: list_filter['updated_at'] = args.edited
 
 
 def force_dirs(path):
@@ -49,70 +92,234 @@ def force_dirs(path):
         if exception.errno != os.errno.EEXIST:
             raise
 
-if args.list_pages_raw:
-	print wd.list_pages_raw(args.depth)
+# Removes a work directory, along with the files which went beside it where '\\' doesn't separate paths
+def remove_work_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    for fname in glob.glob(path+'\\.w*'):
+        os.remove(fname)
+
 
-elif args.list_pages:
-	for page in wd.list_pages(args.depth):
-		print page
+# Page IDs looked up so far: in --batch, each page is only loaded once
+page_ids = {}
 
-elif args.source:
-	if not args.page:
-		raise "Please specify --page for --source."
+def page_id_of(page):
+	if not page:
+		raise Exception("Please specify --page.")
+	page_id = page_ids.get(page)
+	if page_id is None:
+		page_id = wd.get_page_id(page)
+		if not page_id:
+			raise Exception("Page not found: "+page)
+		page_ids[page] = page_id
+	return page_id
+
+#
+# Query actions, shared by the command line and --batch.
+# Each yields what it prints, one item per line.
+#
+def run_action(action, page = None, depth = args.depth, filters = list_filter):
+	if action == 'list-pages-raw':
+		yield wd.list_pages_raw(depth)
 	
-	page_id = wd.get_page_id(args.page)
-	if not page_id:
-		raise "Page not found: "+args.page
+	elif action == 'list-pages':
+		for name in wd.list_pages(depth, **filters):
+			yield name
 	
-	revs = wd.get_revisions(page_id, 1) # last revision
-	print wd.get_revision_source(revs[0]['id'])
-
-elif args.content:
-	if not args.page:
-		raise "Please specify --page for --source."
+	elif action == 'source':
+		revs = wd.get_revisions(page_id_of(page), 1) # last revision
+		yield wd.get_revision_source(revs[0]['id'])
 	
-	page_id = wd.get_page_id(args.page)
-	if not page_id:
-		raise "Page not found: "+args.page
+	elif action == 'content':
+		revs = wd.get_revisions(page_id_of(page), 1) # last revision
+		yield wd.get_revision_version(revs[0]['id'])
 	
-	revs = wd.get_revisions(page_id, 1) # last revision
-	print wd.get_revision_version(revs[0]['id'])
+	elif action == 'log-raw':
+		yield wd.get_revisions_raw(page_id_of(page), depth)
+	
+	elif action == 'log':
+		for rev in wd.get_revisions(page_id_of(page), depth):
+			yield rev
+	
+	else:
+		raise Exception("Unknown action: "+unicode(action))
 
-elif args.log_raw:
-	if not args.page:
-		raise "Please specify --page for --log."
+QUERY_ACTIONS = ['list-pages-raw', 'list-pages', 'source', 'content', 'log-raw', 'log']
+SINGLE_ACTIONS = set(['list-pages-raw', 'source', 'content', 'log-raw']) # answer with one item rather than a list
 
-	page_id = wd.get_page_id(args.page)
-	if not page_id:
-		raise "Page not found: "+args.page
+#
+# Reads commands from stdin, one per line, and answers each with a line of JSON on stdout.
+# A command is either "ACTION [PAGE]", or a JSON object: {"action", "page", "depth", "category", "created", "edited"}.
+# Answers are {"action", "page", "result"}, or {"action", "page", "error"} if it failed.
+# All commands run in this one process, sharing the connection, page IDs and --cache.
+#
+def run_batch():
+	import json
+	while True:
+		line = sys.stdin.readline()
+		if not line:
+			break
+		line = line.strip()
+		if (not line) or line.startswith('#'):
+			continue
+		answer = {}
+		try:
+			if line.startswith('{'):
+				command = json.loads(line)
+			else:
+				parts = line.decode(locale.getpreferredencoding()).split(None, 1)
+				command = {'action': parts[0], 'page': parts[1] if len(parts) > 1 else None}
+			answer['action'] = command.get('action')
+			answer['page'] = command.get('page')
+			filters = dict(list_filter)
+			for option, selector in (('category', 'category'), ('created', 'created_at'), ('edited', 'updated_at')):
+				if command.get(option):
+					filters[selector] = command[option]
+			result = list(run_action(command.get('action'), command.get('page'), command.get('depth') or args.depth, filters))
+			if answer['action'] in SINGLE_ACTIONS:
+				result = result[0]
+				if not isinstance(result, (basestring, dict)):
+					result = unicode(result) # soup of the raw actions
+			answer['result'] = result
+		except Exception as e:
+			answer['error'] = unicode(e)
+		rawStdout.write(json.dumps(answer)+'\n')
+		rawStdout.flush()
 
-	print wd.get_revisions_raw(page_id, args.depth)
 
+if args.batch:
+	run_batch()
 
-elif args.log:
-	if not args.page:
-		raise "Please specify --page for --log."
+elif any(getattr(args, action.replace('-', '_')) for action in QUERY_ACTIONS):
+	action = [action for action in QUERY_ACTIONS if getattr(args, action.replace('-', '_'))][0]
+	for item in run_action(action, args.page):
+		print unicode(item)
 
-	page_id = wd.get_page_id(args.page)
-	if not page_id:
-		raise "Page not found: "+args.page
-	for rev in wd.get_revisions(page_id, args.depth):
-		print unicode(rev)
+
+elif args.verify:
+	from rmaint import RepoMaintainer
+	if not args.dump:
+		raise Exception("Please specify --dump with the dump to verify.")
+	print "Verifying "+args.dump
+	rm = RepoMaintainer(wd, args.dump)
+	rm.debug = args.debug
+	rm.listWorkers = args.list_workers
+	rm.listFilter = list_filter
+	rm.engine = 'git' if args.dump_format == 'git' else args.commit_engine
+	report = rm.verify()
+	print "Pages listed: %d, revision lists fetched: %d" % (report['pages'], report['checked'])
+	for name in report['new']:
+		print "New page: "+name
+	for name in report['deleted']:
+		print "Deleted page: "+name
+	for old, name in report['renamed']:
+		print "Renamed page: "+old+" -> "+name
+	for name, count in report['changed']:
+		print "Changed page: %s (%d new revisions)" % (name, count)
+	for name in report['failed']:
+		print "Cannot check page: "+name
+	print "Requests made: %d" % wd.metrics.total('http_request_seconds')[1] # to Wikidot, retries included
+	if report['new'] or report['deleted'] or report['changed'] or report['failed']:
+		print "Dump is out of sync."
+		sys.exit(1)
+	print "Dump is in sync."
 
 
-elif args.dump:
-	print "Downloading pages to "+args.dump
+elif args.dump and args.shard:
+	from rmaint import RepoMaintainer
+	from shard import parseShard, ShardBundle
+	shard = parseShard(args.shard)
+	print "Downloading shard %d/%d to %s" % (shard[0], shard[1], args.dump)
 	force_dirs(args.dump)
 	
+	bundle = ShardBundle(args.dump)
+	bundle.start(args.site, shard)
 	rm = RepoMaintainer(wd, args.dump)
 	rm.debug = args.debug
-	rm.storeRevIds = args.revids
+	rm.lookahead = args.lookahead
+	rm.fetchWorkers = args.fetch_workers
+	rm.planFetches = not args.fetch_all
+	rm.listWorkers = args.list_workers
+	rm.fetchFiles = not args.no_files
+	rm.fileWorkers = args.file_workers
+	rm.listFilter = list_filter
+	rm.progressInterval = args.progress_interval
+	rm.metricsFile = args.metrics
+	rm.metricsFormat = args.metrics_format
+	rm.shard = shard
 	rm.buildRevisionList([args.page] if args.page else None, args.depth)
-	rm.openRepo()
-	
 	print "Downloading revisions..."
-	while rm.commitNext():
-		pass
+	rm.fillBundle(bundle)
+	bundle.close()
+	print "Done. Merge the bundles of all shards with mergeshards.py."
+	print "Effective rate: %.2f requests/sec" % wd.effective_rate()
+	print "Requests skipped by fetch planning: %d" % rm.skipped_requests
+
+
+elif args.dump or args.export:
+	from rmaint import RepoMaintainer
+	path = args.dump or args.export+'.work'
+	print "Downloading pages to "+(args.export or args.dump)
+	force_dirs(path)
+	
+	rm = RepoMaintainer(wd, path)
+	rm.debug = args.debug
+	rm.storeRevIds = args.revids
+	rm.lookahead = args.lookahead
+	rm.fetchWorkers = args.fetch_workers
+	rm.planFetches = not args.fetch_all
+	rm.listWorkers = args.list_workers
+	rm.fetchFiles = not args.no_files
+	rm.fileWorkers = args.file_workers
+	rm.engine = 'git' if args.dump_format == 'git' else args.commit_engine
+	rm.output = args.git_output
+	if args.git_output == '-':
+		sys.stdout = sys.stderr # stdout is taken by the stream
+	if args.export:
+		rm.engine = 'archive'
+		rm.output = args.export
+		rm.fetchFiles = False # archives hold revisions only
+	rm.commitBatch = args.commit_batch
+	rm.listFilter = list_filter
+	rm.progressInterval = args.progress_interval
+	rm.metricsFile = args.metrics
+	rm.metricsFormat = args.metrics_format
+	try:
+		since = rm.lastDumpDate()
+		if since:
+			print "Updating existing dump with revisions after "+str(since)
+			if args.export and not args.dump:
+				# The work directory is gone: follow renames by the page IDs in the archive
+				from archive import ArchiveReader
+				reader = ArchiveReader(args.export)
+				rm.page_ids = dict(reader.pages())
+				reader.close()
+		rm.buildRevisionList([args.page] if args.page else None, args.depth, since)
+		rm.openRepo()
+	
+		print "Downloading revisions..."
+		if args.profile:
+			import cProfile
+			import pstats
+			profile = cProfile.Profile()
+			profile.enable()
+			for i in range(args.profile):
+				if not rm.commitNext():
+					break
+			profile.disable()
+			if args.profile_output:
+				profile.dump_stats(args.profile_output)
+			pstats.Stats(profile, stream=sys.stdout).sort_stats('cumulative').print_stats(30)
+		while rm.commitNext():
+			pass
 	
-	rm.cleanup()
-	print "Done."
+		rm.cleanup()
+		print "Done."
+		print "Connections opened: %d, reused: %d" % wd.connection_stats()
+		print "Effective rate: %.2f requests/sec" % wd.effective_rate()
+		print "Requests skipped by fetch planning: %d" % rm.skipped_requests
+		if wd.cache:
+			print wd.cache.stats()
+	finally:
+		# Work files of an export only outlive it to continue it after a failure
+		if args.export and not args.dump and not rm.isAborted():
+			remove_work_dir(path)
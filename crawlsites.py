@@ -0,0 +1,266 @@
+import argparse
+import sys
+import os
+import time
+import json
+import codecs
+import locale
+import threading
+import Queue
+import traceback
+import urlparse
+from wikidot import Wikidot
+from rmaint import RepoMaintainer
+from ratelimit import FairLimiter
+
+# Dumps several Wikidot sites at once.
+# Each site gets its own Wikidot + RepoMaintainer pipeline, run by a pool of threads.
+# Requests are capped per site (--delay, like crawl.py) and over all sites (--global-rate);
+# sites waiting for the global cap get requests in turn.
+#
+# Progress of each site is kept in a state file under --dest. When restarted, sites left unfinished
+# are continued first (the dumps themselves resume where they stopped), finished ones are skipped
+# unless --update is given.
+
+# Examples:
+#   crawlsites.py sites.txt --dest Archive --workers 8 --global-rate 20
+#   crawlsites.py --site http://a.wikidot.com --site http://b.wikidot.com --dest Archive
+
+# sites.txt: one site per line, "URL [directory]". Empty lines and lines starting with # are ignored.
+# The directory defaults to the site's host name, under --dest.
+
+
+#
+# Per-thread stdout: each site's output goes to its log file, the rest to the console
+#
+class ThreadOutput:
+	def __init__(self, default):
+		self.default = default
+		self.local = threading.local()
+
+	def target(self):
+		return getattr(self.local, 'fp', None) or self.default
+
+	def write(self, data):
+		self.target().write(data)
+
+	def flush(self):
+		self.target().flush()
+
+	def redirect(self, fp):
+		self.local.fp = fp
+
+
+#
+# Per-site progress, saved as JSON: site -> {'path', 'status', 'rev_no', 'total', 'error', 'finished'}
+# status is one of: pending, listing, committing, done, failed
+#
+class Progress:
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.sites = {}
+		if os.path.isfile(filename):
+			with open(filename, 'rb') as fp:
+				self.sites = json.load(fp)
+
+	def get(self, site):
+		with self.lock:
+			return dict(self.sites.get(site, {}))
+
+	def update(self, site, **fields):
+		with self.lock:
+			self.sites.setdefault(site, {}).update(fields)
+			self.save()
+
+	def save(self):
+		fp = open(self.filename+'.tmp', 'wb')
+		json.dump(self.sites, fp, indent=1, sort_keys=True)
+		fp.close()
+		if os.path.isfile(self.filename):
+			os.remove(self.filename) # can't rename over it on Windows
+		os.rename(self.filename+'.tmp', self.filename)
+
+
+def read_sites(filename):
+	sites = []
+	with codecs.open(filename, 'r', 'utf-8') as fp:
+		for line in fp:
+			line = line.strip()
+			if (not line) or line.startswith('#'):
+				continue
+			parts = line.split(None, 1)
+			sites.append((parts[0], parts[1] if len(parts) > 1 else None))
+	return sites
+
+def site_dir(url):
+	return (urlparse.urlparse(url).netloc or url).replace('/', '_').replace(':', '_')
+
+def force_dirs(path):
+	try:
+		os.makedirs(path)
+	except OSError as exception:
+		if exception.errno != os.errno.EEXIST:
+			raise
+
+
+#
+# Dumps one site. Runs on a pool thread.
+#
+def dump_site(args, site, path, shared_limiter, progress):
+	wd = Wikidot(site)
+	wd.debug = args.debug
+	wd.delay = args.delay
+	wd.burst = args.burst
+	wd.file_delay = args.file_delay
+	wd.pool_size = args.pool_size
+	wd.timeout = args.timeout
+	wd.shared_limiter = shared_limiter
+
+	force_dirs(path)
+	rm = RepoMaintainer(wd, path)
+	rm.debug = args.debug
+	rm.storeRevIds = args.revids
+	rm.lookahead = args.lookahead
+	rm.fetchWorkers = args.fetch_workers
+	rm.planFetches = not args.fetch_all
+	rm.listWorkers = args.list_workers
+	rm.fetchFiles = not args.no_files
+	rm.fileWorkers = args.file_workers
+	rm.engine = 'git' if args.dump_format == 'git' else args.commit_engine
+	rm.commitBatch = args.commit_batch
+	rm.progressInterval = args.progress_interval
+
+	progress.update(site, path=path, status='listing', error=None)
+	since = rm.lastDumpDate()
+	if since:
+		print "Updating existing dump with revisions after "+str(since)
+	rm.buildRevisionList(None, args.depth, since)
+	rm.openRepo()
+
+	print "Downloading revisions..."
+	total = len(rm.wrevs)
+	progress.update(site, status='committing', rev_no=rm.rev_no, total=total)
+	last_update = time.time()
+	while rm.commitNext():
+		if time.time() - last_update >= args.progress_interval:
+			progress.update(site, rev_no=rm.rev_no)
+			last_update = time.time()
+	rm.cleanup()
+	print "Done."
+	print "Effective rate: %.2f requests/sec" % wd.effective_rate()
+	progress.update(site, status='done', rev_no=total, finished=time.time())
+	return total
+
+
+def worker(args, jobs, shared_limiter, progress, output):
+	while True:
+		try:
+			site, path = jobs.get_nowait()
+		except Queue.Empty:
+			return
+		log = codecs.open(path+'.log', 'a', 'utf-8')
+		output.redirect(log)
+		output.default.write("Started: %s\n" % site)
+		try:
+			total = dump_site(args, site, path, shared_limiter, progress)
+			output.default.write("Finished: %s (%d revisions)\n" % (site, total))
+		except Exception:
+			error = traceback.format_exc()
+			print error
+			progress.update(site, status='failed', error=error.strip().split('\n')[-1])
+			output.default.write("Failed: %s, see %s\n" % (site, path+'.log'))
+		finally:
+			output.redirect(None)
+			log.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Dumps several Wikidot sites at once')
+	parser.add_argument('sites', nargs='?', help='File listing the sites, one "URL [directory]" per line')
+	parser.add_argument('--site', action='append', default=[], help='Site URL (may be given several times)')
+	parser.add_argument('--dest', type=str, required=True, help='Directory to put the dumps in')
+	parser.add_argument('--workers', type=int, default='4', help='Sites to dump at the same time')
+	parser.add_argument('--global-rate', type=float, default='0', help='Max requests per second over all sites (0 = only per-site limits)')
+	parser.add_argument('--global-burst', type=int, default='1', help='Allow this many requests over all sites in a burst')
+	parser.add_argument('--update', action='store_true', help='Also update sites which were dumped completely before')
+	# Per-site settings, as in crawl.py
+	parser.add_argument('--delay', type=int, default='200', help='Delay between consequent calls to each site')
+	parser.add_argument('--burst', type=int, default='1', help='Allow this many calls to each site in a burst')
+	parser.add_argument('--file-delay', type=int, default='100', help='Delay between consequent file downloads from each site')
+	parser.add_argument('--pool-size', type=int, default='10', help='Max keep-alive connections to each site')
+	parser.add_argument('--timeout', type=int, default='60', help='Network timeout in seconds')
+	parser.add_argument('--depth', type=int, default='10000', help='Query only last N revisions')
+	parser.add_argument('--revids', action='store_true', help='Store last revision ids in the repository')
+	parser.add_argument('--lookahead', type=int, default='0', help='Prefetch data for this many upcoming revisions while committing')
+	parser.add_argument('--fetch-workers', type=int, default='2', help='Number of threads prefetching revision data, per site')
+	parser.add_argument('--fetch-all', action='store_true', help='Fetch source and details for every revision, even if its flags say they did not change')
+	parser.add_argument('--list-workers', type=int, default='4', help='Number of threads querying pages while building the revision list, per site')
+	parser.add_argument('--no-files', action='store_true', help='Do not download files attached to pages')
+	parser.add_argument('--file-workers', type=int, default='4', help='Number of threads downloading files, per site')
+	parser.add_argument('--dump-format', type=str, default='hg', choices=['hg', 'git'], help='Dump into Mercurial or git repositories')
+	parser.add_argument('--commit-engine', type=str, default='commands', choices=['commands', 'memory'], help='How to commit to Mercurial')
+	parser.add_argument('--commit-batch', type=int, default='100', help='Commits per transaction for --commit-engine memory')
+	parser.add_argument('--progress-interval', type=int, default='10', help='Print progress and save it every N seconds')
+	parser.add_argument('--debug', action='store_true', help='Print debug info')
+	args = parser.parse_args()
+
+	sites = [(url, None) for url in args.site]
+	if args.sites:
+		sites += read_sites(args.sites)
+	if not sites:
+		parser.error('No sites given')
+
+	force_dirs(args.dest)
+	progress = Progress(os.path.join(args.dest, 'crawlsites.state'))
+
+	# Unfinished sites first, so an interrupted run continues where it stopped
+	unfinished = []
+	new = []
+	for url, path in sites:
+		state = progress.get(url)
+		if path:
+			path = os.path.join(args.dest, path)
+		else:
+			path = state.get('path') or os.path.join(args.dest, site_dir(url))
+		status = state.get('status')
+		if status == 'done':
+			if args.update:
+				new.append((url, path))
+			else:
+				print "Skipping "+url+": done"
+		elif status:
+			unfinished.append((url, path))
+		else:
+			progress.update(url, path=path, status='pending')
+			new.append((url, path))
+	jobs = Queue.Queue()
+	for job in unfinished + new:
+		jobs.put(job)
+
+	shared_limiter = FairLimiter(args.global_rate, args.global_burst) if args.global_rate > 0 else None
+	console = codecs.getwriter(locale.getpreferredencoding())(sys.stdout, 'xmlcharrefreplace')
+	output = ThreadOutput(console)
+	sys.stdout = output
+
+	started = time.time()
+	threads = []
+	for i in range(min(args.workers, jobs.qsize())):
+		thread = threading.Thread(target=worker, args=(args, jobs, shared_limiter, progress, output))
+		thread.daemon = True # Ctrl+C stops everything, dumps continue on restart
+		thread.start()
+		threads.append(thread)
+	while any(thread.is_alive() for thread in threads):
+		time.sleep(0.5)
+
+	failed = [url for url, path in unfinished + new if progress.get(url).get('status') != 'done']
+	console.write("All done in %.1f sec, %d sites failed\n" % (time.time() - started, len(failed)))
+	if shared_limiter:
+		console.write("Effective global rate: %.2f requests/sec\n" % shared_limiter.effective_rate())
+	for url in failed:
+		console.write("  %s: %s\n" % (url, progress.get(url).get('error')))
+	if failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
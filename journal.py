@@ -0,0 +1,104 @@
+import os
+import cPickle as pickle
+
+# Append-only journal for RepoMaintainer construction state
+# The state is a snapshot (rev_no, last_names, last_parents) plus a journal of changes made since.
+# Each stored commit appends a small record with only what changed, so saving state costs the same
+# no matter how many pages there are. Every so often the journal is compacted into a new snapshot.
+
+# Usage:
+#   j = StateJournal(snapshot_filename, journal_filename)
+#   rev_no, names, parents = j.load()
+#   j.append(rev_no, changed_names, changed_parents)
+#   j.compact(rev_no, names, parents)
+
+class StateJournal:
+	def __init__(self, snapshot, journal, compactEvery = 1000):
+		self.snapshot = snapshot			# Snapshot file, same format as the old .wstate
+		self.journal = journal			# Journal file
+		self.compactEvery = compactEvery	# Compact after this many records
+		self.records = 0					# Records in the journal
+		self.fp = None
+
+	def exists(self):
+		return os.path.isfile(self.snapshot) or os.path.isfile(self.snapshot+'.tmp')
+
+	#
+	# Returns (rev_no, last_names, last_parents) as of the last record
+	#
+	def load(self):
+		snapshot = self.snapshot
+		if not os.path.isfile(snapshot):
+			snapshot += '.tmp' # crashed while replacing it
+		fp = open(snapshot, 'rb')
+		rev_no = pickle.load(fp)
+		names = pickle.load(fp)
+		try:
+			parents = pickle.load(fp)
+		except EOFError:
+			parents = {}
+		fp.close()
+
+		self.records = 0
+		snapshot_rev_no = rev_no
+		if os.path.isfile(self.journal):
+			fp = open(self.journal, 'rb')
+			while True:
+				try:
+					rec_no, changed_names, changed_parents = pickle.load(fp)
+				except EOFError:
+					break
+				except Exception:
+					break # a record cut short by a crash
+				if rec_no <= snapshot_rev_no:
+					continue # already in the snapshot (crashed while compacting)
+				rev_no = rec_no
+				names.update(changed_names)
+				for page, parent in changed_parents.items():
+					if parent is None:
+						parents.pop(page, None)
+					else:
+						parents[page] = parent
+				self.records += 1
+			fp.close()
+		return (rev_no, names, parents)
+
+	#
+	# Records state changes up to rev_no. changed_parents maps to None for removed parents.
+	#
+	def append(self, rev_no, changed_names, changed_parents):
+		if self.fp is None:
+			self.fp = open(self.journal, 'ab')
+		pickle.dump((rev_no, changed_names, changed_parents), self.fp, pickle.HIGHEST_PROTOCOL)
+		self.fp.flush()
+		self.records += 1
+
+	def needsCompaction(self):
+		return self.records >= self.compactEvery
+
+	#
+	# Writes a new snapshot of the whole state and empties the journal
+	#
+	def compact(self, rev_no, names, parents):
+		fp = open(self.snapshot+'.tmp', 'wb')
+		pickle.dump(rev_no, fp)
+		pickle.dump(names, fp)
+		pickle.dump(parents, fp)
+		fp.close()
+		if os.path.isfile(self.snapshot):
+			os.remove(self.snapshot) # can't rename over it on Windows
+		os.rename(self.snapshot+'.tmp', self.snapshot)
+		self.close()
+		open(self.journal, 'wb').close()
+		self.records = 0
+
+	def close(self):
+		if self.fp is not None:
+			self.fp.close()
+			self.fp = None
+
+	def remove(self):
+		self.close()
+		for fname in (self.snapshot, self.snapshot+'.tmp', self.journal):
+			if os.path.isfile(fname):
+				os.remove(fname)
@@ -0,0 +1,111 @@
+import argparse
+import sys
+import os
+import codecs
+import locale
+from rmaint import RepoMaintainer
+from revstore import RevisionStore
+from shard import ShardBundle, BundleWikidot
+
+# Merges the bundles of a sharded dump into one repository.
+# Each shard of the site is dumped into a bundle first, possibly on different machines:
+#   crawl.py http://example.wikidot.com --dump Shard1 --shard 1/3
+#   crawl.py http://example.wikidot.com --dump Shard2 --shard 2/3
+#   crawl.py http://example.wikidot.com --dump Shard3 --shard 3/3
+# then, with the bundles copied to one place:
+#   mergeshards.py Shard1 Shard2 Shard3 --dump ExampleRepo
+#
+# The revision lists of the bundles are combined into (date, rev_id) order and committed in one pass,
+# with the same options as crawl.py. No requests are made. The history is the same as that of
+# a dump made on one machine. If interrupted, restart the same command.
+
+
+sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout, 'xmlcharrefreplace')
+
+def force_dirs(path):
+	try:
+		os.makedirs(path)
+	except OSError as exception:
+		if exception.errno != os.errno.EEXIST:
+			raise
+
+#
+# Checks that the bundles are complete and make up all shards of one site, once each
+#
+def checkBundles(bundles):
+	sites = set(bundle.getMeta('site') for bundle in bundles)
+	if len(sites) != 1:
+		raise Exception("Bundles are of different sites: "+", ".join(sorted(unicode(site) for site in sites)))
+	shards = {}
+	for bundle in bundles:
+		shard = bundle.shard()
+		if shard[0] is None:
+			raise Exception("Not a bundle: "+bundle.path)
+		if not bundle.isComplete():
+			raise Exception("Bundle at "+bundle.path+" is incomplete, run its crawl.py --shard again to finish it")
+		if shard in shards:
+			raise Exception("Bundles at "+shards[shard].path+" and "+bundle.path+" are both shard %d/%d" % shard)
+		shards[shard] = bundle
+	counts = set(shard[1] for shard in shards)
+	if len(counts) != 1:
+		raise Exception("Bundles are from sharding into different numbers of shards")
+	n = counts.pop()
+	missing = [str(i) for i in range(1, n+1) if (i, n) not in shards]
+	if missing:
+		raise Exception("Missing shards: "+", ".join(missing)+" of "+str(n))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Merges bundles made by crawl.py --shard into one repository')
+	parser.add_argument('bundles', nargs='+', help='Bundle directories, one for each shard')
+	parser.add_argument('--dump', type=str, required=True, help='Create the repository in this directory')
+	parser.add_argument('--revids', action='store_true', help='Store last revision ids in the repository')
+	parser.add_argument('--dump-format', type=str, default='hg', choices=['hg', 'git'], help='Dump into a Mercurial repository, or as a git fast-import stream')
+	parser.add_argument('--git-output', type=str, help='Write git fast-import stream to this file (- for stdout) instead of a git repository at --dump; new dumps only')
+	parser.add_argument('--commit-engine', type=str, default='commands', choices=['commands', 'memory'], help='How to commit: through Mercurial commands, or by building changesets in memory (faster)')
+	parser.add_argument('--commit-batch', type=int, default='100', help='Commits per transaction for --commit-engine memory')
+	parser.add_argument('--no-files', action='store_true', help='Leave out files attached to pages')
+	parser.add_argument('--progress-interval', type=int, default='10', help='Print progress and ETA every N seconds')
+	parser.add_argument('--debug', action='store_true', help='Print debug info')
+	args = parser.parse_args()
+
+	bundles = [ShardBundle(path) for path in args.bundles]
+	checkBundles(bundles)
+
+	print "Merging "+str(len(bundles))+" bundles into "+args.dump
+	force_dirs(args.dump)
+	rm = RepoMaintainer(BundleWikidot(bundles), args.dump)
+	rm.debug = args.debug
+	rm.storeRevIds = args.revids
+	rm.fetchFiles = not args.no_files
+	rm.engine = 'git' if args.dump_format == 'git' else args.commit_engine
+	rm.output = args.git_output
+	if args.git_output == '-':
+		sys.stdout = sys.stderr # stdout is taken by the stream
+	rm.commitBatch = args.commit_batch
+	rm.progressInterval = args.progress_interval
+	if rm.lastDumpDate() is not None:
+		raise Exception("There's a finished dump at "+args.dump+" already, merge into a new directory")
+
+	# The combined revision list: buildRevisionList takes it from here as a finished one
+	store = RevisionStore(args.dump+'\\.wrevs.db')
+	if not store.isComplete():
+		print "Combining revision lists..."
+		for bundle in bundles:
+			store.mergeFrom(bundle.storePath())
+		store.setMeta('started', 1)
+		store.setComplete()
+	store.close()
+	rm.buildRevisionList()
+	rm.openRepo()
+
+	print "Committing revisions..."
+	while rm.commitNext():
+		pass
+	rm.cleanup()
+	for bundle in bundles:
+		bundle.close()
+	print "Done."
+
+if __name__ == '__main__':
+	main()
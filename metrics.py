@@ -0,0 +1,164 @@
+import time
+import json
+import os
+import threading
+
+# Counters, gauges and timing histograms for the stages of a dump
+# Series are identified by a name plus optional labels, e.g. http_request_seconds{module="history/PageSourceModule"}.
+# Snapshots can be exported as JSON lines or in the Prometheus text format.
+
+# Usage:
+#   metrics = Metrics()
+#   with metrics.timer('commit_seconds'):
+#       ...
+#   metrics.observe('http_request_seconds', elapsed, module='history/PageSourceModule')
+#   metrics.count('http_retries_total', module='history/PageSourceModule')
+#   metrics.gauge('revisions_done', rev_no)
+#   metrics.writeJson(fp)					# one line per call
+#   metrics.writePrometheus(filename)		# replaces the file
+
+# Thread-safe.
+
+# Histogram bucket upper bounds, seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = 'wdotcrawl_'	# for Prometheus
+
+
+class Histogram:
+	def __init__(self):
+		self.count = 0
+		self.sum = 0.0
+		self.buckets = [0] * len(BUCKETS)	# observations <= each bound (not cumulative)
+
+	def observe(self, value):
+		self.count += 1
+		self.sum += value
+		for i, bound in enumerate(BUCKETS):
+			if value <= bound:
+				self.buckets[i] += 1
+				break
+
+	def cumulative(self):
+		total = 0
+		result = []
+		for n in self.buckets:
+			total += n
+			result.append(total)
+		return result
+
+
+class _Timer:
+	def __init__(self, metrics, name, labels):
+		self.metrics = metrics
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.started = time.time()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.metrics.observe(self.name, time.time() - self.started, **self.labels)
+		return False
+
+
+# Series key: name plus sorted labels
+def _key(name, labels):
+	return (name, tuple(sorted(labels.items())))
+
+def _series(key, extra = None):
+	name, labels = key
+	labels = list(labels)
+	if extra:
+		labels.append(extra)
+	if not labels:
+		return name
+	return name + '{' + ','.join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class Metrics:
+	def __init__(self):
+		self.counters = {}
+		self.gauges = {}
+		self.histograms = {}
+		self.started = time.time()
+		self.lock = threading.Lock()
+
+	def count(self, name, value = 1, **labels):
+		key = _key(name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def gauge(self, name, value, **labels):
+		with self.lock:
+			self.gauges[_key(name, labels)] = value
+
+	def observe(self, name, seconds, **labels):
+		key = _key(name, labels)
+		with self.lock:
+			hist = self.histograms.get(key)
+			if hist is None:
+				hist = self.histograms[key] = Histogram()
+			hist.observe(seconds)
+
+	# Times the with-block into a histogram
+	def timer(self, name, **labels):
+		return _Timer(self, name, labels)
+
+	# Total time and count of observations of a histogram, over all its labels
+	def total(self, name):
+		with self.lock:
+			hists = [hist for (key, hist) in self.histograms.items() if key[0] == name]
+			return (sum(hist.sum for hist in hists), sum(hist.count for hist in hists))
+
+	def snapshot(self):
+		with self.lock:
+			return {
+				'time': time.time(),
+				'uptime': time.time() - self.started,
+				'counters': dict((_series(key), value) for key, value in self.counters.items()),
+				'gauges': dict((_series(key), value) for key, value in self.gauges.items()),
+				'histograms': dict((_series(key), {
+					'count': hist.count,
+					'sum': hist.sum,
+					'buckets': dict(zip([str(bound) for bound in BUCKETS], hist.cumulative())),
+				}) for key, hist in self.histograms.items()),
+			}
+
+	def writeJson(self, fp):
+		fp.write(json.dumps(self.snapshot(), sort_keys=True)+'\n')
+		fp.flush()
+
+	def prometheus(self):
+		lines = []
+		with self.lock:
+			for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+				typed = set()
+				for key in sorted(series):
+					if key[0] not in typed:
+						lines.append('# TYPE %s%s %s' % (PREFIX, key[0], kind))
+						typed.add(key[0])
+					lines.append('%s%s %s' % (PREFIX, _series(key), series[key]))
+			typed = set()
+			for key in sorted(self.histograms):
+				hist = self.histograms[key]
+				if key[0] not in typed:
+					lines.append('# TYPE %s%s histogram' % (PREFIX, key[0]))
+					typed.add(key[0])
+				bucket_key = (key[0]+'_bucket', key[1])
+				for bound, n in zip(BUCKETS, hist.cumulative()):
+					lines.append('%s%s %d' % (PREFIX, _series(bucket_key, ('le', bound)), n))
+				lines.append('%s%s %d' % (PREFIX, _series(bucket_key, ('le', '+Inf')), hist.count))
+				lines.append('%s%s %r' % (PREFIX, _series((key[0]+'_sum', key[1])), hist.sum))
+				lines.append('%s%s %d' % (PREFIX, _series((key[0]+'_count', key[1])), hist.count))
+		return u'\n'.join(lines)+u'\n'
+
+	# Replaces the file as a whole, so scrapers never see a partial one
+	def writePrometheus(self, filename):
+		fp = open(filename+'.tmp', 'wb')
+		fp.write(self.prometheus().encode('utf-8'))
+		fp.close()
+		if os.path.isfile(filename):
+			os.remove(filename) # can't rename over it on Windows
+		os.rename(filename+'.tmp', filename)
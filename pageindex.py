@@ -0,0 +1,82 @@
+import sqlite3
+import threading
+
+# Page index
+# What a finished dump holds of each page: its ID, unix name, last revision and what the site's listing
+# said of it (last edit time, revision count). Kept beside the repository (.wpages.db) and brought up to date
+# by each dump, so that checking the dump against the site (RepoMaintainer.verify) only needs the listing
+# and the revision lists of pages which changed since.
+
+# Usage:
+#   index = PageIndex(filename)
+#   index.put(page_id, unixname, last_rev_id, edited, revisions)
+#   index.get(page_id)			# {'page_id', 'unixname', 'last_rev_id', 'edited', 'revisions'} or None
+#   index.pages()				# all of them, page_id -> the same
+
+
+class PageIndex:
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(filename, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.executescript("""
+			CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+			CREATE TABLE IF NOT EXISTS pages (
+				page_id INTEGER PRIMARY KEY,
+				unixname TEXT,
+				last_rev_id INTEGER,
+				edited INTEGER,
+				revisions INTEGER
+			);
+		""")
+		self.db.commit()
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+	def getMeta(self, key, default = None):
+		with self.lock:
+			row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		return row[0] if row else default
+
+	def setMeta(self, key, value):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+			self.db.commit()
+
+	def count(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+	def _page(self, row):
+		return {
+		  'page_id': row[0],
+		  'unixname': row[1],
+		  'last_rev_id': row[2],
+		  'edited': row[3],
+		  'revisions': row[4],
+		}
+
+	def get(self, page_id):
+		with self.lock:
+			row = self.db.execute('SELECT page_id, unixname, last_rev_id, edited, revisions FROM pages WHERE page_id = ?',
+				(page_id,)).fetchone()
+		return self._page(row) if row else None
+
+	def pages(self):
+		with self.lock:
+			rows = self.db.execute('SELECT page_id, unixname, last_rev_id, edited, revisions FROM pages').fetchall()
+		return dict((row[0], self._page(row)) for row in rows)
+
+	def put(self, page_id, unixname, last_rev_id, edited, revisions):
+		self.putMany([(page_id, unixname, last_rev_id, edited, revisions)])
+
+	# Records several pages in one transaction: [(page_id, unixname, last_rev_id, edited, revisions)]
+	def putMany(self, rows):
+		with self.lock:
+			self.db.executemany('INSERT OR REPLACE INTO pages (page_id, unixname, last_rev_id, edited, revisions) VALUES (?, ?, ?, ?, ?)',
+				[(int(row[0]), row[1], int(row[2]), row[3], row[4]) for row in rows])
+			self.db.commit()
@@ -0,0 +1,83 @@
+import threading
+import Queue
+import sys
+
+# Bounded look-ahead fetcher
+# Runs fetch(index) for the next few indices on worker threads while the caller
+# consumes results strictly in order.
+
+# Usage:
+#   pf = Prefetcher(fetch, count, lookahead, workers)
+#   data = pf.get(0)
+#   data = pf.get(1)
+#   ...
+#   pf.stop()
+
+# At most `lookahead` results are scheduled or held in memory at any time.
+# Rate limiting is the fetch function's business (Wikidot does it per request).
+
+class Prefetcher:
+	def __init__(self, fetch, count, lookahead = 10, workers = 2):
+		self.fetch = fetch			# fetch(index) -> data
+		self.count = count			# Total number of indices
+		self.lookahead = max(lookahead, 1)
+
+		self.jobs = Queue.Queue()
+		self.results = {}			# index -> (data, exc_info)
+		self.cond = threading.Condition()
+		self.next_scheduled = 0		# First index not yet handed to workers
+		self.stopped = False
+
+		self.threads = []
+		for i in range(max(workers, 1)):
+			thread = threading.Thread(target=self._work)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def _work(self):
+		while True:
+			index = self.jobs.get()
+			if (index is None) or self.stopped:
+				return
+			try:
+				result = (self.fetch(index), None)
+			except Exception:
+				result = (None, sys.exc_info())
+			with self.cond:
+				self.results[index] = result
+				self.cond.notify_all()
+
+	# Schedules indices [index, index+lookahead) that haven't been scheduled yet
+	def _schedule(self, index):
+		if self.next_scheduled < index:
+			self.next_scheduled = index # skipped ahead, e.g. on resume
+		while (self.next_scheduled < index + self.lookahead) and (self.next_scheduled < self.count):
+			self.jobs.put(self.next_scheduled)
+			self.next_scheduled += 1
+
+	# Returns fetch(index), waiting for it if needed. Re-raises fetch errors.
+	def get(self, index):
+		with self.cond:
+			if index >= self.next_scheduled:
+				# Not scheduled yet (or we went backwards) -- make sure it is
+				self._schedule(index)
+			while index not in self.results:
+				self.cond.wait(1)
+			data, exc_info = self.results.pop(index)
+			self._schedule(index + 1)
+		if exc_info:
+			raise exc_info[0], exc_info[1], exc_info[2]
+		return data
+
+	# Stops the workers. Jobs not yet started are dropped; fetches in progress finish, but nobody waits for them.
+	def stop(self):
+		if self.stopped: return
+		self.stopped = True
+		while True:
+			try:
+				self.jobs.get_nowait()
+			except Queue.Empty:
+				break
+		for thread in self.threads:
+			self.jobs.put(None)
@@ -0,0 +1,123 @@
+import threading
+import time
+import collections
+
+# Adaptive token-bucket rate limiter
+# Allows bursts of up to `burst` requests and a steady rate of `rate` requests per second.
+# When the server complains (backoff()), the rate is cut in half;
+# every successful request (success()) then brings it back up step by step (AIMD).
+
+# Usage:
+#   limiter = RateLimiter(5.0, burst=3)
+#   limiter.wait()
+#   ... make request ...
+#   limiter.success() or limiter.backoff()
+
+# Thread-safe. rate = 0 means no limit.
+
+class RateLimiter:
+	def __init__(self, rate, burst = 1):
+		self.max_rate = float(rate)		# Configured steady-state rate, req/sec
+		self.rate = float(rate)			# Current rate, lowered on backoff
+		self.min_rate = self.max_rate / 64	# Don't back off below this
+		self.increase = self.max_rate / 20	# Rate regained per successful request
+		self.burst = max(burst, 1)		# Bucket capacity
+		self.tokens = float(self.burst)	# Start full
+		self.last_fill = time.time()
+		self.lock = threading.Lock()
+		self.history = collections.deque(maxlen=100) # Recent grant times, for effective_rate()
+
+	def _fill(self, now):
+		if now > self.last_fill:
+			self.tokens = min(self.burst, self.tokens + (now - self.last_fill) * self.rate)
+		self.last_fill = now
+
+	# Blocks until a request may be made. Returns time spent waiting, in seconds.
+	# Waiters are served in the order they got the lock: each takes a token right away, borrowing it
+	# from the future if the bucket is empty, and sleeps until it's due without holding the lock,
+	# so success() and backoff() from other threads aren't held up.
+	def wait(self):
+		started = time.time()
+		delay = 0
+		with self.lock:
+			if self.max_rate > 0:
+				self._fill(time.time())
+				self.tokens -= 1
+				if self.tokens < 0:
+					delay = -self.tokens / self.rate
+		if delay > 0:
+			time.sleep(delay)
+		with self.lock:
+			self.history.append(time.time())
+		return time.time() - started
+
+	# Server is overloaded or refusing us (429/5xx/bad status): slow down
+	def backoff(self):
+		with self.lock:
+			if self.max_rate <= 0: return
+			self.rate = max(self.rate / 2, self.min_rate)
+			self.tokens = min(self.tokens, 0) # tokens already borrowed stay owed
+
+	# Request went through: gradually recover the configured rate
+	def success(self):
+		with self.lock:
+			if self.rate < self.max_rate:
+				self.rate = min(self.rate + self.increase, self.max_rate)
+
+	# Actual requests per second over the recent requests
+	def effective_rate(self):
+		with self.lock:
+			if len(self.history) < 2:
+				return 0.0
+			span = self.history[-1] - self.history[0]
+			if span <= 0:
+				return 0.0
+			return (len(self.history) - 1) / span
+
+
+#
+# Rate limiter shared by several clients (e.g. Wikidot instances for different sites),
+# which takes turns between them: while several clients are waiting, each gets a request in turn,
+# so a busy client can't starve the others.
+#
+# Usage:
+#   shared = FairLimiter(20.0)
+#   shared.wait(site)
+#
+class FairLimiter:
+	def __init__(self, rate, burst = 1):
+		self.limiter = RateLimiter(rate, burst)
+		self.cond = threading.Condition()
+		self.queues = collections.OrderedDict()	# client -> tickets of its waiters, in turn order
+		self.turn = None				# Ticket allowed to take the next request slot
+		self.next_ticket = 0
+
+	def _pass_turn(self):
+		if self.queues:
+			self.turn = self.queues[next(iter(self.queues))][0]
+		else:
+			self.turn = None
+
+	# Blocks until `client` may make a request. Returns time spent waiting, in seconds.
+	def wait(self, client):
+		started = time.time()
+		with self.cond:
+			ticket = self.next_ticket
+			self.next_ticket += 1
+			self.queues.setdefault(client, collections.deque()).append(ticket)
+			if self.turn is None:
+				self._pass_turn()
+			while self.turn != ticket:
+				self.cond.wait()
+		self.limiter.wait() # only the turn holder gets here
+		with self.cond:
+			queue = self.queues.pop(client)
+			queue.popleft()
+			if queue:
+				self.queues[client] = queue # to the back of the line
+			self._pass_turn()
+			self.cond.notify_all()
+		return time.time() - started
+
+	def effective_rate(self):
+		return self.limiter.effective_rate()
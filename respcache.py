@@ -0,0 +1,94 @@
+import sqlite3
+import threading
+import zlib
+import json
+
+# Persistent cache for Wikidot AJAX responses
+# Keyed by (site, moduleName, object id). Only for responses which never change once they exist,
+# such as revision source and version data. Entries are stored compressed; when the cache grows
+# over its size cap, least recently used entries are evicted.
+
+# Usage:
+#   cache = ResponseCache(filename, max_bytes)
+#   res = cache.get(site, module, rev_id)		# None on miss
+#   cache.put(site, module, rev_id, res)		# res: anything JSON-serializable
+#   print cache.stats()
+
+class ResponseCache:
+	def __init__(self, filename, max_bytes = 1024*1024*1024):
+		self.filename = filename
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(filename, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.executescript("""
+			CREATE TABLE IF NOT EXISTS responses (
+				site TEXT,
+				module TEXT,
+				id TEXT,
+				data BLOB,
+				size INTEGER,
+				used INTEGER,
+				PRIMARY KEY (site, module, id)
+			);
+			CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+		""")
+		self.db.commit()
+		row = self.db.execute('SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM responses').fetchone()
+		self.total_bytes = row[0]
+		self.clock = row[1]		# Access counter for LRU
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+	def get(self, site, module, id):
+		with self.lock:
+			row = self.db.execute('SELECT data FROM responses WHERE site = ? AND module = ? AND id = ?',
+				(site, module, str(id))).fetchone()
+			if row is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.clock += 1
+			self.db.execute('UPDATE responses SET used = ? WHERE site = ? AND module = ? AND id = ?',
+				(self.clock, site, module, str(id)))
+			self.db.commit()
+		return json.loads(zlib.decompress(str(row[0])).decode('utf-8'))
+
+	def put(self, site, module, id, value):
+		data = zlib.compress(json.dumps(value).encode('utf-8'), 6)
+		with self.lock:
+			self.clock += 1
+			old = self.db.execute('SELECT size FROM responses WHERE site = ? AND module = ? AND id = ?',
+				(site, module, str(id))).fetchone()
+			if old:
+				self.total_bytes -= old[0]
+			self.db.execute('INSERT OR REPLACE INTO responses (site, module, id, data, size, used) VALUES (?, ?, ?, ?, ?, ?)',
+				(site, module, str(id), sqlite3.Binary(data), len(data), self.clock))
+			self.total_bytes += len(data)
+			if self.total_bytes > self.max_bytes:
+				self._evict()
+			self.db.commit()
+
+	# Drops least recently used entries until we're 10% under the cap
+	def _evict(self):
+		target = self.max_bytes * 9 / 10
+		while self.total_bytes > target:
+			rows = self.db.execute('SELECT site, module, id, size FROM responses ORDER BY used LIMIT 100').fetchall()
+			if not rows: break
+			for site, module, id, size in rows:
+				self.db.execute('DELETE FROM responses WHERE site = ? AND module = ? AND id = ?', (site, module, id))
+				self.total_bytes -= size
+				self.evictions += 1
+				if self.total_bytes <= target: break
+
+	def stats(self):
+		total = self.hits + self.misses
+		return "Cache: %d hits, %d misses (%.1f%% hit rate), %d evicted, %.1f MB stored" % (
+			self.hits, self.misses, 100.0 * self.hits / total if total else 0.0,
+			self.evictions, self.total_bytes / (1024.0*1024.0))
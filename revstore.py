@@ -0,0 +1,261 @@
+import sqlite3
+import threading
+import heapq
+
+# On-disk revision list
+# Records each page's revisions as soon as they're queried, so an interrupted listing
+# continues where it stopped. Revisions are read back in (date, rev_id) order straight from an index,
+# a window at a time, without loading the whole list into memory.
+
+# Usage:
+#   store = RevisionStore(filename)
+#   if not store.hasPage(name):
+#       store.addPage(name, page_id, revs)
+#   store.setComplete()
+#   wrevs = store.revisions()		# behaves like a read-only list of Revision records
+
+
+#
+# Revision record: page_id, page_name, rev_id, date, user, comment, flags.
+# Reads like the revision dicts it replaces (rev['date'], rev.get('flags')) at a fraction of their size.
+#
+class Revision(object):
+	__slots__ = ('page_id', 'page_name', 'rev_id', 'date', 'user', 'comment', 'flags')
+
+	def __init__(self, page_id, page_name, rev_id, date, user, comment, flags = None):
+		self.page_id = page_id
+		self.page_name = page_name
+		self.rev_id = rev_id
+		self.date = date
+		self.user = user
+		self.comment = comment
+		self.flags = flags
+
+	def __getitem__(self, key):
+		if key not in Revision.__slots__:
+			raise KeyError(key)
+		return getattr(self, key)
+
+	def get(self, key, default = None):
+		if key not in Revision.__slots__:
+			return default
+		return getattr(self, key)
+
+	def __repr__(self):
+		return repr(dict((key, getattr(self, key)) for key in Revision.__slots__))
+
+
+# Page names and users repeat across revisions: keep one copy of each.
+# (The builtin intern() only takes byte strings.)
+def _intern(strings, s):
+	return strings.setdefault(s, s)
+
+
+#
+# Merges revision lists pickled by older versions (.wrevs) into history order.
+# Those lists hold each page's revisions in one run, in the order Wikidot listed them,
+# and were sorted by date only, so the position in the list breaks ties, as the stable sort did.
+# Each run is ordered on its own and the runs are merged through a heap, instead of sorting everything at once.
+# Returns a list of Revision records.
+#
+def mergeRevisions(revs):
+	runs = []
+	strings = {}
+	for pos, rev in enumerate(revs):
+		if (not runs) or (runs[-1][-1][1].page_name != rev['page_name']):
+			runs.append([])
+		runs[-1].append(((rev['date'], pos), Revision(rev['page_id'], _intern(strings, rev['page_name']),
+			rev['rev_id'], rev['date'], _intern(strings, rev['user']), rev['comment'], rev.get('flags'))))
+	for run in runs:
+		run.sort() # newest first as listed, mostly just reversed; keys are unique so records are never compared
+	return [rev for (key, rev) in heapq.merge(*runs)]
+
+
+class RevisionStore:
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(filename, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.executescript("""
+			CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+			CREATE TABLE IF NOT EXISTS pages (name TEXT PRIMARY KEY, page_id INTEGER);
+			CREATE TABLE IF NOT EXISTS revs (
+				rev_id INTEGER PRIMARY KEY,
+				page_id INTEGER,
+				page_name TEXT,
+				date INTEGER,
+				user TEXT,
+				comment TEXT,
+				flags TEXT
+			);
+			CREATE INDEX IF NOT EXISTS revs_order ON revs (date, rev_id);
+			CREATE TABLE IF NOT EXISTS files (
+				rev_id INTEGER,
+				page_name TEXT,
+				name TEXT,
+				url TEXT,
+				sha1 TEXT,
+				size INTEGER,
+				PRIMARY KEY (rev_id, name)
+			);
+		""")
+		columns = [row[1] for row in self.db.execute('PRAGMA table_info(revs)')]
+		if 'flags' not in columns: # list started by an older version
+			self.db.execute('ALTER TABLE revs ADD COLUMN flags TEXT')
+		self.db.commit()
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+	def getMeta(self, key, default = None):
+		with self.lock:
+			row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		return row[0] if row else default
+
+	def setMeta(self, key, value):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+			self.db.commit()
+
+	# The list is complete when all pages have been recorded
+	def isComplete(self):
+		return bool(self.getMeta('complete', False))
+
+	def setComplete(self):
+		self.setMeta('complete', 1)
+
+	def hasPage(self, name):
+		with self.lock:
+			return self.db.execute('SELECT 1 FROM pages WHERE name = ?', (name,)).fetchone() is not None
+
+	def pageCount(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+	# Records a page with all its revisions (as returned by Wikidot.get_revisions) at once,
+	# and the files to commit with them: (rev_id, file name, url)
+	def addPage(self, name, page_id, revs, files = ()):
+		with self.lock:
+			self.db.executemany('INSERT OR REPLACE INTO revs (rev_id, page_id, page_name, date, user, comment, flags) VALUES (?, ?, ?, ?, ?, ?, ?)',
+				[(int(rev['id']), page_id, name, rev['date'], rev['user'], rev['comment'], rev.get('flags')) for rev in revs])
+			self.db.executemany('INSERT OR REPLACE INTO files (rev_id, page_name, name, url) VALUES (?, ?, ?, ?)',
+				[(int(rev_id), name, fname, url) for (rev_id, fname, url) in files])
+			self.db.execute('INSERT OR REPLACE INTO pages (name, page_id) VALUES (?, ?)', (name, page_id))
+			self.db.commit()
+
+	# Adds all pages, revisions and files recorded in another store file, e.g. another shard of the site
+	def mergeFrom(self, filename):
+		with self.lock:
+			self.db.execute('ATTACH DATABASE ? AS other', (filename,))
+			try:
+				self.db.execute('INSERT OR REPLACE INTO pages (name, page_id) SELECT name, page_id FROM other.pages')
+				self.db.execute('INSERT OR REPLACE INTO revs (rev_id, page_id, page_name, date, user, comment, flags) '
+					'SELECT rev_id, page_id, page_name, date, user, comment, flags FROM other.revs')
+				self.db.execute('INSERT OR REPLACE INTO files (rev_id, page_name, name, url, sha1, size) '
+					'SELECT rev_id, page_name, name, url, sha1, size FROM other.files')
+				self.db.commit()
+			finally:
+				self.db.execute('DETACH DATABASE other')
+
+	def count(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM revs').fetchone()[0]
+
+	# Each page's last revision and revision count: [(page_id, page_name, rev_id, date, count)]
+	def pageSummaries(self):
+		with self.lock:
+			# Revision IDs only grow, and all revisions of a page have its name atm
+			return self.db.execute('SELECT page_id, page_name, MAX(rev_id), MAX(date), COUNT(*) FROM revs GROUP BY page_id').fetchall()
+
+	# Reads `limit` revisions in history order, starting at position `offset`,
+	# or right after the (date, rev_id) key `after` if given (much faster).
+	# Page names and users are shared through `strings`, if given.
+	def readRevisions(self, offset, limit, after = None, strings = None):
+		query = 'SELECT page_id, page_name, rev_id, date, user, comment, flags FROM revs '
+		if after is not None:
+			query += 'WHERE date > ? OR (date = ? AND rev_id > ?) ORDER BY date, rev_id LIMIT ?'
+			params = (after[0], after[0], after[1], limit)
+		else:
+			query += 'ORDER BY date, rev_id LIMIT ? OFFSET ?'
+			params = (limit, offset)
+		with self.lock:
+			rows = self.db.execute(query, params).fetchall()
+		if strings is None:
+			strings = {}
+		return [Revision(row[0], _intern(strings, row[1]), str(row[2]), row[3], _intern(strings, row[4]), row[5], row[6])
+			for row in rows]
+
+	# Files to commit, in history order: dicts with 'rev_id', 'date' (of the revision), 'page_name', 'name', 'url',
+	# and 'sha1', 'size' once downloaded (else None)
+	def files(self):
+		with self.lock:
+			rows = self.db.execute('SELECT files.rev_id, files.page_name, name, url, sha1, size, revs.date FROM files '
+				'JOIN revs ON revs.rev_id = files.rev_id ORDER BY revs.date, files.rev_id').fetchall()
+		return [{
+		  'rev_id' : str(row[0]),
+		  'page_name' : row[1],
+		  'name' : row[2],
+		  'url' : row[3],
+		  'sha1' : row[4],
+		  'size' : row[5],
+		  'date' : row[6],
+		} for row in rows]
+
+	def setFileBlob(self, rev_id, name, sha1, size):
+		with self.lock:
+			self.db.execute('UPDATE files SET sha1 = ?, size = ? WHERE rev_id = ? AND name = ?', (sha1, size, int(rev_id), name))
+			self.db.commit()
+
+	def revisions(self, chunk = 1000):
+		return RevisionList(self, chunk)
+
+
+#
+# Read-only list view of the revisions in a RevisionStore, in history order.
+# Keeps a few chunks around the positions being accessed.
+#
+class RevisionList:
+	def __init__(self, store, chunk = 1000):
+		self.store = store
+		self.chunk = chunk
+		self.length = store.count()
+		self.chunks = {}		# chunk number -> list of revisions
+		self.strings = {}		# shared page names and users
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += self.length
+		if (index < 0) or (index >= self.length):
+			raise IndexError("revision index out of range")
+		k = index // self.chunk
+		with self.lock:
+			revs = self.chunks.get(k)
+			if revs is None:
+				revs = self._load(k)
+		return revs[index - k * self.chunk]
+
+	def _load(self, k):
+		prev = self.chunks.get(k - 1)
+		if prev:
+			# Continue right after the previous chunk
+			after = (prev[-1]['date'], int(prev[-1]['rev_id']))
+			revs = self.store.readRevisions(None, self.chunk, after, self.strings)
+		else:
+			revs = self.store.readRevisions(k * self.chunk, self.chunk, strings=self.strings)
+		self.chunks[k] = revs
+		# Only keep a couple of chunks before this one, for readers lagging behind
+		for old in self.chunks.keys():
+			if (old < k - 2) or (old > k + 2):
+				del self.chunks[old]
+		return revs
+
+	def __iter__(self):
+		for index in xrange(self.length):
+			yield self[index]
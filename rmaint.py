@@ -1,23 +1,52 @@
 import os
-import codecs
-from mercurial import commands, ui, hg
-import hgpatch
 import cPickle as pickle
+import collections
+import time
+import datetime
+import threading
+import Queue
 import wikidot
+from prefetch import Prefetcher
+from backends import makeBackend
+from revstore import RevisionStore, mergeRevisions
+from journal import StateJournal
+from metrics import Metrics
+from blobstore import BlobStore
+from asyncwd import AsyncWikidot
+from shard import inShard
+from pageindex import PageIndex
 
 # Repository builder and maintainer
 # Contains logic for actual loading and maintaining the repository over the course of its construction.
 
 # Usage:
 #   rm = RepoMaintainer(wikidot, path)
-#   rm.buildRevisionList(pages, depth)
+#   since = rm.lastDumpDate()			# None unless updating a finished dump
+#   rm.buildRevisionList(pages, depth, since)
 #   rm.openRepo()
 #   while rm.commitNext():
 #		pass
 #   rm.cleanup()
+#
+# Checking a finished dump against the site:
+#   report = rm.verify()
 
 # Talkative.
 
+
+# Wikidot's revision comments for file changes, e.g. 'Uploaded file "logo.png".'
+# Returns ('upload' or 'delete', file name), or None for other comments.
+def fileChange(comment):
+	for prefix, change in (('Uploaded file "', 'upload'), ('Deleted file "', 'delete')):
+		if comment.startswith(prefix) and comment.endswith('".'):
+			return (change, comment[len(prefix):-2])
+	return None
+
+# Where files attached to pages go in the repository: by the page's name at the revision, like the page itself
+def attachedFileName(unixname, name):
+	return 'files/'+unixname+'/'+name
+
+
 class RepoMaintainer:
 	def __init__(self, wikidot, path):
 		# Settings
@@ -25,71 +54,291 @@ class RepoMaintainer:
 		self.path = path			# Path to repository
 		self.debug = False			# = True to enable more printing
 		self.storeRevIds = True		# = True to store .revid with each commit
+		self.lookahead = 0			# Prefetch data for this many upcoming revisions (0 = fetch inline)
+		self.fetchWorkers = 2		# Number of prefetching threads
+		self.engine = 'commands'	# Commit backend, see backends.makeBackend
+		self.commitBatch = 100		# Commits per transaction, for backends which batch them
+		self.planFetches = True		# Only fetch what revision flags say has changed
+		self.listFilter = {}		# ListPagesModule selectors limiting which pages to dump (category, created_at, updated_at)
+		self.fetchFiles = True		# Also download files attached to pages, see planFiles
+		self.listWorkers = 4		# Number of threads querying pages while building the revision list
+		self.pageRetries = 2		# Query pages which failed this many more times before giving up
+		self.shard = None			# (i, n): only dump the i-th of n shares of the pages, see shard.py
+		self.fileWorkers = 4		# Number of threads downloading files
+		self.sourceCacheSize = 1000	# Keep sources of this many recently committed pages in memory
+		self.output = None			# Where to write the history, for backends which stream it
+		self.metrics = getattr(wikidot, 'metrics', None) or Metrics()	# Stage timings, shared with the Wikidot instance
+		self.progressInterval = 10	# Print progress and export metrics every this many seconds
+		self.metricsFile = None		# Export metrics to this file, if set
+		self.metricsFormat = 'json'	# 'json': append a JSON line each time, 'prometheus': replace a Prometheus text file
 		
 		# Internal state
 		self.wrevs = None			# Compiled wikidot revision list (history)
+		self.store = None			# On-disk store behind wrevs
+		self.page_ids = None		# Cached page unix name -> page ID map, kept across runs
+		self.page_ids_listed = False	# page_ids has been refreshed from the site in this run
+		self.page_ids_lock = threading.Lock()	# Pages are queried on several threads
+		self.since = None			# When updating an existing dump: time of its last revision
 		
 		self.rev_no	= 0				# Next revision to process
 		self.last_names = {}		# Tracks page renames: name atm -> last name in repo
 		self.last_parents = {}		# Tracks page parent names: name atm -> last parent in repo
+		self.last_titles = {}		# Tracks page titles: name atm -> last title in repo (not saved between runs)
+		self.children = {}			# Reverse of last_parents: parent name -> set of names atm of its children
+		self.sources = collections.OrderedDict()	# name atm -> last source, for recently committed pages
+		self.journal = None			# Construction state journal
+		self.changed_names = {}		# Changes to last_names and last_parents not yet in the journal
+		self.changed_parents = {}
+		self.skipped_requests = 0	# Requests saved by fetch planning
+		self.failed_files = 0		# Files which couldn't be downloaded
+		self.blobs = None			# Downloaded files, see blobstore.py
+		self.downloader = None		# Download thread pool
+		self.downloads = None		# rev_id -> [(file, future of its sha1)] to commit with that revision, once started
 		
-		self.ui = None				# Mercurial UI object
-		self.repo = None			# Mercurial repo object
+		self.backend = None			# Commit backend
+		self.prefetcher = None		# Look-ahead fetcher, if enabled
+		self.progress_start = None	# (time, rev_no) when committing started in this run
+		self.progress_last = 0		# Last time progress was reported
 
 
 	#
-	# Saves and loads revision list from file
+	# Loads revision list pickled by older versions, in the same order they had it
 	#
-	def saveWRevs(self):
-		fp = open(self.path+'\\.wrevs', 'wb')
-		pickle.dump(self.wrevs, fp)
-		fp.close()
-	
 	def loadWRevs(self):
 		fp = open(self.path+'\\.wrevs', 'rb')
-		self.wrevs = pickle.load(fp)
+		revs = pickle.load(fp)
+		fp.close()
+		self.wrevs = mergeRevisions(revs)
+
+	#
+	# Whether there's an aborted dump at the repository destination, to be continued
+	#
+	def isAborted(self):
+		return os.path.isfile(self.path+'\\.wstate') or os.path.isfile(self.path+'\\.wrevs.db') \
+			or os.path.isfile(self.path+'\\.wrevs')
+
+	#
+	# Returns the time of the last revision in a finished dump at the repository destination,
+	# or None if there's none (new dump, or an aborted one which will simply be continued).
+	#
+	def lastDumpDate(self):
+		if self.isAborted():
+			return None
+		if os.path.isfile(self.path+'\\.wlast'):
+			fp = open(self.path+'\\.wlast', 'rb')
+			since = pickle.load(fp)
+			fp.close()
+			return since
+		backend = self.makeBackend()
+		if backend.exists():
+			# Dumped before we started keeping .wlast: trust the commit dates (read without opening the repository)
+			return backend.lastDate()
+		return None
+
+	#
+	# Resolves page ID for a page name.
+	# IDs for all pages are listed in bulk on the first cache miss; each page is only loaded
+	# to get its ID if it's still missing after that.
+	# Thread-safe.
+	#
+	def getPageId(self, page):
+		with self.page_ids_lock:
+			if self.page_ids is None:
+				self.loadPageIds()
+			page_id = self.page_ids.get(page)
+			if (page_id is None) and not self.page_ids_listed:
+				print "Listing page IDs..."
+				self.page_ids.update(self.wd.list_page_ids())
+				self.page_ids_listed = True
+				self.savePageIds()
+				page_id = self.page_ids.get(page)
+		if page_id is None:
+			page_id = self.wd.get_page_id(page)
+			if page_id is not None:
+				with self.page_ids_lock:
+					self.page_ids[page] = page_id
+					self.savePageIds()
+		return page_id
+
+	#
+	# Yields names of all pages on the site as the listing arrives, oldest first
+	# (so pages created meanwhile don't shift the rest between list pages).
+	# Their IDs come along and go to the page ID cache.
+	#
+	def listPages(self):
+		with self.page_ids_lock:
+			if self.page_ids is None:
+				self.loadPageIds()
+			self.page_ids_listed = True
+		for page, page_id in self.wd.iter_page_ids(order='dateCreatedAsc', **self.listFilter):
+			if page_id is not None:
+				with self.page_ids_lock:
+					self.page_ids[page] = page_id
+			yield page
+		with self.page_ids_lock:
+			self.savePageIds()
+
+	def loadPageIds(self):
+		self.page_ids = {}
+		if os.path.isfile(self.path+'\\.wpageids'):
+			fp = open(self.path+'\\.wpageids', 'rb')
+			self.page_ids = pickle.load(fp)
+			fp.close()
+
+	def savePageIds(self):
+		fp = open(self.path+'\\.wpageids', 'wb')
+		pickle.dump(self.page_ids, fp)
 		fp.close()
 
+	def makeBackend(self):
+		return makeBackend(self.engine, self.path, self.commitBatch, self.output)
+
 	#
 	# Compiles a combined revision list for a given set of pages, or all pages on the site.
 	#  pages: compile history for these pages
 	#  depth: download at most this number of revisions.
+	#  since: only include revisions made after this time (to update an existing dump)
 	#
-	# If there exists a cached revision list at the repository destination,
-	# it is loaded and no requests are made.
+	# Pages are recorded in the revision store at the repository destination as soon as they're queried.
+	# If the list there is complete, it is used and no requests are made;
+	# if it's partial, only the pages not yet in it are queried.
 	#
-	def buildRevisionList(self, pages = None, depth = 10000):
+	# Pages are queried by listWorkers threads at once (all under the Wikidot instance's rate limits),
+	# and recorded in whatever order they finish: the store keeps the history in (date, rev_id) order regardless.
+	# Pages which fail are retried after the rest; if some still fail, the list is left incomplete
+	# and we stop, so that the next run queries just those.
+	#
+	def buildRevisionList(self, pages = None, depth = 10000, since = None):
 		if os.path.isfile(self.path+'\\.wrevs'):
 			print "Loading cached revision list..."
 			self.loadWRevs()
+			self.since = since
+			self.printRevisionList()
+			return
+
+		self.store = RevisionStore(self.path+'\\.wrevs.db')
+		if self.store.isComplete():
+			print "Loading cached revision list..."
 		else:
-			print "Building revision list..."
-			if not pages:
-				pages = self.wd.list_pages(10000)
-			self.wrevs = []
-			for page in pages:
-				print "Querying page: "+page
-				page_id = self.wd.get_page_id(page)
-				print "ID: "+str(page_id)
-				revs = self.wd.get_revisions(page_id, depth)
-				print "Revisions: "+str(len(revs))
-				for rev in revs:
-					self.wrevs.append({
-					  'page_id' : page_id,
-					  'page_name' : page, # name atm, not at revision time
-					  'rev_id' : rev['id'],
-					  'date' : rev['date'],
-					  'user' : rev['user'],
-					  'comment' : rev['comment'],
-					})
-			self.saveWRevs() # Save a cached copy
+			if self.store.getMeta('started'):
+				print "Continuing building revision list..."
+				since = self.store.getMeta('since') # same as when we started
+			else:
+				print "Building revision list..."
+				self.store.setMeta('since', since)
+				self.store.setMeta('all_pages', int(not pages and not self.listFilter and not self.shard)) # see updatePageIndex
+				self.store.setMeta('started', 1)
+			if not pages and since:
+				# Only pages edited after the last dump can have new revisions
+				pages = [name for (name, edited) in self.wd.list_pages_edited_since(since, **self.listFilter)]
+				print "Pages edited since last dump: "+str(len(pages))
+			elif not pages:
+				pages = self.listPages() # revisions are queried while the listing is still arriving
+			if self.shard:
+				pages = (page for page in pages if inShard(page, self.shard))
+			failed = self.queryPages(pages, depth, since)
+			for attempt in range(self.pageRetries):
+				if not failed:
+					break
+				print "Retrying "+str(len(failed))+" failed pages..."
+				failed = self.queryPages(failed, depth, since)
+			if failed:
+				raise Exception("Cannot query "+str(len(failed))+" pages ("+", ".join(failed[:10])
+					+(", ..." if len(failed) > 10 else "")+"), run again to retry them")
+			self.store.setComplete()
 			print ""
 		
-		
+		self.since = self.store.getMeta('since')
+		self.wrevs = self.store.revisions() # in history order
+		self.printRevisionList()
+
+	#
+	# Queries pages on listWorkers threads and records them in the store as they're done.
+	# Pages already in the store are skipped. Returns the names of pages which failed.
+	#
+	def queryPages(self, pages, depth, since):
+		pool = AsyncWikidot(self.wd, max(self.listWorkers, 1))
+		done = Queue.Queue()
+		failed = []
+		pending = 0
+		try:
+			for page in pages:
+				if self.store.hasPage(page):
+					continue # queried before we were interrupted
+				future = pool.submit(self.queryPage, page, depth, since)
+				future.add_done_callback(lambda future, page=page: done.put((page, future)))
+				pending += 1
+				# Record what's done, and don't run too far ahead of the workers
+				while pending and ((pending >= 4 * pool.concurrency) or not done.empty()):
+					self.recordPage(done, failed)
+					pending -= 1
+			while pending:
+				self.recordPage(done, failed)
+				pending -= 1
+		finally:
+			pool.close()
+		return failed
+
+	# Returns (page_id, revisions, files) for a page, see planFiles. Runs on listing threads.
+	def queryPage(self, page, depth, since):
+		page_id = self.getPageId(page)
+		revs = self.wd.get_revisions(page_id, depth)
+		if since:
+			revs = [rev for rev in revs if rev['date'] > since]
+		files = self.planFiles(page_id, revs, since) if self.fetchFiles else []
+		return (page_id, revs, files)
+
+	# Waits for the next page query to finish and records it, or notes it as failed
+	def recordPage(self, done, failed):
+		while True:
+			try:
+				page, future = done.get(True, 1) # in steps, so Ctrl+C gets through
+				break
+			except Queue.Empty:
+				pass
+		try:
+			page_id, revs, files = future.result()
+		except Exception as e:
+			print "Cannot query page "+page+": "+str(e)
+			failed.append(page)
+			return
+		print "Queried page: "+page
+		print "ID: "+str(page_id)
+		print "Revisions: "+str(len(revs))
+		if files:
+			print "Files: "+str(len(files))
+		self.store.addPage(page, page_id, revs, files) # page_name is the name atm, not at revision time
+
+	#
+	# Decides which revisions the page's files are committed with. Returns [(rev_id, file name, url)].
+	# Wikidot only keeps the current version of a file, so it goes with the last revision which uploaded it.
+	# Files uploaded before Wikidot started saying so in revision comments go with the page's last revision,
+	# unless we're updating a dump, which has them already.
+	# The files module is only queried for pages with file changes (F flag or comment) in their history.
+	#
+	def planFiles(self, page_id, revs, since):
+		revs = sorted(revs, key=lambda rev: (rev['date'], int(rev['id'])), reverse=True) # newest first
+		uploads = {}
+		touched = False
+		for rev in revs:
+			change = fileChange(rev['comment'])
+			if ('F' in (rev.get('flags') or '')) or change:
+				touched = True
+			if change and (change[0] == 'upload') and (change[1] not in uploads):
+				uploads[change[1]] = rev['id']
+		if not touched:
+			return []
+		planned = []
+		for f in self.wd.get_files(page_id):
+			rev_id = uploads.get(f['name'])
+			if (rev_id is None) and not since:
+				rev_id = revs[0]['id']
+			if rev_id is not None:
+				planned.append((rev_id, f['name'], f['url']))
+		return planned
+
+	def printRevisionList(self):
 		print "Total revisions: "+str(len(self.wrevs))
-		
-		print "Sorting revisions..."
-		self.wrevs.sort(key=lambda rev: rev['date'])
 		print ""
 		
 		if self.debug:
@@ -100,25 +349,136 @@ class RepoMaintainer:
 
 
 	#
-	# Saves and loads operational state from file
+	# Saves and loads operational state from file.
+	# Only changes since the last save are written; see journal.py.
 	#
 	def saveState(self):
-		fp = open(self.path+'\\.wstate', 'wb')
-		pickle.dump(self.rev_no, fp)
+		with self.metrics.timer('state_seconds'):
+			self.saveStateNow()
+
+	def saveStateNow(self):
+		self.journal.append(self.rev_no, self.changed_names, self.changed_parents)
+		self.changed_names = {}
+		self.changed_parents = {}
+		if self.journal.needsCompaction():
+			self.journal.compact(self.rev_no, self.last_names, self.last_parents)
+	
+	def loadState(self):
+		self.rev_no, self.last_names, self.last_parents = self.journal.load()
+
+	#
+	# All changes to rename and parent tracking go through these, to keep the journal and the children index
+	#
+	def setLastName(self, unixname, rev_unixname):
+		if self.last_names.get(unixname) != rev_unixname:
+			self.last_names[unixname] = rev_unixname
+			self.changed_names[unixname] = rev_unixname
+
+	def setLastParent(self, unixname, parent_unixname):
+		old_parent = self.last_parents.get(unixname)
+		if old_parent == parent_unixname:
+			return
+		if old_parent is not None:
+			self.children[old_parent].discard(unixname)
+		self.last_parents[unixname] = parent_unixname
+		self.children.setdefault(parent_unixname, set()).add(unixname)
+		self.changed_parents[unixname] = parent_unixname
+
+	def buildChildrenIndex(self):
+		self.children = {}
+		for child, parent in self.last_parents.items():
+			self.children.setdefault(parent, set()).add(child)
+
+
+	#
+	# Saves and loads the final state of a finished dump, to continue from it on the next update
+	#
+	def saveLastState(self):
+		last_date = self.wrevs[-1]['date'] if self.wrevs else self.since
+		if last_date is None and self.backend is not None:
+			last_date = self.backend.lastDate()
+		fp = open(self.path+'\\.wlast', 'wb')
+		pickle.dump(last_date, fp)
 		pickle.dump(self.last_names, fp)
 		pickle.dump(self.last_parents, fp)
 		fp.close()
-	
-	def loadState(self):
-		fp = open(self.path+'\\.wstate', 'rb')
-		self.rev_no = pickle.load(fp)
+
+	#
+	# Brings the page index (see pageindex.py) up to date with the pages just committed.
+	# Edit times and revision counts are what we committed; verify() replaces them with what the site lists
+	# the first time it sees a page. An update adds to what the index had of a page.
+	# The index is complete (knows all pages of the dump) after a dump of the whole site, and stays so with updates.
+	#
+	def updatePageIndex(self):
+		index = PageIndex(self.path+'\\.wpages.db')
+		known = index.pages() if self.since else {}
+		rows = []
+		for page_id, page_name, rev_id, date, count in self.store.pageSummaries():
+			old = known.get(page_id)
+			if old and (old['revisions'] is not None):
+				count += old['revisions']
+			rows.append((page_id, page_name, rev_id, date, count))
+		index.putMany(rows)
+		if not self.since and self.store.getMeta('all_pages'):
+			index.setMeta('complete', 1)
+		index.close()
+
+	def loadLastState(self):
+		fp = open(self.path+'\\.wlast', 'rb')
+		pickle.load(fp) # last date, see lastDumpDate()
 		self.last_names = pickle.load(fp)
-		try:
-			self.last_parents = pickle.load(fp)
-		except EOFError:
-			pass
+		self.last_parents = pickle.load(fp)
 		fp.close()
 
+	#
+	# Reconstructs rename/parent tracking from page files when there's no saved state.
+	# Page names atm are assumed to be the same as in the repo.
+	# Read through the backend: archives keep their page files in the index, not on disk.
+	#
+	def scanLastState(self):
+		for fname in self.backend.listFiles(''):
+			if ('/' in fname) or not fname.endswith('.txt'): continue
+			unixname = fname[:-4]
+			self.last_names[unixname] = unixname
+			for line in self.backend.readFile(fname).splitlines():
+				if line.startswith('parent:'):
+					self.last_parents[unixname] = line[7:]
+				elif not line.startswith('title:'):
+					break # header is over
+
+	#
+	# When updating: rename and parent tracking is by page names atm, as they were at the last dump.
+	# Pages renamed since then would be taken for new ones, leaving their old files and children behind.
+	# Moves their tracking to the names they have now, so the rename revision renames the file and updates the children.
+	# Old names come from the page index (by page ID), or for dumps made before there was one, from the page ID cache.
+	#
+	def followRenames(self):
+		if not self.store:
+			return
+		index = PageIndex(self.path+'\\.wpages.db')
+		known = index.pages()
+		index.close()
+		with self.page_ids_lock:
+			if self.page_ids is None:
+				self.loadPageIds()
+			cached = {}
+			for name, page_id in self.page_ids.items():
+				if name in self.last_names:
+					cached.setdefault(page_id, []).append(name)
+		for page_id, page_name, rev_id, date, count in self.store.pageSummaries():
+			if page_name in self.last_names:
+				continue # tracked under this name already
+			if page_id in known:
+				old_names = [known[page_id]['unixname']]
+			else:
+				old_names = cached.get(page_id, [])
+			old_names = [name for name in old_names if (name != page_name) and (name in self.last_names)]
+			if len(old_names) != 1:
+				continue # new, or we can't tell
+			print "Renamed since last dump: "+old_names[0]+" -> "+page_name
+			self.last_names[page_name] = self.last_names.pop(old_names[0])
+			if old_names[0] in self.last_parents:
+				self.last_parents[page_name] = self.last_parents.pop(old_names[0])
 
 	#
 	# Initializes the construction process, after the revision list has been compiled.
@@ -127,28 +487,249 @@ class RepoMaintainer:
 	#
 	def openRepo(self):
 		# Create a new repository or continue from aborted dump
-		self.ui=ui.ui()
+		self.backend = self.makeBackend()
+		self.journal = StateJournal(self.path+'\\.wstate', self.path+'\\.wjournal')
 		self.last_names = {} # Tracks page renames: name atm -> last name in repo
 		self.last_parents = {} # Tracks page parent names: name atm -> last parent in repo
 		
-		if os.path.isfile(self.path+'\\.wstate'):
+		if self.journal.exists():
 			print "Continuing from aborted dump state..."
 			self.loadState()
-			self.repo = hg.repository(self.ui, self.path)
+			self.backend.open(False)
+		
+		elif self.backend.exists(): # a finished dump, append new revisions to it
+			print "Updating existing repository..."
+			self.backend.open(False)
+			self.rev_no = 0
+			if os.path.isfile(self.path+'\\.wlast'):
+				self.loadLastState()
+			else:
+				self.scanLastState()
+			self.followRenames()
 		
-		else: # create a new repository (will fail if one exists)
+		else: # create a new repository
 			print "Initializing repository..."
-			commands.init(self.ui, self.path)
-			self.repo = hg.repository(self.ui, self.path)
+			self.backend.open(True)
 			self.rev_no = 0
 			
 			if self.storeRevIds:
 				# Add revision id file to the new repo
-				fname = self.path+'\\.revid'
-				codecs.open(fname, "w", "UTF-8").close()
-				commands.add(self.ui, self.repo, str(fname))
+				self.backend.writeFile('.revid', '')
+				self.backend.addFile('.revid')
+		
+		self.buildChildrenIndex()
+		self.journal.compact(self.rev_no, self.last_names, self.last_parents) # start a fresh journal
+		self.progress_start = (time.time(), self.rev_no)
+		self.progress_last = time.time()
 	
 	
+	#
+	# Fetches the data needed to commit a revision. Returns (source, details).
+	# May be called from prefetching threads, so must not touch the construction state.
+	#
+	# Wikidot flags the kinds of changes made in each revision:
+	#   N new page, S source, T title, R rename, A tags, M metadata (e.g. parent), F files
+	# If we have the flags, we only fetch what the revision could have changed and return None for the rest;
+	# completeRevision() fills that in from the page's last state.
+	#
+	def fetchRevision(self, rev):
+		flags = rev.get('flags') if self.planFetches else None
+		source = None
+		details = None
+		if (not flags) or ('N' in flags) or ('S' in flags):
+			source = self.wd.get_revision_source(rev['rev_id'])
+		if (not flags) or ('N' in flags) or ('T' in flags) or ('R' in flags):
+			# Page title and unix_name changes are only available through another request:
+			details = self.wd.get_revision_version(rev['rev_id'], content=False)
+		return (source, details)
+
+	#
+	# Fills in the data fetchRevision() skipped from the page's last state.
+	# If we don't know it (e.g. the first time we see the page after a restart), fetches it now.
+	#
+	def completeRevision(self, rev, source, details):
+		unixname = rev['page_name']
+		if details is None:
+			if (unixname in self.last_names) and (unixname in self.last_titles):
+				details = {
+				  'rev_id': rev['rev_id'],
+				  'unixname': self.last_names[unixname],
+				  'title': self.last_titles[unixname],
+				  'content': None,
+				}
+				self.skipped_requests += 1
+			else:
+				details = self.wd.get_revision_version(rev['rev_id'], content=False)
+		if source is None:
+			source = self.lastSource(unixname)
+			if source is None:
+				source = self.wd.get_revision_source(rev['rev_id'])
+			else:
+				self.skipped_requests += 1
+		self.last_titles[unixname] = details['title']
+		return (source, details)
+
+	#
+	# Returns the source of the page as last committed (without our header), or None if not known.
+	#
+	def lastSource(self, unixname):
+		if unixname in self.sources:
+			return self.sources[unixname]
+		if (unixname not in self.last_names) or (unixname not in self.last_titles):
+			return None # we can't tell how the header looks
+		try:
+			lines = self.backend.readFile(self.last_names[unixname]+'.txt').splitlines(True)
+		except IOError:
+			return None
+		if self.last_titles[unixname]:
+			if not lines or not lines[0].startswith('title:'): return None
+			lines = lines[1:]
+		if self.last_parents.get(unixname):
+			if not lines or not lines[0].startswith('parent:'): return None
+			lines = lines[1:]
+		return ''.join(lines)
+
+	# Remembers the last committed source of the page, dropping the least recently committed ones
+	def rememberSource(self, unixname, source):
+		self.sources.pop(unixname, None)
+		if self.sourceCacheSize <= 0:
+			return
+		self.sources[unixname] = source
+		while len(self.sources) > self.sourceCacheSize:
+			self.sources.popitem(last=False)
+
+	# Page file contents: our header followed by the source
+	def pageContent(self, title, parent_unixname, source):
+		content = ''
+		if title:
+			content += 'title:'+title+'\n'
+		if parent_unixname:
+			content += 'parent:'+parent_unixname+'\n'
+		return content + source
+
+	#
+	# Starts downloading files to commit, in the order they're going to be needed.
+	# Downloads run on their own threads, limited by Wikidot.file_delay rather than the page request budget,
+	# and are streamed into a content-addressed blob store, so a file attached to several pages is kept once.
+	#
+	def startDownloads(self):
+		self.downloads = {}
+		if (not self.store) or (self.rev_no >= len(self.wrevs)):
+			return
+		first = self.wrevs[self.rev_no]
+		files = [f for f in self.store.files()
+			if (f['date'], int(f['rev_id'])) >= (first['date'], int(first['rev_id']))] # the rest is committed already
+		if not files:
+			return
+		print "Files to download: "+str(len(files))
+		self.blobs = BlobStore(self.path+'\\.wblobs')
+		self.downloader = AsyncWikidot(self.wd, self.fileWorkers)
+		for f in files:
+			if f['sha1'] and self.blobs.has(f['sha1']):
+				future = None # downloaded before we were interrupted
+			else:
+				future = self.downloader.submit(self.downloadFile, f)
+			self.downloads.setdefault(f['rev_id'], []).append((f, future))
+
+	# Downloads a file into the blob store. Runs on download threads. Returns its SHA-1.
+	def downloadFile(self, f):
+		sha1, size = self.blobs.store(lambda fp: self.wd.download_file(f['url'], fp))
+		self.store.setFileBlob(f['rev_id'], f['name'], sha1, size)
+		return sha1
+
+	# Moves the page's attached files along when it's renamed, see attachedFileName
+	def renameAttachedFiles(self, oldunixname, newunixname):
+		oldprefix = attachedFileName(oldunixname, '')
+		for fname in self.backend.listFiles(oldprefix):
+			fname = fname.decode('utf-8')
+			self.backend.renameFile(fname, attachedFileName(newunixname, fname[len(oldprefix):]))
+
+	#
+	# Writes out the files which go with the revision, waiting for their downloads if needed.
+	# Files which couldn't be downloaded are left out, with a warning.
+	#
+	def writeFiles(self, rev, rev_unixname):
+		for f, future in self.downloads.pop(rev['rev_id'], ()):
+			try:
+				sha1 = future.result() if future else f['sha1']
+			except Exception as e:
+				print "Cannot download "+f['url']+", skipping: "+str(e)
+				self.failed_files += 1
+				continue
+			self.backend.writeBinaryFile(attachedFileName(rev_unixname, f['name']), self.blobs.blobPath(sha1))
+		change = fileChange(rev['comment'])
+		if change and (change[0] == 'delete'):
+			self.backend.removeFile(attachedFileName(rev_unixname, change[1]))
+
+	#
+	# For sharded dumps: instead of committing, fetches what each revision needs into the bundle (see shard.py),
+	# as commitNext would. The revision list and files are already in the bundle, this adds the files' contents.
+	# Each page's first revision gets everything fetched: when the bundles are merged, nothing is known
+	# about the page before it, just like when dumping in one go.
+	# Continues where it stopped if interrupted.
+	#
+	def fillBundle(self, bundle):
+		first = set() # rev_ids of each page's first revision
+		seen = set()
+		for rev in self.wrevs:
+			if rev['page_name'] not in seen:
+				seen.add(rev['page_name'])
+				first.add(rev['rev_id'])
+		
+		def fetch(idx):
+			rev = self.wrevs[idx]
+			if bundle.hasRevision(rev['rev_id']):
+				return # fetched before we were interrupted
+			source, details = self.fetchRevision(rev)
+			if rev['rev_id'] in first:
+				if source is None:
+					source = self.wd.get_revision_source(rev['rev_id'])
+				if details is None:
+					details = self.wd.get_revision_version(rev['rev_id'], content=False)
+			bundle.putRevision(rev, source, details)
+		
+		self.progress_start = (time.time(), 0)
+		prefetcher = Prefetcher(fetch, len(self.wrevs), max(self.lookahead, 1), self.fetchWorkers)
+		try:
+			for idx in xrange(len(self.wrevs)):
+				with self.metrics.timer('fetch_seconds'):
+					prefetcher.get(idx)
+				self.rev_no = idx + 1
+				self.reportProgress()
+		finally:
+			prefetcher.stop()
+		
+		files = [f for f in self.store.files() if not (f['sha1'] and bundle.blobs.has(f['sha1']))]
+		if self.fetchFiles and files:
+			print "Downloading "+str(len(files))+" files..."
+			pool = AsyncWikidot(self.wd, self.fileWorkers)
+			try:
+				futures = [(f, pool.submit(bundle.blobs.store, lambda fp, url=f['url']: self.wd.download_file(url, fp))) for f in files]
+				for f, future in futures:
+					try:
+						sha1, size = future.result()
+					except Exception as e:
+						print "Cannot download "+f['url']+", skipping: "+str(e)
+						self.failed_files += 1
+						continue
+					self.store.setFileBlob(f['rev_id'], f['name'], sha1, size)
+			finally:
+				pool.close()
+		
+		self.reportProgress(True)
+		self.store.close() # the bundle is complete on disk now
+		self.store = None
+		bundle.setComplete()
+
+	# Returns fetched data for the revision #rev_no, through the prefetcher if enabled.
+	def fetchRevisionNo(self, rev_no):
+		if self.lookahead <= 0:
+			return self.fetchRevision(self.wrevs[rev_no])
+		if self.prefetcher is None:
+			self.prefetcher = Prefetcher(lambda idx: self.fetchRevision(self.wrevs[idx]),
+				len(self.wrevs), self.lookahead, self.fetchWorkers)
+		return self.prefetcher.get(rev_no)
+
 	#
 	# Takes an unprocessed revision from a revision log, fetches its data and commits it.
 	# Returns false if no unprocessed revisions remain.
@@ -158,17 +739,11 @@ class RepoMaintainer:
 			return False
 			
 		rev = self.wrevs[self.rev_no]
-		source = self.wd.get_revision_source(rev['rev_id'])
-		# Page title and unix_name changes are only available through another request:
-		details = self.wd.get_revision_version(rev['rev_id'])
-		
-		# Store revision_id for last commit
-		# Without this, empty commits (e.g. file uploads) will be skipped by Mercurial
-		if self.storeRevIds:
-			fname = self.path+'\\.revid'
-			outp = codecs.open(fname, "w", "UTF-8")
-			outp.write(rev['rev_id']) # rev_ids are unique amongst all pages, and only one page changes in each commit anyway
-			outp.close()
+		if self.fetchFiles and (self.downloads is None):
+			self.startDownloads()
+		with self.metrics.timer('fetch_seconds'):
+			source, details = self.fetchRevisionNo(self.rev_no)
+			source, details = self.completeRevision(rev, source, details)
 		
 		unixname = rev['page_name']
 		rev_unixname = details['unixname'] # may be different in revision than atm
@@ -178,7 +753,7 @@ class RepoMaintainer:
 		if rev['comment'].startswith('Parent page set to: "'):
 			# This is a parenting revision, remember the new parent
 			parent_unixname = rev['comment'][21:-2]
-			self.last_parents[unixname] = parent_unixname
+			self.setLastParent(unixname, parent_unixname)
 		else:
 			# Else use last parent_unixname we've recorded
 			parent_unixname =  self.last_parents[unixname] if unixname in self.last_parents else None
@@ -187,24 +762,30 @@ class RepoMaintainer:
 		# If the page is tracked and its name just changed, tell HG
 		rename = (unixname in self.last_names) and (self.last_names[unixname] <> rev_unixname)
 		if rename:
-			self.updateChildren(self.last_names[unixname], rev_unixname) # Update children which reference us -- see comments there
-			commands.rename(self.ui, self.repo, self.path+'\\'+str(self.last_names[unixname])+'.txt', self.path+'\\'+str(rev_unixname)+'.txt')
+			with self.metrics.timer('write_seconds'):
+				self.updateChildren(self.last_names[unixname], rev_unixname) # Update children which reference us -- see comments there
+				self.backend.renameFile(str(self.last_names[unixname])+'.txt', str(rev_unixname)+'.txt')
+				self.renameAttachedFiles(self.last_names[unixname], rev_unixname)
 		
 		# Ouput contents
-		fname = self.path+'\\'+rev_unixname+'.txt'
-		outp = codecs.open(fname, "w", "UTF-8")
-		if details['title']:
-			outp.write('title:'+details['title']+'\n')
-		if parent_unixname:
-			outp.write('parent:'+parent_unixname+'\n')
-		outp.write(source)
-		outp.close()
-		
-		# Add new page
-		if not unixname in self.last_names: # never before seen
-			commands.add(self.ui, self.repo, str(fname))
+		with self.metrics.timer('write_seconds'):
+			# Store revision_id for last commit
+			# Without this, empty commits (e.g. file uploads) will be skipped by Mercurial
+			if self.storeRevIds:
+				self.backend.writeFile('.revid', rev['rev_id']) # rev_ids are unique amongst all pages, and only one page changes in each commit anyway
+			
+			fname = rev_unixname+'.txt'
+			self.backend.writeFile(fname, self.pageContent(details['title'], parent_unixname, source))
+			self.rememberSource(unixname, source)
+			
+			# Add new page
+			if not unixname in self.last_names: # never before seen
+				self.backend.addFile(str(fname))
+			
+			if self.fetchFiles:
+				self.writeFiles(rev, rev_unixname)
 
-		self.last_names[unixname] = rev_unixname
+		self.setLastName(unixname, rev_unixname)
 
 		# Commit
 		if rev['comment'] <> '':
@@ -216,13 +797,68 @@ class RepoMaintainer:
 		else:
 			commit_date = None
 		print "Commiting: "+str(self.rev_no)+'. '+commit_msg
+		self.backend.setRevision({
+		  'page_id' : rev['page_id'],
+		  'page_name' : unixname,
+		  'rev_id' : rev['rev_id'],
+		  'date' : rev['date'],
+		  'user' : rev['user'],
+		  'comment' : rev['comment'],
+		  'flags' : rev.get('flags'),
+		  'title' : details['title'],
+		  'unixname' : rev_unixname,
+		  'parent' : parent_unixname,
+		  'source' : source,
+		})
 
-		commands.commit(self.ui, self.repo, message=commit_msg, user=rev['user'], date=commit_date)
+		with self.metrics.timer('commit_seconds'):
+			stored = self.backend.commit(commit_msg, rev['user'], commit_date)
 		self.rev_no += 1
+		self.metrics.count('commits_total')
 
-		self.saveState() # Update operation state
+		if stored: # Otherwise the commit might still be lost, and we'll have to redo it
+			self.saveState() # Update operation state
+		self.reportProgress()
 		return True
 
+	#
+	# Every progressInterval seconds (or now, if final): prints throughput, ETA and where the time goes,
+	# and exports metrics if asked to.
+	#
+	def reportProgress(self, final = False):
+		now = time.time()
+		if (not final) and (now - self.progress_last < self.progressInterval):
+			return
+		self.progress_last = now
+		total = len(self.wrevs)
+		started, start_rev_no = self.progress_start or (now, self.rev_no)
+		rate = (self.rev_no - start_rev_no) / (now - started) if now > started else 0.0
+		eta = (total - self.rev_no) / rate if rate > 0 else None
+		self.metrics.gauge('revisions_total', total)
+		self.metrics.gauge('revisions_done', self.rev_no)
+		self.metrics.gauge('commits_per_second', rate)
+		self.metrics.gauge('eta_seconds', eta if eta is not None else -1)
+		
+		requests = self.metrics.total('http_request_seconds')[1]
+		line = "Progress: %d/%d (%.1f%%), %.2f commits/sec, %.2f requests/sec" % (self.rev_no, total,
+			100.0 * self.rev_no / total if total else 100.0, rate, requests / (now - self.metrics.started))
+		if eta is not None:
+			line += ", ETA "+str(datetime.timedelta(seconds=int(eta)))
+		# Which stage the time goes to: network-bound dumps spend it in fetch, Mercurial-bound ones in commit
+		stages = [(stage, self.metrics.total(stage+'_seconds')[0]) for stage in ('fetch', 'write', 'commit', 'state')]
+		spent = sum(seconds for (stage, seconds) in stages)
+		if spent > 0:
+			line += " ["+", ".join("%s %d%%" % (stage, 100 * seconds / spent) for (stage, seconds) in stages)+"]"
+		print line
+		
+		if self.metricsFile:
+			if self.metricsFormat == 'prometheus':
+				self.metrics.writePrometheus(self.metricsFile)
+			else:
+				fp = open(self.metricsFile, 'a')
+				self.metrics.writeJson(fp)
+				fp.close()
+
 
 	#
 	# Updates all children of the page to reflect parent's unixname change.
@@ -232,32 +868,149 @@ class RepoMaintainer:
 	# Wikidot logs no additional changes for child pages, yet they stay linked to the parent.
 	#
 	# Therefore, on every rename we must update all linked children in the same revision.
+	# The children are looked up in self.children, and from then on reference the parent by its new name.
 	#
 	def updateChildren(self, oldunixname, newunixname):
-		for child in self.last_parents.keys():
-			if self.last_parents[child] == oldunixname:
-				self.updateParentField(child, self.last_parents[child], newunixname)
+		for child in list(self.children.get(oldunixname, ())):
+			self.updateParentField(child, oldunixname, newunixname)
+			self.setLastParent(child, newunixname)
 	
 	#
 	# Processes a page file and updates "parent:..." string to reflect a change in parent's unixname.
 	# The rest of the file is preserved.
 	#
 	def updateParentField(self, child_unixname, parent_oldunixname, parent_newunixname):
-		with codecs.open(self.path+'\\'+child_unixname+'.txt', "r", "UTF-8") as f:
-			content = f.readlines()
+		fname = self.last_names.get(child_unixname, child_unixname)+'.txt'
+		if (child_unixname in self.sources) and (child_unixname in self.last_titles):
+			# We know what's in the file, no need to read it back
+			self.backend.writeFile(fname, self.pageContent(self.last_titles[child_unixname], parent_newunixname, self.sources[child_unixname]))
+			return
+		content = self.backend.readFile(fname).splitlines(True)
 		# Since this is all tracked by us, we KNOW there's a line in standard format somewhere
-		idx = content.index('parent:'+parent_oldunixname+'\n')
-		if idx < 0:
+		try:
+			idx = content.index('parent:'+parent_oldunixname+'\n')
+		except ValueError:
 			raise Exception("Cannot update child page "+child_unixname+": "
 				+"it is expected to have parent set to "+parent_oldunixname+", but there seems to be no such record in it.");
 		content[idx] = 'parent:'+parent_newunixname+'\n'
-		with codecs.open(self.path+'\\'+child_unixname+'.txt', "w", "UTF-8") as f:
-			f.writelines(content)
+		self.backend.writeFile(fname, ''.join(content))
 
 
 	#
 	# Finalizes the construction process and deletes any temporary files.
 	#
 	def cleanup(self):
-		os.remove(self.path+'\\.wstate')
-		os.remove(self.path+'\\.wrevs')
\ No newline at end of file
+		if self.prefetcher:
+			self.prefetcher.stop()
+			self.prefetcher = None
+		if self.downloader:
+			self.downloader.close()
+			self.downloader = None
+		if self.failed_files:
+			print "Warning: "+str(self.failed_files)+" files could not be downloaded"
+		with self.metrics.timer('commit_seconds'):
+			self.backend.close()
+		self.reportProgress(True)
+		self.saveLastState() # for the next update
+		self.journal.remove()
+		if self.store:
+			self.updatePageIndex()
+			self.store.close()
+			self.store = None
+			os.remove(self.path+'\\.wrevs.db')
+		else:
+			os.remove(self.path+'\\.wrevs')
+		if self.blobs:
+			self.blobs.remove()
+			self.blobs = None
+
+
+	#
+	# Checks a finished dump against the site. Returns the divergence:
+	#   {'pages': pages listed, 'checked': revision lists fetched,
+	#    'new': [names], 'deleted': [names], 'renamed': [(old name, name)], 'changed': [(name, revisions not in the dump)],
+	#    'failed': [names of pages which couldn't be checked]}
+	#
+	# The listing (a request per list page) tells each page's ID, name, revision count and last edit time,
+	# and is compared to the page index. Revision lists are only fetched for pages where those moved,
+	# to see if they have revisions after the last one in the dump. Pages which don't are just brought up to date
+	# in the index; the rest are left to the next dump (crawl.py --dump again), which syncs them.
+	# Deleted pages leave no revisions, so they stay in the dump and get reported each time.
+	#
+	# Until the index is complete (dumps made before there was one, or checked with a filter),
+	# pages it doesn't have are compared with the time of the last dump instead, once each.
+	#
+	def verify(self):
+		since = self.lastDumpDate()
+		if since is None:
+			raise Exception("No finished dump at "+self.path+" to verify")
+		index = PageIndex(self.path+'\\.wpages.db')
+		known = index.pages()
+		complete = bool(index.getMeta('complete'))
+		report = {'pages': 0, 'checked': 0, 'new': [], 'deleted': [], 'renamed': [], 'changed': [], 'failed': []}
+		
+		print "Listing pages..."
+		check = [] # [(listed page, index entry or None)]
+		listed = set()
+		for page in self.wd.iter_page_meta(order='dateCreatedAsc', **self.listFilter):
+			report['pages'] += 1
+			if page['page_id'] is None:
+				page['page_id'] = self.getPageId(page['unixname'])
+			listed.add(page['page_id'])
+			old = known.get(page['page_id'])
+			if (old is None) and complete:
+				report['new'].append(page['unixname'])
+			elif (old is None) or (old['unixname'] != page['unixname']) \
+				or (old['edited'] != page['edited']) or (old['revisions'] != page['revisions']):
+				check.append((page, old))
+		if not self.listFilter:
+			report['deleted'] = sorted(old['unixname'] for page_id, old in known.items() if page_id not in listed)
+		
+		print "Pages to check: "+str(len(check))
+		in_sync = []
+		for attempt in range(self.pageRetries + 1):
+			if not check:
+				break
+			if attempt:
+				print "Retrying "+str(len(check))+" failed pages..."
+			check = self.checkPages(check, since, report, in_sync)
+		report['failed'] = [page['unixname'] for page, old in check]
+		index.putMany(in_sync)
+		
+		if not self.listFilter and not (report['new'] or report['deleted'] or report['changed'] or report['failed']):
+			index.setMeta('complete', 1) # every listed page is in the index now
+		index.setMeta('verified', int(time.time()))
+		index.close()
+		return report
+
+	#
+	# Fetches revision lists for pages on listWorkers threads and sorts them into the report,
+	# or into in_sync as index rows. Returns the pages which failed.
+	#
+	def checkPages(self, check, since, report, in_sync):
+		pool = AsyncWikidot(self.wd, max(self.listWorkers, 1))
+		failed = []
+		try:
+			futures = [pool.submit(self.wd.get_revisions, page['page_id'], 10000) for page, old in check]
+			for (page, old), future in zip(check, futures):
+				try:
+					revs = future.result()
+				except Exception as e:
+					print "Cannot check page "+page['unixname']+": "+str(e)
+					failed.append((page, old))
+					continue
+				report['checked'] += 1
+				if old:
+					newer = [rev for rev in revs if int(rev['id']) > old['last_rev_id']]
+				else:
+					newer = [rev for rev in revs if rev['date'] > since]
+				if newer:
+					if old and (old['unixname'] != page['unixname']):
+						report['renamed'].append((old['unixname'], page['unixname']))
+					report['changed'].append((page['unixname'], len(newer)))
+				elif old or revs:
+					last_rev_id = old['last_rev_id'] if old else max(int(rev['id']) for rev in revs)
+					in_sync.append((page['page_id'], page['unixname'], last_rev_id, page['edited'], page['revisions']))
+		finally:
+			pool.close()
+		return failed
@@ -0,0 +1,209 @@
+import sqlite3
+import threading
+import zlib
+import shutil
+from revstore import RevisionStore
+from blobstore import BlobStore
+from metrics import Metrics
+
+# Sharded dumps
+# A big site can be dumped by several machines at once: each takes a share of the pages
+# (crawl.py --dump DIR --shard i/n) and fetches everything their revisions need into a bundle,
+# without committing anything. mergeshards.py then combines the bundles and commits the whole history
+# in one pass, making no requests. The result is the same as dumping the site on one machine.
+#
+# Pages go to shards by a CRC-32 of their name, so every machine agrees without talking to the others.
+#
+# A bundle is a directory, portable as it is:
+#   .wrevs.db		the shard's revision list and files (RevisionStore)
+#   .wbundle.db		page sources and titles/names at each revision, as far as fetched
+#   .wblobs			downloaded files (BlobStore)
+
+# Usage (fetching, see RepoMaintainer.fillBundle):
+#   bundle = ShardBundle(path)
+#   bundle.start(site, shard)
+#   bundle.putRevision(rev, source, details)
+#   bundle.setComplete()
+# Usage (merging):
+#   wd = BundleWikidot(bundles)		# answers RepoMaintainer's queries from the bundles
+
+
+# Parses "i/n" (1 <= i <= n) into (i, n)
+def parseShard(text):
+	try:
+		i, n = [int(part) for part in text.split('/')]
+	except ValueError:
+		raise ValueError("Shard must be given as i/n, e.g. 1/4: "+text)
+	if not (1 <= i <= n):
+		raise ValueError("Shard number must be between 1 and "+str(n)+": "+text)
+	return (i, n)
+
+def shardOf(page, shards):
+	if isinstance(page, unicode):
+		page = page.encode('utf-8')
+	return (zlib.crc32(page) & 0xffffffff) % shards + 1
+
+def inShard(page, shard):
+	return shardOf(page, shard[1]) == shard[0]
+
+
+class ShardBundle:
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path+'\\.wbundle.db', check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.executescript("""
+			CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+			CREATE TABLE IF NOT EXISTS revisions (
+				rev_id INTEGER PRIMARY KEY,
+				page_name TEXT,
+				date INTEGER,
+				source TEXT,
+				unixname TEXT,
+				title TEXT
+			);
+			CREATE INDEX IF NOT EXISTS revisions_page ON revisions (page_name, date, rev_id);
+		""")
+		self.db.commit()
+		self.blobs = BlobStore(path+'\\.wblobs')
+		self.store = None	# Revision store, opened when merging
+		self.file_blobs = None	# File URL -> sha1, when merging
+
+	def close(self):
+		with self.lock:
+			self.db.close() # also folds the WAL back into the file, so the bundle can be copied
+		if self.store:
+			self.store.close()
+			self.store = None
+
+	def getMeta(self, key, default = None):
+		with self.lock:
+			row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		return row[0] if row else default
+
+	def setMeta(self, key, value):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+			self.db.commit()
+
+	# Records which site and shard the bundle is for, or checks it's the same as when it was started
+	def start(self, site, shard):
+		if self.getMeta('site') is None:
+			self.setMeta('site', site)
+			self.setMeta('shard', shard[0])
+			self.setMeta('shards', shard[1])
+		elif (self.getMeta('site') != site) or ((self.getMeta('shard'), self.getMeta('shards')) != shard):
+			raise Exception("Bundle at "+self.path+" is for shard "+str(self.getMeta('shard'))+'/'+str(self.getMeta('shards'))
+				+" of "+self.getMeta('site'))
+
+	def shard(self):
+		return (self.getMeta('shard'), self.getMeta('shards'))
+
+	def isComplete(self):
+		return bool(self.getMeta('complete', False))
+
+	def setComplete(self):
+		self.setMeta('complete', 1)
+
+	def storePath(self):
+		return self.path+'\\.wrevs.db'
+
+	def hasRevision(self, rev_id):
+		with self.lock:
+			return self.db.execute('SELECT 1 FROM revisions WHERE rev_id = ?', (int(rev_id),)).fetchone() is not None
+
+	# Records what was fetched for a revision: its source and details (see Wikidot.get_revision_version),
+	# or None for what its flags say didn't change. Thread-safe.
+	def putRevision(self, rev, source, details):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO revisions (rev_id, page_name, date, source, unixname, title) VALUES (?, ?, ?, ?, ?, ?)',
+				(int(rev['rev_id']), rev['page_name'], rev['date'], source,
+				details['unixname'] if details else None, details['title'] if details else None))
+			self.db.commit()
+
+	#
+	# Returns the revision's row with `columns` filled in: what wasn't fetched for the revision itself
+	# is what it was at the page's last revision which had it fetched.
+	# Returns None if the revision isn't in this bundle.
+	#
+	def _lookup(self, rev_id, columns, known):
+		with self.lock:
+			row = self.db.execute('SELECT page_name, date, '+columns+' FROM revisions WHERE rev_id = ?', (int(rev_id),)).fetchone()
+			if (row is None) or (row[2] is not None):
+				return row
+			row = self.db.execute('SELECT page_name, date, '+columns+' FROM revisions WHERE page_name = ? AND '+known+' IS NOT NULL '
+				'AND (date < ? OR (date = ? AND rev_id < ?)) ORDER BY date DESC, rev_id DESC LIMIT 1',
+				(row[0], row[1], row[1], int(rev_id))).fetchone()
+		if row is None:
+			raise Exception("Bundle at "+self.path+" has no data for revision "+str(rev_id)+" or any before it")
+		return row
+
+	def source(self, rev_id):
+		row = self._lookup(rev_id, 'source', 'source')
+		return row[2] if row else None
+
+	def details(self, rev_id):
+		row = self._lookup(rev_id, 'unixname, title', 'unixname')
+		if not row:
+			return None
+		return {
+		  'rev_id': str(rev_id),
+		  'unixname': row[2],
+		  'title': row[3],
+		  'content': None,
+		}
+
+	# Downloaded file with this URL, or None
+	def fileBlob(self, url):
+		if self.file_blobs is None:
+			if self.store is None:
+				self.store = RevisionStore(self.storePath())
+			self.file_blobs = dict((f['url'], f['sha1']) for f in self.store.files() if f['sha1'])
+		sha1 = self.file_blobs.get(url)
+		if (sha1 is None) or not self.blobs.has(sha1):
+			return None
+		return self.blobs.blobPath(sha1)
+
+
+#
+# Stands in for Wikidot when merging: answers the queries RepoMaintainer makes while committing
+# from the bundles, so the merge makes no requests.
+#
+class BundleWikidot:
+	def __init__(self, bundles):
+		self.bundles = bundles
+		self.site = bundles[0].getMeta('site') if bundles else None
+		self.metrics = Metrics()
+		self.cache = None
+
+	def _find(self, get, rev_id):
+		for bundle in self.bundles:
+			data = get(bundle, rev_id)
+			if data is not None:
+				return data
+		raise Exception("Revision "+str(rev_id)+" is in none of the bundles")
+
+	def get_revision_source(self, rev_id):
+		return self._find(ShardBundle.source, rev_id)
+
+	def get_revision_version(self, rev_id, content = True):
+		if content:
+			raise Exception("Bundles don't keep page content")
+		return self._find(ShardBundle.details, rev_id)
+
+	def download_file(self, url, fp, chunk_size = 65536):
+		for bundle in self.bundles:
+			filename = bundle.fileBlob(url)
+			if filename:
+				with open(filename, 'rb') as blob:
+					shutil.copyfileobj(blob, fp, chunk_size)
+				return
+		raise Exception("File "+url+" is in none of the bundles")
+
+	def effective_rate(self):
+		return 0.0
+
+	def connection_stats(self):
+		return (0, 0)
@@ -0,0 +1,370 @@
+from HTMLParser import HTMLParser
+import htmlentitydefs
+
+# Streaming parsers for Wikidot AJAX responses
+# Built on the event-based HTMLParser: no tree is constructed, each response is scanned once.
+# Results are the same as walking a BeautifulSoup html.parser tree the way wikidot.py used to.
+
+VOID_ELEMENTS = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+	'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+
+#
+# Base parser: keeps a stack of open tags and decodes text the way BeautifulSoup does.
+# Subclasses implement start(tag, attrs), end(tag) and text(data).
+#
+class _Parser(HTMLParser):
+	def __init__(self):
+		HTMLParser.__init__(self)
+		self.stack = []
+
+	def handle_starttag(self, tag, attrs):
+		self.start(tag, dict(attrs))
+		if tag in VOID_ELEMENTS:
+			self.end(tag)
+		else:
+			self.stack.append(tag)
+
+	def handle_startendtag(self, tag, attrs):
+		self.start(tag, dict(attrs))
+		self.end(tag)
+
+	def handle_endtag(self, tag):
+		if tag not in self.stack:
+			return # stray end tag
+		while self.stack:
+			top = self.stack.pop()
+			self.end(top)
+			if top == tag: break
+
+	def handle_data(self, data):
+		self.text(data)
+
+	def handle_charref(self, name):
+		if name.startswith('x') or name.startswith('X'):
+			code = int(name[1:], 16)
+		else:
+			code = int(name)
+		if 128 <= code <= 159:
+			data = chr(code).decode('windows-1252', 'replace') # how browsers (and BeautifulSoup) read these
+		else:
+			data = unichr(code)
+		self.text(data)
+
+	def handle_entityref(self, name):
+		code = htmlentitydefs.name2codepoint.get(name)
+		self.text(unichr(code) if code is not None else '&'+name)
+
+	def start(self, tag, attrs): pass
+	def end(self, tag): pass
+	def text(self, data): pass
+
+	def parse(self, html):
+		self.feed(html)
+		self.close()
+		while self.stack:
+			self.end(self.stack.pop())
+
+
+def _classes(attrs):
+	return (attrs.get('class') or '').split()
+
+
+#
+# PageRevisionListModule: one dict per revision row of the first table
+#
+class _RevisionsParser(_Parser):
+	def __init__(self):
+		_Parser.__init__(self)
+		self.revs = []
+		self.table_depth = None		# stack depth of the first table while we're inside it
+		self.table_seen = False
+		self.row = None				# current row state
+		self.flag_text = None		# text of the flag span being read
+		self.flag_depth = None
+		self.user_depth = None		# inside the printuser span
+		self.date_seen = False
+		self.a_text = None			# text of the <a> being read
+		self.a_depth = None
+		self.tds = []				# open <td> text buffers
+
+	def start(self, tag, attrs):
+		depth = len(self.stack)
+		if (tag == 'table') and not self.table_seen:
+			self.table_seen = True
+			self.table_depth = depth
+			return
+		if self.table_depth is None:
+			return
+		if (tag == 'tr') and (depth == self.table_depth + 1) and (self.stack[-1] == 'table'):
+			self.row = {'id': None, 'date': 0, 'user': None, 'flags': [], 'input_seen': False, 'user_seen': False, 'last_td': None}
+			self.date_seen = False
+			self.tds = []
+			return
+		row = self.row
+		if row is None:
+			return
+		if tag == 'input':
+			if not row['input_seen']: # first <input> has the rev id
+				row['input_seen'] = True
+				row['id'] = attrs.get('value')
+		elif tag == 'span':
+			classes = _classes(attrs)
+			if ('odate' in classes) and not self.date_seen:
+				self.date_seen = True
+				for cls in classes:
+					if cls.startswith('time_'):
+						row['date'] = int(cls[5:])
+			if ('printuser' in classes) and not row['user_seen']:
+				row['user_seen'] = True
+				self.user_depth = depth
+			if ('spantip' in classes) and (self.flag_depth is None):
+				self.flag_text = []
+				self.flag_depth = depth
+		elif (tag == 'a') and (self.user_depth is not None) and (self.a_depth is None):
+			self.a_text = []
+			self.a_depth = depth
+		elif tag == 'td':
+			buf = []
+			row['last_td'] = buf # last td in document order
+			self.tds.append(buf)
+
+	def end(self, tag):
+		depth = len(self.stack)
+		row = self.row
+		if self.table_depth is None:
+			return
+		if (tag == 'table') and (depth == self.table_depth):
+			self.table_depth = None # done with the first table
+			self.row = None
+			return
+		if row is None:
+			return
+		if (tag == 'a') and (self.a_depth == depth):
+			row['user'] = u''.join(self.a_text) # last <a> wins
+			self.a_text = None
+			self.a_depth = None
+		elif (tag == 'span') and (self.flag_depth == depth):
+			row['flags'].append(u''.join(self.flag_text).strip())
+			self.flag_text = None
+			self.flag_depth = None
+		elif (tag == 'span') and (self.user_depth == depth):
+			self.user_depth = None
+		elif tag == 'td':
+			if self.tds: self.tds.pop()
+		elif (tag == 'tr') and (depth == self.table_depth + 1):
+			if row['id'] is not None:
+				last_td = row['last_td']
+				self.revs.append({
+					'id': row['id'],
+					'date': row['date'],
+					'user': row['user'],
+					'comment': u''.join(last_td) if last_td is not None else "",
+					'flags': u''.join(row['flags']),
+				})
+			self.row = None
+
+	def text(self, data):
+		if self.row is None:
+			return
+		if self.a_text is not None:
+			self.a_text.append(data)
+		if self.flag_text is not None:
+			self.flag_text.append(data)
+		for buf in self.tds:
+			buf.append(data)
+
+
+#
+# PageSourceModule: text of the first <div>
+#
+class _SourceParser(_Parser):
+	def __init__(self):
+		_Parser.__init__(self)
+		self.div_depth = None
+		self.done = False
+		self.parts = []
+
+	def start(self, tag, attrs):
+		if (tag == 'div') and (self.div_depth is None) and not self.done:
+			self.div_depth = len(self.stack)
+
+	def end(self, tag):
+		if (tag == 'div') and (self.div_depth == len(self.stack)):
+			self.div_depth = None
+			self.done = True
+
+	def text(self, data):
+		if self.div_depth is not None:
+			self.parts.append(data)
+
+
+#
+# PageVersionModule: "Page name:" from the page-version-info flyout
+#
+class _VersionParser(_Parser):
+	def __init__(self):
+		_Parser.__init__(self)
+		self.info_depth = None
+		self.done = False
+		self.trs = []			# open <tr>s: lists of their <td> texts
+		self.tds = []			# open <td> text buffers
+		self.unixname = None
+
+	def start(self, tag, attrs):
+		depth = len(self.stack)
+		if self.info_depth is None:
+			if (tag == 'div') and (attrs.get('id') == 'page-version-info') and not self.done:
+				self.info_depth = depth
+			return
+		if tag == 'tr':
+			self.trs.append([])
+		elif tag == 'td':
+			buf = []
+			for tr in self.trs:
+				tr.append(buf)
+			self.tds.append(buf)
+
+	def end(self, tag):
+		if self.info_depth is None:
+			return
+		if (tag == 'div') and (self.info_depth == len(self.stack)):
+			self.info_depth = None
+			self.done = True
+		elif tag == 'td':
+			if self.tds: self.tds.pop()
+		elif tag == 'tr' and self.trs:
+			tds = self.trs.pop()
+			if len(tds) >= 2 and u''.join(tds[0]).strip() == 'Page name:':
+				self.unixname = u''.join(tds[1]).strip()
+
+	def text(self, data):
+		for buf in self.tds:
+			buf.append(data)
+
+
+#
+# ListPagesModule (separate=false): entries of the list, one per <br/>-separated line of the first <p>.
+# Each entry is its text plus the time of the first odate span in it, if any. Dates rendered in the spans are skipped.
+#
+class _ListPagesParser(_Parser):
+	def __init__(self):
+		_Parser.__init__(self)
+		self.p_depth = None
+		self.done = False
+		self.odate_depth = None
+		self.entries = []
+		self.text_parts = []
+		self.time = None
+
+	def start(self, tag, attrs):
+		depth = len(self.stack)
+		if self.p_depth is None:
+			if (tag == 'p') and not self.done and ('div' in self.stack):
+				self.p_depth = depth
+			return
+		if tag == 'br':
+			self.flush()
+		elif (tag == 'span') and (self.odate_depth is None) and ('odate' in _classes(attrs)):
+			self.odate_depth = depth
+			for cls in _classes(attrs):
+				if cls.startswith('time_') and (self.time is None):
+					self.time = int(cls[5:])
+
+	def end(self, tag):
+		depth = len(self.stack)
+		if self.p_depth is None:
+			return
+		if (tag == 'span') and (self.odate_depth == depth):
+			self.odate_depth = None
+		elif (tag == 'p') and (self.p_depth == depth):
+			self.flush()
+			self.p_depth = None
+			self.done = True
+
+	def text(self, data):
+		if (self.p_depth is not None) and (self.odate_depth is None):
+			self.text_parts.append(data)
+
+	def flush(self):
+		text = u''.join(self.text_parts).strip()
+		if text or (self.time is not None):
+			self.entries.append((text, self.time))
+		self.text_parts = []
+		self.time = None
+
+
+#
+# PageFilesModule: a row per attached file, with a link to it and its size in a "N bytes" title
+#
+class _FilesParser(_Parser):
+	def __init__(self):
+		_Parser.__init__(self)
+		self.files = []
+		self.row = None
+		self.a_depth = None
+
+	def start(self, tag, attrs):
+		if (tag == 'tr') and (attrs.get('id') or '').startswith('file-row-'):
+			self.row = {'id': attrs['id'][9:], 'name': None, 'url': None, 'size': None, 'text': []}
+			return
+		row = self.row
+		if row is None:
+			return
+		if (tag == 'a') and (row['url'] is None) and attrs.get('href'):
+			row['url'] = attrs['href'] # first link is the file itself
+			self.a_depth = len(self.stack)
+		elif (row['size'] is None) and (attrs.get('title') or '').endswith(' bytes'):
+			try:
+				row['size'] = int(attrs['title'][:-6].replace(',', '').replace(' ', ''))
+			except ValueError:
+				pass
+
+	def end(self, tag):
+		row = self.row
+		if row is None:
+			return
+		if (tag == 'a') and (self.a_depth == len(self.stack)):
+			row['name'] = u''.join(row['text']).strip()
+			self.a_depth = None
+		elif tag == 'tr':
+			if row['url']:
+				del row['text']
+				self.files.append(row)
+			self.row = None
+
+	def text(self, data):
+		if self.a_depth is not None:
+			self.row['text'].append(data)
+
+
+# Returns a list of {'id', 'name', 'url', 'size'} for a PageFilesModule response. size is None if not given.
+def parse_files(html):
+	parser = _FilesParser()
+	parser.parse(html)
+	return parser.files
+
+# Returns a list of (text, time) entries for a ListPagesModule response, see _ListPagesParser
+def parse_list_pages(html):
+	parser = _ListPagesParser()
+	parser.parse(html)
+	return parser.entries
+
+# Returns a list of {'id', 'date', 'user', 'comment', 'flags'} for a PageRevisionListModule response.
+# Flags are the letters Wikidot shows for the kinds of changes made in a revision, see rmaint.fetchRevision.
+def parse_revisions(html):
+	parser = _RevisionsParser()
+	parser.parse(html)
+	return parser.revs
+
+# Returns page source from a PageSourceModule response
+def parse_revision_source(html):
+	parser = _SourceParser()
+	parser.parse(html)
+	return u''.join(parser.parts).lstrip(' \r\n')
+
+# Returns page unix name at the time of the revision from a PageVersionModule response
+def parse_revision_unixname(html):
+	parser = _VersionParser()
+	parser.parse(html)
+	return parser.unixname
@@ -1,45 +1,155 @@
 import requests
 import random
-from bs4 import BeautifulSoup
+import threading
 import time
+import urlparse
+import urllib
+import re
+from ratelimit import RateLimiter
+from metrics import Metrics
+import wdparse
 
 # Implements various queries to Wikidot engine through its AJAX facilities
 
+# Modules whose responses for a given revision never change, and can be cached (by revision_id)
+IMMUTABLE_MODULES = set(['history/PageSourceModule', 'history/PageVersionModule'])
+
+# Page ID, as set by a script in the page head
+PAGE_ID_RE = re.compile(r'WIKIREQUEST\.info\.pageId\s*=\s*(\d+)')
 
 class Wikidot:
 	def __init__(self, site):
 		self.site = site		# Wikidot site to query
-		self.delay = 200		# Delay between requests in msec
+		self.delay = 200		# Delay between requests in msec (steady-state rate)
+		self.file_delay = 100	# Delay between file downloads in msec; files come from a separate file host
+		self.burst = 1			# Allow this many requests in a burst
+		self.retries = 3		# Retry throttled/failed requests this many times
 		self.debug = False		# Print debug messages
-		self.next_timeslot = time.clock()	# Can call immediately
+		self.limiter = None		# RateLimiter, created on first request from delay/burst
+		self.file_limiter = None	# RateLimiter for file downloads, from file_delay
+		self.shared_limiter = None	# FairLimiter shared with other Wikidot instances (a cap over several sites), if any
+		self.pool_size = 10		# Max keep-alive connections kept open to the site
+		self.timeout = 60		# Network timeout in seconds
+		self.session = None		# Pooled HTTP session, created on first request
+		self.token = None		# wikidot_token7 of the session
+		self.cache = None		# ResponseCache for immutable responses, if any
+		self.metrics = Metrics()	# Request timings and counts
+		self.list_page_size = 250	# Entries per ListPagesModule request
+		self.lock = threading.Lock()	# Wikidot may be shared by several fetching threads
+
+
+	# All requests go through a single keep-alive session with connection pooling,
+	# so we don't pay for a TCP+TLS handshake on every AJAX call.
+	# Settings are applied on first use, so pool_size/timeout can be changed after construction.
+	def _session(self):
+		with self.lock:
+			if self.session is None:
+				session = requests.Session()
+				# A pool for the site, and one for its file host
+				adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size)
+				session.mount('http://', adapter)
+				session.mount('https://', adapter)
+				session.headers['Accept-Encoding'] = 'gzip, deflate'
+				# Wikidot only checks that the token in the cookie matches the one in the request,
+				# so one token per session is enough.
+				self.token = "".join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for i in range(8))
+				session.cookies.set('wikidot_token7', self.token)
+				self.session = session
+		return self.session
+
+	def _request(self, method, url, **kwargs):
+		return self._session().request(method, url, timeout=self.timeout, **kwargs)
+
+	# Returns (opened, reused) connection counts for the session so far.
+	def connection_stats(self):
+		if self.session is None:
+			return (0, 0)
+		opened = 0
+		requests_made = 0
+		for adapter in set(self.session.adapters.values()): # same adapter is mounted for both schemes
+			pools = adapter.poolmanager.pools
+			for key in pools.keys():
+				pool = pools.get(key)
+				if pool is None: continue
+				opened += pool.num_connections
+				requests_made += pool.num_requests
+		return (opened, max(requests_made - opened, 0))
 
 
-	# To honor usage rules, we wait for self.delay between requests.
-	# Low-level query functions call this before every request to Wikidot./
+	def _limiter(self):
+		with self.lock:
+			if self.limiter is None:
+				self.limiter = RateLimiter(1000.0 / self.delay if self.delay > 0 else 0, self.burst)
+		return self.limiter
+
+	# To honor usage rules, we keep to 1000/self.delay requests per second on average,
+	# and to our share of the shared limit if there's one.
+	# Low-level query functions call this before every request to Wikidot.
+	# Thread-safe.
 	def _wait_request_slot(self):
-		tm = time.clock()
-		if self.next_timeslot - tm > 0:
-			time.sleep(self.next_timeslot - tm)
-		self.next_timeslot = tm + self.delay / 1000
-		pass
+		waited = self._limiter().wait()
+		if self.shared_limiter is not None:
+			waited += self.shared_limiter.wait(self.site)
+		self.metrics.observe('request_slot_wait_seconds', waited)
+
+	# Requests per second we're actually making
+	def effective_rate(self):
+		return self._limiter().effective_rate()
+
+	# Makes a request in a request slot. Throttling and server errors make us back off and retry.
+	# Latency is recorded under `module` (moduleName for AJAX queries).
+	def _slotted_request(self, method, url, module = 'page', **kwargs):
+		limiter = self._limiter()
+		attempt = 0
+		while True:
+			self._wait_request_slot()
+			started = time.time()
+			try:
+				req = self._request(method, url, **kwargs)
+			except requests.exceptions.RequestException:
+				self.metrics.count('http_errors_total', module=module, status='network')
+				if attempt >= self.retries: raise
+				req = None
+			self.metrics.observe('http_request_seconds', time.time() - started, module=module)
+			if (req is not None) and (req.status_code != 429) and (req.status_code < 500):
+				return req
+			if req is not None:
+				self.metrics.count('http_errors_total', module=module, status=req.status_code)
+			limiter.backoff()
+			if attempt >= self.retries:
+				req.raise_for_status()
+			attempt += 1
+			self.metrics.count('http_retries_total', module=module)
+			if self.debug:
+				print "Retrying "+url+" ("+(str(req.status_code) if req is not None else "network error")+")"
 
 	# Makes a Wikidot AJAX query. Returns the response+title or throws an error.
+	# Responses of immutable modules are served from self.cache if it's set.
 	def queryex(self, params):
-		token = "".join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for i in range(8))
-		cookies = {"wikidot_token7": token}
-		params['wikidot_token7'] = token
+		cached = (self.cache is not None) and (params.get('moduleName') in IMMUTABLE_MODULES) and ('revision_id' in params)
+		if cached:
+			res = self.cache.get(self.site, params['moduleName'], params['revision_id'])
+			if res is not None:
+				self.metrics.count('cache_hits_total', module=params['moduleName'])
+				return tuple(res)
+
+		self._session()
+		params['wikidot_token7'] = self.token
 	
 		if self.debug:
 			print params
-			print cookies
 
-		self._wait_request_slot()
-		req = requests.request('POST', self.site+'/ajax-module-connector.php', data=params, cookies=cookies)
+		req = self._slotted_request('POST', self.site+'/ajax-module-connector.php', params.get('moduleName'), data=params)
 		json = req.json()
 		if json['status'] == 'ok':
-			return json['body'], (json['title'] if 'title' in json else '')
+			self._limiter().success()
+			res = json['body'], (json['title'] if 'title' in json else '')
+			if cached:
+				self.cache.put(self.site, params['moduleName'], params['revision_id'], res)
+			return res
 		else:
-			raise req.text
+			self._limiter().backoff()
+			raise Exception(req.text)
 
 	# Same but only returns the body, most responses don't have titles
 	def query(self, params):
@@ -47,28 +157,101 @@ class Wikidot:
 
 
 	# List all pages for the site.
-
-	# Raw version
-	# For the supported formats (module_body) see:
+	# Wikidot returns lists a page (perPage entries) at a time; we walk through them with offset.
+	# Filters are ListPagesModule selectors, e.g. category='news', created_at='> 2015-01-01', updated_at='last 7 day'.
+	# For the supported formats (module_body) and selectors see:
 	# See https://github.com/gabrys/wikidot/blob/master/php/modules/list/ListPagesModule.php
-	def list_pages_raw(self, limit):
-		res = self.query({
+
+	# Raw version: a single list page
+	def list_pages_raw(self, limit, module_body = '%%page_unix_name%%', order = 'dateCreatedDesc', offset = 0,
+			category = None, created_at = None, updated_at = None):
+		params = {
 		  'moduleName': 'list/ListPagesModule',
-		  'limit': limit if limit else '10000',
-		  'perPage': limit if limit else '10000',
-		  'module_body': '%%page_unix_name%%',
+		  'perPage': limit if limit else self.list_page_size,
+		  'offset': offset,
+		  'module_body': module_body,
 		  'separate': 'false',
-		  'order': 'dateCreatedDesc',  # This way limit makes sense. This is also the default
-		})
-		return res
+		  'order': order,  # dateCreatedDesc: this way limit makes sense. This is also the default
+		}
+		if category: params['category'] = category
+		if created_at: params['created_at'] = created_at
+		if updated_at: params['updated_at'] = updated_at
+		return self.query(params)
 
-	# Client version
-	def list_pages(self, limit):
-		raw = self.list_pages_raw(limit).replace('<br/>',"\n")
-		soup = BeautifulSoup(raw, 'html.parser')
+	# Yields (text, time) for each entry of the list, requesting list pages as they're consumed.
+	# time is that of the first %%created_at%%/%%updated_at%% in module_body, if any.
+	def iter_list_pages(self, module_body, order = 'dateCreatedDesc', limit = None, **filters):
+		offset = 0
+		last_entries = None
+		while True:
+			per_page = min(self.list_page_size, limit - offset) if limit else self.list_page_size
+			if per_page <= 0:
+				return
+			res = self.list_pages_raw(per_page, module_body, order, offset, **filters)
+			with self.metrics.timer('parse_seconds', what='list_pages'):
+				entries = wdparse.parse_list_pages(res)
+			if (not entries) or (entries == last_entries):
+				return # past the end, or the offset wasn't honored
+			for entry in entries:
+				yield entry
+			if len(entries) < per_page:
+				return
+			offset += len(entries)
+			last_entries = entries
+
+	# Client version: yields page unix names
+	def list_pages(self, limit = None, order = 'dateCreatedDesc', **filters):
+		for text, time in self.iter_list_pages('%%page_unix_name%%', order, limit, **filters):
+			yield text
+
+
+	# Yields (page unix name, page ID) for all pages, without loading each page.
+	# Page ID is None if Wikidot didn't give a proper one.
+	def iter_page_ids(self, limit = None, order = 'dateCreatedDesc', **filters):
+		for text, time in self.iter_list_pages('%%page_unix_name%% %%page_id%%', order, limit, **filters):
+			parts = text.split()
+			if not parts: continue
+			try:
+				page_id = int(parts[1]) if len(parts) == 2 else None
+			except ValueError:
+				page_id = None # not substituted
+			yield (parts[0], page_id)
+
+	# Maps page unix names to page IDs for all pages at once.
+	# Pages for which Wikidot didn't give a proper ID are left out.
+	def list_page_ids(self, limit = None, **filters):
+		return dict((name, page_id) for (name, page_id) in self.iter_page_ids(limit, **filters) if page_id is not None)
+
+	# Yields what the listing tells about each page, for change detection without loading pages or their histories:
+	# {'unixname', 'page_id', 'revisions' (revision count), 'edited' (last edit time)}. Values Wikidot didn't give are None.
+	def iter_page_meta(self, limit = None, order = 'dateCreatedDesc', **filters):
+		for text, edited in self.iter_list_pages('%%page_unix_name%% %%page_id%% %%revisions%% %%updated_at%%', order, limit, **filters):
+			parts = text.split()
+			if not parts: continue
+			numbers = []
+			for part in parts[1:3]:
+				try:
+					numbers.append(int(part))
+				except ValueError:
+					numbers.append(None) # not substituted
+			numbers += [None] * (2 - len(numbers))
+			yield {
+			  'unixname': parts[0],
+			  'page_id': numbers[0],
+			  'revisions': numbers[1],
+			  'edited': edited,
+			}
+
+	# Lists pages edited after a given time, most recently edited first.
+	# Returns a list of (page_unix_name, last_edit_time) pairs.
+	def list_pages_edited_since(self, since, limit = None, **filters):
 		pages = []
-		for entry in soup.div.p.text.split('\n'):
-			pages.append(entry)
+		# Names come as text, edit times as <span class="odate time_*"> right after them
+		for name, edited in self.iter_list_pages('%%page_unix_name%% %%updated_at%%', 'dateEditedDesc', limit, **filters):
+			if edited is None: continue
+			if edited <= since:
+				break # the rest were edited even earlier
+			pages.append((name, edited))
 		return pages
 
 
@@ -77,74 +260,40 @@ class Wikidot:
 
 	def get_page_id(self, page_unix_name):
 		# The only freaking way to get page ID is to load the page! Wikidot!
-		self._wait_request_slot()
-		req = requests.request('GET', self.site+'/'+page_unix_name)
-		soup = BeautifulSoup(req.text, 'html.parser')
-		for item in soup.head.find_all('script'):
-			text = item.text
-			pos = text.find("WIKIREQUEST.info.pageId = ")
-			if pos >= 0:
-				pos += len("WIKIREQUEST.info.pageId = ")
-				crlf = text.find(";", pos)
-				if crlf >= 0:
-					return int(text[pos:crlf])
-				else:
-					return int(text[pos:])
-		return None
+		req = self._slotted_request('GET', self.site+'/'+page_unix_name)
+		self._limiter().success()
+		# It's in a script in the page head. No need to parse the whole page for that
+		# (newer BeautifulSoup versions don't even return script text).
+		with self.metrics.timer('parse_seconds', what='page'):
+			match = PAGE_ID_RE.search(req.text)
+		return int(match.group(1)) if match else None
 
 
 	# Retrieves a list of revisions for a page.
 	# See https://github.com/gabrys/wikidot/blob/master/php/modules/history/PageRevisionListModule.php
 
-	# Raw version
-	def get_revisions_raw(self, page_id, limit):
-		res = self.query({
+	def _query_revisions(self, page_id, limit):
+		return self.query({
 		  'moduleName': 'history/PageRevisionListModule',
 		  'page_id': page_id,
 		  'page': '1',
 		  'perpage': limit if limit else '10000',
 		  'options': '{"all":true}'
 		})
-		
-		soup = BeautifulSoup(res, 'html.parser')
+
+	# Raw version
+	def get_revisions_raw(self, page_id, limit):
+		from bs4 import BeautifulSoup
+		soup = BeautifulSoup(self._query_revisions(page_id, limit), 'html.parser')
 		return soup.table.contents
 
 	# Client version
+	# RevID is the value of the first INPUT field, unixtime is a CSS class time_* of span.odate,
+	# username is in the last <a> under span.printuser, comment is in the last TD of the row.
 	def get_revisions(self, page_id, limit):
-		revs = []
-		for tr in self.get_revisions_raw(page_id, limit):
-			if tr.name != 'tr': continue # there's a header + various junk
-
-			# RevID is stored as a value of an INPUT field
-			rev_id = tr.input['value'] if tr.input else None
-			if rev_id is None: continue # can't parse
-
-			# Unixtime is stored as a CSS class time_*
-			rev_date = 0
-			date_span = tr.find("span", attrs={"class": "odate"})
-			if date_span is not None:
-				for cls in date_span['class']:
-					if cls.startswith('time_'):
-						rev_date = int(cls[5:])
-
-			# Username in a last <a> under <span class="printuser">
-			user_span = tr.find("span", attrs={"class": "printuser"})
-			for last_a in user_span.find_all('a'): pass
-			rev_user = last_a.getText() if last_a else None
-			
-
-			# Comment is in the last TD of the row
-			last_td = None
-			for last_td in tr.find_all('td'): pass
-			rev_comment = last_td.getText() if last_td else ""
-
-			revs.append({
-				'id': rev_id,
-				'date': rev_date,
-				'user': rev_user,
-				'comment': rev_comment,
-			})
-		return revs
+		res = self._query_revisions(page_id, limit)
+		with self.metrics.timer('parse_seconds', what='revisions'):
+			return wdparse.parse_revisions(res)
 
 
 	# Retrieves revision source for a revision.
@@ -155,12 +304,12 @@ class Wikidot:
 		  'revision_id': rev_id,
 		  # We don't need page id
 		})
-		# The source is HTMLified but BeautifulSoup's getText() will decode that
+		# The source is HTMLified but taking the text of the first div will decode that
 		# - htmlentities
 		# - <br/>s in place of linebreaks
 		# - random real linebreaks (have to be ignored)
-		soup = BeautifulSoup(res, 'html.parser')
-		return soup.div.getText().lstrip(' \r\n')
+		with self.metrics.timer('parse_seconds', what='source'):
+			return wdparse.parse_revision_source(res)
 	
 	# Retrieves the rendered version + additional info unavailable in get_revision_source:
 	# * Title
@@ -172,9 +321,22 @@ class Wikidot:
 		})
 		return res
 	
-	def get_revision_version(self, rev_id):
+	# Rendered content takes a full parse, so only include it if asked to.
+	def get_revision_version(self, rev_id, content = True):
 		res = self.get_revision_version_raw(rev_id) # this has title!
-		soup = BeautifulSoup(res[0], 'html.parser')
+		if not content:
+			with self.metrics.timer('parse_seconds', what='version'):
+				unixname = wdparse.parse_revision_unixname(res[0])
+			return {
+			  'rev_id': rev_id,
+			  'unixname': unixname,
+			  'title': res[1],
+			  'content': None,
+			}
+
+		from bs4 import BeautifulSoup
+		with self.metrics.timer('parse_seconds', what='version'):
+			soup = BeautifulSoup(res[0], 'html.parser')
 
 		# First table is a flyout with revision details. Remove and study it.
 		unixname = None
@@ -190,4 +352,56 @@ class Wikidot:
 		  'unixname': unixname,
 		  'title': res[1],
 		  'content': unicode(soup), # only content remains
-		}
\ No newline at end of file
+		}
+
+
+	# Lists files attached to a page.
+	# Returns a list of {'id', 'name', 'url', 'size'}; url is absolute, size is None if Wikidot didn't say.
+	def get_files(self, page_id):
+		res = self.query({
+		  'moduleName': 'files/PageFilesModule',
+		  'page_id': page_id,
+		})
+		with self.metrics.timer('parse_seconds', what='files'):
+			files = wdparse.parse_files(res)
+		for f in files:
+			f['url'] = urlparse.urljoin(self.site+'/', f['url'])
+			if not f['name']:
+				f['name'] = urllib.unquote(f['url'].rstrip('/').split('/')[-1]).decode('utf-8', 'replace')
+		return files
+
+	def _file_limiter(self):
+		with self.lock:
+			if self.file_limiter is None:
+				self.file_limiter = RateLimiter(1000.0 / self.file_delay if self.file_delay > 0 else 0)
+		return self.file_limiter
+
+	# Downloads a file, writing it to fp a chunk at a time. Returns the number of bytes written.
+	# Downloads don't count against the AJAX request rate, they have their own (file_delay).
+	# Thread-safe.
+	def download_file(self, url, fp, chunk_size = 65536):
+		attempt = 0
+		while True:
+			self._file_limiter().wait()
+			started = time.time()
+			try:
+				req = self._session().get(url, stream=True, timeout=self.timeout)
+				req.raise_for_status()
+				size = 0
+				for chunk in req.iter_content(chunk_size):
+					fp.write(chunk)
+					size += len(chunk)
+				self.metrics.observe('download_seconds', time.time() - started)
+				self.metrics.count('download_bytes_total', size)
+				self._file_limiter().success()
+				return size
+			except requests.exceptions.RequestException as e:
+				self.metrics.count('download_errors_total')
+				response = getattr(e, 'response', None)
+				if (response is not None) and (response.status_code != 429) and (response.status_code < 500):
+					raise # e.g. gone since it was listed, no point retrying
+				if attempt >= self.retries: raise
+				self._file_limiter().backoff()
+				attempt += 1
+				fp.seek(0) # start over
+				fp.truncate()